@@ -1,157 +1,175 @@
-import os
+import importlib
+from collections.abc import Mapping
 from typing import TYPE_CHECKING
 
-import numpy as np
-import polars as pl
+# Importing the package is kept cheap, as every notebook, worker and scoring process
+# pays for it: NumPy, Polars and the stage modules are only imported once they are
+# used, through the attributes below (see __getattr__) or the functions.
+if TYPE_CHECKING:
+    import numpy as np
 
-from .constants import data_dir
-from .create_splits import split_data
-from .link_rtm_sas import ensure_linked
-from .space_pad import ensure_space_padded
-from .space_window import ensure_space_window
-from .svd_kernels import ensure_kernels
-from .time_window import ensure_time_window
+    from . import pipeline
+    from .constants import data_dir
+    from .create_splits import TransformedSplits, load_splits, split_data
+    from .rollups import Rollups
+    from .rtm_index import RtmIndex
+    from .svd_kernels import KernelTransform
 
-if TYPE_CHECKING:
-    from numpy.lib.npyio import NpzFile
+# The attributes that are imported on first use, and the modules they come from
+_LAZY = {
+    "pipeline": ".pipeline",
+    "data_dir": ".constants",
+    "TransformedSplits": ".create_splits",
+    "load_splits": ".create_splits",
+    "split_data": ".create_splits",
+    "KernelTransform": ".svd_kernels",
+    "Rollups": ".rollups",
+    "RtmIndex": ".rtm_index",
+}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_LAZY[name], __name__)
+    value = module if module.__name__ == f"{__name__}.{name}" else getattr(module, name)
+    globals()[name] = value
+    return value
 
 
-def get_base_splits(name: str = "simple_splits.npz") -> "NpzFile":
+def __dir__() -> list[str]:
+    return sorted([*globals(), *_LAZY])
+
+
+def get_base_splits(name: str = "simple_splits.npz") -> Mapping[str, "np.ndarray"]:
     """
     Makes sure that the system has the 'simple_splits' numpy file for the
-    training tuning and testing of the models. If it does not yet exist
-    it is made.
+    training tuning and testing of the models. If it does not yet exist, or any of
+    the files it is made from changed, it is made.
     :param name: The name of the split data file.
-    :returns: A NpZ file-mapped dictionary containing the 6 splits
+    :returns: A dictionary containing the 6 splits, memory-mapped by default
     """
-    if not os.path.isfile(data_dir(f"samples/{name}")):
-        ensure_linked(
-            "train_joined.pq",
-            original_rtm="train_preprocessed.pq",
-            original_sas="avg_cleaned.pq",
-        )
-        split_data(
-            "train_joined.pq",
-            split_file=name,
-            input_columns=["volt_1", "volt_2", "volt_7", "distance_to_sensor"],
-            target_column="sensor_voltage",
-        )
-    return np.load(data_dir(f"samples/{name}"))
+    from . import pipeline, preview
+    from .create_splits import load_splits
+
+    with preview.active():
+        (split_file,) = pipeline.build_all(pipeline.base_splits_stage(name))
+        return load_splits(split_file)
 
 
 def get_time_splits(
     name: str = "train_splits.npz", include_interpolated: bool = True
-) -> "NpzFile":
+) -> Mapping[str, "np.ndarray"]:
     """
     Makes sure that the splits file for the extra time dimension data set exists for
     training, tuning, and testing of the neural networks using this dataset. If the
-    file does not exist it is made.
+    file does not exist, or any of the files it is made from changed, it is made.
     :param name: The name of the splits file.
     :param include_interpolated: A parameter stating whether datapoints that are
     centred on an interpolated point should be included
-    :returns: A NpZ file-mapped dictionary containing the 6 splits
+    :returns: A dictionary containing the 6 splits, memory-mapped by default
     """
+    from . import pipeline, preview
+    from .create_splits import load_splits
+
     if name == "train_splits.npz" and not include_interpolated:
         name = "train_ni_splits.npz"
-    if not os.path.isfile(data_dir(f"samples/{name}")):
-        ensure_linked(
-            "train_joined.pq",
-            original_rtm="train_cleaned.pq",
-            original_sas="avg_cleaned.pq",
-        )
-        ensure_time_window("train_joined.pq", include_interpolated=include_interpolated)
-        split_data(
-            "interpolated_train_joined.pq",
-            split_file=name,
-            input_columns=[
-                "volt_1",
-                "volt_2",
-                "volt_7",
-                "distance_to_sensor",
-                "pre_volt_1",
-                "pre_volt_2",
-                "pre_volt_7",
-                "pre_distance_to_sensor",
-                "pos_volt_1",
-                "pos_volt_2",
-                "pos_volt_7",
-                "pos_distance_to_sensor",
-            ],
-            target_column="sensor_voltage",
+    with preview.active():
+        (split_file,) = pipeline.build_all(
+            pipeline.time_splits_stage(name, include_interpolated)
         )
-    return np.load(data_dir(f"samples/{name}"))
+        return load_splits(split_file)
 
 
-def get_space_splits(name: str = "space_splits.npz") -> "NpzFile":
+def get_space_splits(
+    name: str = "space_splits.npz", window_size_m: int = 5_000
+) -> Mapping[str, "np.ndarray"]:
     """
     Makes sure that the splits file for the extra space dimension data set exists for
     training, tuning, and testing of the neural networks using this dataset. If the
-    file does not exist it is made.
+    file does not exist, or any of the files it is made from changed, it is made.
     :param name: The name of the splits file.
-    :returns: A NpZ file-mapped dictionary containing the 6 splits
+    :param window_size_m: The radius of the space window in metres.
+    :returns: A dictionary containing the 6 splits, memory-mapped by default
     """
-    if not os.path.isfile(data_dir(f"samples/{name}")):
-        print("space split file missing")
-        print("checking space window")
-        ensure_space_window(
-            "space_window.pq",
-            original_train="train.pq",
-            original_train_preprocessed="train_preprocessed.pq",
-        )
-        print("checking linked")
-        ensure_linked(
-            "space_joined.pq",
-            original_rtm="space_window.pq",
-            original_sas="avg_cleaned.pq",
-        )
-        print("checking padding")
-        ensure_space_padded("space_padded.pq", original="space_joined.pq")
-        print("splitting")
-        split_data(
-            "space_padded.pq",
-            split_file=name,
-            input_columns=[pl.exclude("sensor_voltage")],
-            target_column="sensor_voltage",
-        )
+    from . import pipeline, preview
+    from .create_splits import load_splits
 
-    return np.load(data_dir(f"samples/{name}"))
+    with preview.active():
+        (split_file,) = pipeline.build_all(
+            pipeline.space_splits_stage(name, window_size_m)
+        )
+        return load_splits(split_file)
 
 
 def get_kernel_splits(
-    name: str = "kernel_splits.npz", original: str = "train_joined.pq"
-):
+    name: str = "kernel_splits.npz",
+    original: str = "train_joined.pq",
+    lazy: bool = False,
+) -> Mapping[str, "np.ndarray"]:
     """
     Makes sure that the data splits exist with all the available kernels for
     training, tuning, and testing for the support vector machine. If it does not
-    yet exist it is made.
+    yet exist, or any of the files it is made from changed, it is made.
     :param name: The name of the split data file.
-    :param original: The name of the original data file to process
-    :returns: A NpZ file-mapped dictionary containing the 6 splits
+    :param original: The name of the linked file to make the kernels from
+    :param lazy: Whether to make the kernels from the base splits when a split is
+    accessed, instead of storing them (see svd_kernels.KernelTransform). The rows are
+    then split like the base splits, so name and original can't be given.
+    :returns: A dictionary containing the 6 splits, memory-mapped by default
     """
-    if not os.path.isfile(data_dir(f"samples/{name}")):
-        print("no kernel file")
-        print("linking with sas")
-        ensure_linked(
-            original,
-            original_rtm="train_preprocessed.pq",
-            original_sas="avg_cleaned.pq",
-        )
-        print("making kernels")
-        ensure_kernels("kernels.pq", original=original)
-        print("splitting")
-        split_data(
-            "kernels.pq",
-            input_columns=[pl.exclude("sensor_voltage")],
-            target_column="sensor_voltage",
-            split_file=name,
-        )
-    return np.load(data_dir(f"samples/{name}"))
+    from . import pipeline, preview
+    from .create_splits import TransformedSplits, load_splits
+    from .svd_kernels import KernelTransform
+
+    if lazy:
+        if (name, original) != ("kernel_splits.npz", "train_joined.pq"):
+            raise ValueError(
+                "Lazy kernel splits are made from the base splits, without a name or"
+                f" original file, got {name=} and {original=}"
+            )
+        return TransformedSplits(get_base_splits(), KernelTransform.svd(4))
+    with preview.active():
+        (split_file,) = pipeline.build_all(pipeline.kernel_splits_stage(name, original))
+        return load_splits(split_file)
+
+
+def get_rollups(resolutions: list[str] = None) -> "Rollups":
+    """
+    Makes sure that the per-sensor rollups of the SAS and linked data exist, for
+    quick statistics and distributions. If they do not exist yet, or any of the files
+    they are made from changed, they are made.
+    :param resolutions: The lengths of the buckets, see rollups.rollup.
+    :returns: The rollups, to query with e.g. summary or quantiles
+    """
+    from . import pipeline, preview
+    from .rollups import Rollups
+
+    with preview.active():
+        (rollup_dir,) = pipeline.build_all(pipeline.rollups_stage(resolutions))
+        return Rollups(rollup_dir)
+
+
+def get_rtm_index() -> "RtmIndex":
+    """
+    Makes sure that the preprocessed RTM data indexed by sensor and time exists. If it
+    does not exist yet, or any of the files it is made from changed, it is made.
+    :returns: The index, to find the measurements near a sensor with query
+    """
+    from . import pipeline, preview
+    from .rtm_index import RtmIndex
+
+    with preview.active():
+        (index_file,) = pipeline.build_all(pipeline.rtm_index_stage())
+        return RtmIndex(index_file)
 
 
 __all__ = [
-    data_dir,
-    get_base_splits,
-    get_space_splits,
-    get_time_splits,
-    get_kernel_splits,
+    "data_dir",
+    "get_base_splits",
+    "get_space_splits",
+    "get_time_splits",
+    "get_kernel_splits",
+    "get_rollups",
+    "get_rtm_index",
 ]
@@ -0,0 +1,146 @@
+import json
+import os
+
+import polars as pl
+
+from .constants import with_suffix
+
+# The format of the intermediate files, which are written by one stage and read by
+# the next. Parquet ("parquet") is compact, but every read decompresses and decodes
+# the whole file. Arrow IPC files are in the in-memory layout of Polars, so they are
+# memory-mapped instead of read: uncompressed ("ipc") they are used without copying,
+# and the pages are shared by all processes reading them, at the cost of 3 to 5 times
+# the disk space. With LZ4 ("ipc_lz4"), the buffers are decompressed on read, which is
+# far cheaper than decoding parquet. Can be set with CLEAN_ARTIFACT_FORMAT, see
+# benchmark.py --formats for a comparison on the whole chain.
+# The format of an artifact follows from its suffix, so files of both formats can be
+# read in one build. Polars can't store key-value metadata in IPC files, so the
+# metadata of an IPC artifact (like its sort order, see sortedness.py) is written to
+# a .meta.json file next to it. Every artifact records the codec it was written with.
+ARTIFACT_FORMATS = {
+    "parquet": (".pq", "zstd"),
+    "ipc": (".arrow", "uncompressed"),
+    "ipc_lz4": (".arrow", "lz4"),
+}
+IPC_SUFFIX = ".arrow"
+CODEC_KEY = "clean.codec"
+
+
+def artifact_format() -> str:
+    """
+    :return: The format new artifacts are written in, from CLEAN_ARTIFACT_FORMAT.
+    """
+    fmt = os.environ.get("CLEAN_ARTIFACT_FORMAT", "parquet")
+    if fmt not in ARTIFACT_FORMATS:
+        raise ValueError(
+            f"Unknown artifact format {fmt!r}, expected one of {list(ARTIFACT_FORMATS)}"
+        )
+    return fmt
+
+
+def artifact_suffix() -> str:
+    """
+    :return: The file suffix of new artifacts, see artifact_format.
+    """
+    return ARTIFACT_FORMATS[artifact_format()][0]
+
+
+def is_ipc(path: str) -> bool:
+    return path.endswith(IPC_SUFFIX)
+
+
+def metadata_file(path: str) -> str:
+    return with_suffix(path, ".meta.json")
+
+
+def memory_mappable(path: str) -> bool:
+    """
+    :param path: The path to the file.
+    :return: Whether the file is an uncompressed IPC file, which Polars can map.
+    """
+    return is_ipc(path) and artifact_codec(path) in (None, "uncompressed")
+
+
+def scan_artifact(path: str) -> pl.LazyFrame:
+    """
+    Scans an artifact, memory-mapping it if it is an uncompressed IPC file.
+    :param path: The path to the file.
+    :return: A Polars LazyFrame of the file.
+    """
+    if is_ipc(path):
+        return pl.scan_ipc(path, memory_map=memory_mappable(path))
+    return pl.scan_parquet(path)
+
+
+def read_artifact(path: str, columns: list[str] = None) -> pl.DataFrame:
+    """
+    Reads an artifact, memory-mapping it if it is an uncompressed IPC file.
+    :param path: The path to the file.
+    :param columns: The columns to read, defaults to all.
+    :return: A Polars DataFrame of the file.
+    """
+    if is_ipc(path):
+        return pl.read_ipc(path, columns=columns, memory_map=memory_mappable(path))
+    return pl.read_parquet(path, columns=columns)
+
+
+def write_artifact(
+    data: pl.DataFrame | pl.LazyFrame,
+    path: str,
+    metadata: dict[str, str] = None,
+    compression_level: int = None,
+    row_group_size: int = None,
+) -> None:
+    """
+    Writes (or streams, for a LazyFrame) an artifact in the format of its suffix.
+    :param data: The data to write.
+    :param path: The path to the file, ending in .arrow for an IPC file.
+    :param metadata: The key-value metadata of the file, e.g. from sort_metadata.
+    :param compression_level: The zstd level of a parquet file, defaults to Polars'.
+    :param row_group_size: The rows per row group of a parquet file, defaults to
+    Polars'.
+    :return: None, but makes the file (and the .meta.json file of an IPC file).
+    """
+    if not is_ipc(path):
+        metadata = {**(metadata or {}), CODEC_KEY: ARTIFACT_FORMATS["parquet"][1]}
+        kwargs = {"metadata": metadata}
+        if compression_level is not None:
+            kwargs["compression_level"] = compression_level
+        if row_group_size is not None:
+            kwargs["row_group_size"] = row_group_size
+        if isinstance(data, pl.LazyFrame):
+            data.sink_parquet(path, **kwargs)
+        else:
+            data.write_parquet(path, **kwargs)
+        return
+
+    # An .arrow file asked for while writing parquet is written uncompressed
+    codec = ARTIFACT_FORMATS["ipc_lz4" if artifact_format() == "ipc_lz4" else "ipc"][1]
+    if isinstance(data, pl.LazyFrame):
+        data.sink_ipc(path, compression=codec)
+    else:
+        data.write_ipc(path, compression=codec)
+    with open(metadata_file(path), "w") as file:
+        json.dump({**(metadata or {}), CODEC_KEY: codec}, file, indent=2)
+
+
+def artifact_metadata(path: str) -> dict[str, str]:
+    """
+    Reads the key-value metadata of an artifact.
+    :param path: The path to the file.
+    :return: The metadata, empty if the file has none.
+    """
+    if not is_ipc(path):
+        return pl.read_parquet_metadata(path)
+    if not os.path.isfile(metadata_file(path)):
+        return {}
+    with open(metadata_file(path)) as file:
+        return json.load(file)
+
+
+def artifact_codec(path: str) -> str | None:
+    """
+    :param path: The path to the file.
+    :return: The codec the artifact was written with, or None if not recorded.
+    """
+    return artifact_metadata(path).get(CODEC_KEY)
@@ -0,0 +1,365 @@
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+from . import profiling
+from .artifacts import ARTIFACT_FORMATS
+from .constants import data_dir
+
+# Benchmarks the whole preprocessing chain, from clean_rtm to split_data, on
+# synthetic data (see synthetic.py) at several scales. Every run is appended to
+# data/bench/results.jsonl and compared to the stored data/bench/baseline.json.
+# With --imports, the time to import the package (and the modules used by the
+# scoring processes) is benchmarked instead, as it is paid by every process.
+# With --formats, the chain is run once per artifact format (see artifacts.py), to
+# compare the time spent writing and reading the intermediate files, and their size.
+SCALES = {
+    "small": {"trains": 4, "days": 1},
+    "medium": {"trains": 20, "days": 3},
+    "large": {"trains": 60, "days": 7},
+}
+RESULTS_FILE = "bench/results.jsonl"
+BASELINE_FILE = "bench/baseline.json"
+IMPORT_MODULES = ["clean", "clean.inference", "clean.serve", "clean.pipeline"]
+HEAVY_MODULES = ["numpy", "polars", "tqdm", "keras"]
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stage_metrics(records: list[dict]) -> dict[str, dict]:
+    """
+    Collects the metrics of every stage from its profile record. Stages that run
+    more than once (e.g. split_data) are numbered in the order they finished.
+    :param records: The profile records of one benchmark run.
+    :return: The wall time, CPU time, peak memory and output rows per stage.
+    """
+    seen = Counter()
+    metrics = {}
+    for record in records:
+        stage = record["stage"].rsplit(".", maxsplit=1)[-1]
+        seen[stage] += 1
+        if seen[stage] > 1:
+            stage = f"{stage}#{seen[stage]}"
+        metrics[stage] = {
+            key: record.get(key)
+            for key in ["wall_s", "cpu_s", "peak_rss_mb", "rows_out"]
+        }
+    return metrics
+
+
+def artifact_bytes(directory: str) -> int:
+    """
+    :param directory: A data directory.
+    :return: The total size of the artifacts in it, not counting the base data.
+    """
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(directory)
+        for file in files
+        # Stage outputs are named <stage>.<fingerprint>.<suffix>
+        if file.count(".") >= 2 and file.endswith((".pq", ".arrow"))
+    )
+
+
+def baseline_key(result: dict) -> str:
+    """
+    :param result: A benchmark result, see run_benchmark.
+    :return: The key of its baseline, the scale (and the format if not parquet).
+    """
+    fmt = result.get("format", "parquet")
+    return result["scale"] if fmt == "parquet" else f"{result['scale']}/{fmt}"
+
+
+def run_benchmark(
+    scale: str, max_jobs: int = 1, seed: int = 42, artifact_format: str = "parquet"
+) -> dict:
+    """
+    Generates synthetic data at one scale in a temporary data directory and builds
+    all splits from it, timing every stage.
+    :param scale: The name of the scale, see SCALES.
+    :param max_jobs: The maximum number of stages running at the same time. The
+    default of 1 keeps the per-stage numbers from overlapping.
+    :param seed: The seed of the synthetic data.
+    :param artifact_format: The format of the intermediate files, see artifacts.py.
+    :return: The benchmark result.
+    """
+    from .clean_rtm import clean_rtm
+    from .pipeline import build_all_splits
+    from .synthetic import RAW_RTM_DIR, generate
+
+    if not profiling.PROFILE:
+        raise RuntimeError("Benchmarks need profiling, unset CLEAN_PROFILE=0")
+
+    old_env = {
+        key: os.environ.get(key)
+        for key in ["CLEAN_DATA_DIR", "CLEAN_PROFILE_LOG", "CLEAN_ARTIFACT_FORMAT"]
+    }
+    with tempfile.TemporaryDirectory(prefix=f"clean-bench-{scale}-") as tmp:
+        os.environ["CLEAN_DATA_DIR"] = tmp
+        os.environ["CLEAN_PROFILE_LOG"] = f"{tmp}/profile.jsonl"
+        os.environ["CLEAN_ARTIFACT_FORMAT"] = artifact_format
+        try:
+            start = time.perf_counter()
+            generate(**SCALES[scale], seed=seed)
+            generate_s = time.perf_counter() - start
+
+            start = time.perf_counter()
+            clean_rtm(f"rtm/{RAW_RTM_DIR}", cleaned_file="cleaned.pq")
+            build_all_splits(max_jobs=max_jobs)
+            total_s = time.perf_counter() - start
+            total_bytes = artifact_bytes(tmp)
+
+            with open(profiling.profile_log()) as file:
+                records = [json.loads(line) for line in file]
+        finally:
+            for key, value in old_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+    return {
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "scale": scale,
+        "format": artifact_format,
+        "max_jobs": max_jobs,
+        "generate_s": generate_s,
+        "total_s": total_s,
+        "artifact_mb": total_bytes / 1e6,
+        "stages": stage_metrics(records),
+    }
+
+
+def import_times(modules: list[str] = None, repeat: int = 5) -> dict[str, dict]:
+    """
+    Times importing modules, each in a new interpreter as imports are cached.
+    :param modules: The modules to import, defaults to IMPORT_MODULES.
+    :param repeat: The number of times to import a module, of which the fastest
+    counts.
+    :return: The import time in ms of every module, and the heavy dependencies
+    (HEAVY_MODULES) it imported.
+    """
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import {module}\n"
+        "ms = (time.perf_counter() - start) * 1000\n"
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(json.dumps({{'import_ms': ms, 'heavy': heavy}}))"
+    )
+    # The package is imported from the directory it is in, like `python -m clean.x`
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    times = {}
+    for module in modules or IMPORT_MODULES:
+        runs = [
+            json.loads(
+                subprocess.run(
+                    [sys.executable, "-c", script.format(module=module)],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                    cwd=package_dir,
+                ).stdout
+            )
+            for _ in range(repeat)
+        ]
+        times[module] = min(runs, key=lambda run: run["import_ms"])
+    return times
+
+
+def find_import_regressions(
+    result: dict, baseline: dict, tolerance: float = 0.25, min_ms: float = 20.0
+) -> list[str]:
+    """
+    Compares the import times to the baseline. Importing a heavy dependency that the
+    baseline didn't is a regression regardless of the time.
+    :param result: The import benchmark result, see import_times.
+    :param baseline: The baseline results.
+    :param tolerance: The relative slowdown that is allowed.
+    :param min_ms: The smallest slowdown that counts as a regression.
+    :return: A description of every regression.
+    """
+    base = baseline.get("imports", {})
+    regressions = []
+    for module, metrics in result.items():
+        if module not in base:
+            continue
+        new, old = metrics["import_ms"], base[module]["import_ms"]
+        if new > old * (1 + tolerance) and new - old > min_ms:
+            regressions.append(f"import {module}: {old:.0f}ms -> {new:.0f}ms")
+        if added := set(metrics["heavy"]) - set(base[module]["heavy"]):
+            regressions.append(f"import {module} now imports {', '.join(added)}")
+    return regressions
+
+
+def find_regressions(
+    result: dict,
+    baseline: dict,
+    tolerance: float = 0.25,
+    min_seconds: float = 1.0,
+    min_mb: float = 100.0,
+) -> list[str]:
+    """
+    Compares a benchmark result to the baseline of its scale and format. Small changes
+    are ignored, as they are mostly noise.
+    :param result: The benchmark result, see run_benchmark.
+    :param baseline: The baseline results, see baseline_key.
+    :param tolerance: The relative slowdown (or memory increase) that is allowed.
+    :param min_seconds: The smallest slowdown that counts as a regression.
+    :param min_mb: The smallest increase in peak memory that counts as a regression.
+    :return: A description of every regression.
+    """
+    base = baseline.get(baseline_key(result))
+    if base is None:
+        return []
+
+    regressions = []
+    checks = [("total", "total_s", result["total_s"], base["total_s"], min_seconds)]
+    for stage, metrics in result["stages"].items():
+        if stage not in base["stages"]:
+            continue
+        base_metrics = base["stages"][stage]
+        checks.append(
+            (stage, "wall_s", metrics["wall_s"], base_metrics["wall_s"], min_seconds)
+        )
+        checks.append(
+            (
+                stage,
+                "peak_rss_mb",
+                metrics["peak_rss_mb"],
+                base_metrics["peak_rss_mb"],
+                min_mb,
+            )
+        )
+
+    for stage, metric, new, old, min_diff in checks:
+        # Stages that ran concurrently have no peak memory, see profiling.py
+        if new is None or old is None:
+            continue
+        if new > old * (1 + tolerance) and new - old > min_diff:
+            regressions.append(
+                f"{baseline_key(result)} {stage} {metric}: {old:.2f} -> {new:.2f}"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing chain")
+    parser.add_argument("--scales", nargs="+", choices=SCALES, default=["small"])
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        choices=ARTIFACT_FORMATS,
+        default=["parquet"],
+        help="Run the chain once per format of the intermediate files",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--min-seconds", type=float, default=1.0)
+    parser.add_argument(
+        "--imports",
+        action="store_true",
+        help="Benchmark the import time of the package instead of the stages",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Store the results as the new baseline instead of comparing",
+    )
+    args = parser.parse_args()
+
+    # Resolved before the benchmarks move the data directory
+    results_file = data_dir(RESULTS_FILE)
+    baseline_file = data_dir(BASELINE_FILE)
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+
+    baseline = {}
+    if os.path.isfile(baseline_file):
+        with open(baseline_file) as file:
+            baseline = json.load(file)
+
+    regressions = []
+    if args.imports:
+        times = import_times()
+        result = {
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "commit": _commit(),
+            "imports": times,
+        }
+        with open(results_file, "a") as file:
+            file.write(json.dumps(result) + "\n")
+        for module, metrics in times.items():
+            heavy = ", ".join(metrics["heavy"]) or "-"
+            print(f"  {module:<24} {metrics['import_ms']:>8.1f}ms  {heavy}")
+        if args.update_baseline:
+            baseline["imports"] = times
+        else:
+            regressions += find_import_regressions(times, baseline, args.tolerance)
+    results = []
+    scales = [] if args.imports else args.scales
+    for scale, fmt in itertools.product(scales, args.formats):
+        result = run_benchmark(scale, args.jobs, args.seed, fmt)
+        results.append(result)
+        with open(results_file, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+        print(
+            f"{baseline_key(result)}: {result['total_s']:.2f}s,"
+            f" {result['artifact_mb']:.0f} MB of artifacts"
+        )
+        for stage, metrics in result["stages"].items():
+            peak = metrics["peak_rss_mb"]
+            print(
+                f"  {stage:<24} {metrics['wall_s']:>8.2f}s"
+                f" {'-' if peak is None else f'{peak:.0f}':>8} MB"
+                f"  {metrics['rows_out']} rows"
+            )
+
+        if args.update_baseline:
+            baseline[baseline_key(result)] = result
+        else:
+            regressions += find_regressions(
+                result, baseline, args.tolerance, args.min_seconds
+            )
+
+    if len(args.formats) > 1:
+        for scale in scales:
+            runs = [result for result in results if result["scale"] == scale]
+            base = runs[0]["total_s"]
+            print(f"{scale} by format, relative to {runs[0]['format']}:")
+            for result in runs:
+                print(
+                    f"  {result['format']:<10} {result['total_s']:>8.2f}s"
+                    f" {result['total_s'] / base:>6.2f}x"
+                    f" {result['artifact_mb']:>8.0f} MB"
+                )
+
+    if args.update_baseline:
+        with open(baseline_file, "w") as file:
+            json.dump(baseline, file, indent=2)
+        print(f"Updated the baseline in {baseline_file}")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
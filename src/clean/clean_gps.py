@@ -1,8 +1,11 @@
 import polars as pl
 
+from .artifacts import write_artifact
 from .constants import data_dir
+from .profiling import profiled, record_plan
 
 
+@profiled(inputs={"filename": "mtps"}, outputs={"cleaned_file": "mtps"})
 def clean_gps(filename: str, cleaned_file: str = None) -> None:
     """
     A cleaning function that takes a GPS data file and select the usable columns for
@@ -13,7 +16,7 @@ def clean_gps(filename: str, cleaned_file: str = None) -> None:
     """
     if cleaned_file is None:
         cleaned_file = "gps.pq"
-    with open(data_dir(f"mtps/{filename}")) as file:
+    with open(data_dir(f"mtps/{filename}"), "rb") as file:
         # The sherlock format files are different from the GPS_filter files,
         # and must be parsed differently
         is_sherlock = file.read(8) == b"Sherlock"
@@ -30,13 +33,20 @@ def clean_gps(filename: str, cleaned_file: str = None) -> None:
             .select(
                 train_nr=pl.col("Treinnr").cast(pl.UInt32),
                 mat_nr=pl.col("Matnr").cast(pl.UInt32),
-                time=pl.col("Tijdstip").str.to_datetime("%F %T%.3f"),
+                time=pl.col("Tijdstip")
+                .str.to_datetime("%F %T%.3f")
+                .dt.replace_time_zone(
+                    "Europe/Amsterdam", ambiguous="earliest", non_existent="null"
+                ),
                 lat=pl.col("GPS_latitude").str.replace(",", ".").cast(pl.Float64),
                 lon=pl.col("GPS_longitude").str.replace(",", ".").cast(pl.Float64),
             )
             # Many coordinates appear invalid, we throw those away
             .filter(pl.col("lat").is_between(50, 60) & pl.col("lon").is_between(3, 7))
-            .sink_parquet(data_dir(f"mtps/{cleaned_file}"))
+            # Times in the hour skipped when the clocks go forward don't exist
+            .drop_nulls("time")
+            .pipe(record_plan)
+            .pipe(write_artifact, data_dir(f"mtps/{cleaned_file}"))
         )
     else:
         (
@@ -44,11 +54,19 @@ def clean_gps(filename: str, cleaned_file: str = None) -> None:
             .select(
                 train_nr=pl.col("Treinnummer").cast(pl.UInt32),
                 mat_nr=pl.col("Mat-nummer").cast(pl.UInt32),
-                time=pl.col("Tijdstip").str.to_datetime("%F %T"),
+                # Local time, like the RTM and SAS data
+                time=pl.col("Tijdstip")
+                .str.to_datetime("%F %T")
+                .dt.replace_time_zone(
+                    "Europe/Amsterdam", ambiguous="earliest", non_existent="null"
+                ),
                 lat=pl.col("Latitude").str.replace(",", ".").cast(pl.Float64),
                 lon=pl.col("Longitude").str.replace(",", ".").cast(pl.Float64),
             )
-            .sink_parquet(data_dir(f"mtps/{cleaned_file}"))
+            # Times in the hour skipped when the clocks go forward don't exist
+            .drop_nulls("time")
+            .pipe(record_plan)
+            .pipe(write_artifact, data_dir(f"mtps/{cleaned_file}"))
         )
 
 
@@ -1,6 +1,7 @@
 import polars as pl
 
 from .constants import data_dir, with_suffix
+from .profiling import profiled, record_plan
 
 measurement_names = {
     "lijnspanning 10 4 v bit 3a2 mbvk1": "volt_1",
@@ -76,23 +77,15 @@ def voltage_calc(num: int) -> pl.Expr:
     return pl.when(val.lt(100)).then(0).when(val.is_between(1_000, 2_200)).then(val)
 
 
-def clean_rtm(dir_or_file: str, cleaned_file=None, is_dir=True) -> None:
+def clean_measurements(df: pl.LazyFrame) -> pl.LazyFrame:
     """
-    Cleans the raw RTM data for later linking and use. Can be run on a directory, in
-    which case this directory should contain several parquet files.
-    :param dir_or_file: The name or path to the raw data.
-    :param cleaned_file: The name of the new file to be made.
-    :param is_dir: Whether the given dir_or_file is a directory or file name.
-    :return: None, but makes a new file.
+    Extracts the time, position and voltages from raw RTM messages, dropping the
+    messages without a valid position or voltages. Also used by stream.py.
+    :param df: The raw RTM messages.
+    :return: The cleaned RTM measurements.
     """
-    if cleaned_file is None:
-        cleaned_file = with_suffix(f"rtm/{dir_or_file}", "_cleaned.pq")
-    if is_dir:
-        dir_or_file = f"{dir_or_file}/*.parquet"
-    (
-        pl.scan_parquet(data_dir(dir_or_file))
-        .lazy()
-        .select(
+    return (
+        df.select(
             *[list_find(m, n) for m, n in measurement_names.items()],
             time=pl.col("datetime")
             .struct.field("local")
@@ -109,6 +102,28 @@ def clean_rtm(dir_or_file: str, cleaned_file=None, is_dir=True) -> None:
         )
         .filter(pl.col("lat").ne(0) & pl.col("lon").ne(0))
         .drop_nulls()
+    )
+
+
+@profiled(inputs={"dir_or_file": ""}, outputs={"cleaned_file": "rtm"})
+def clean_rtm(dir_or_file: str, cleaned_file=None, is_dir=True) -> None:
+    """
+    Cleans the raw RTM data for later linking and use. Can be run on a directory, in
+    which case this directory should contain several parquet files.
+    :param dir_or_file: The name or path to the raw data.
+    :param cleaned_file: The name of the new file to be made.
+    :param is_dir: Whether the given dir_or_file is a directory or file name.
+    :return: None, but makes a new file.
+    """
+    if cleaned_file is None:
+        cleaned_file = with_suffix(f"rtm/{dir_or_file}", "_cleaned.pq")
+    if is_dir:
+        dir_or_file = f"{dir_or_file}/*.parquet"
+    (
+        pl.scan_parquet(data_dir(dir_or_file))
+        .lazy()
+        .pipe(clean_measurements)
+        .pipe(record_plan)
         .sink_parquet(data_dir(f"rtm/{cleaned_file}"))
     )
 
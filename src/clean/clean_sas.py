@@ -1,6 +1,9 @@
 import polars as pl
 
+from .artifacts import write_artifact
 from .constants import SENSOR_POSITIONS, data_dir
+from .profiling import profiled, record_plan
+from .sortedness import sort_metadata
 
 
 def add_sensor_num(sensor: tuple, num: int) -> pl.Expr:
@@ -19,6 +22,7 @@ def add_sensor_num(sensor: tuple, num: int) -> pl.Expr:
     )
 
 
+@profiled(inputs={"filename": "sas"}, outputs={"cleaned_file": "sas"})
 def clean_sas(filename: str, cleaned_file: str = None) -> None:
     """
     Selects only the necessary columns from the SAS data for model training.
@@ -48,7 +52,13 @@ def clean_sas(filename: str, cleaned_file: str = None) -> None:
         .drop([f"s_dist_{num+1}" for num in range(len(SENSOR_POSITIONS))])
         .drop_nulls()
         .sort("time")
-        .sink_parquet(data_dir(f"sas/{cleaned_file}"), compression_level=10)
+        .pipe(record_plan)
+        .pipe(
+            write_artifact,
+            data_dir(f"sas/{cleaned_file}"),
+            compression_level=10,
+            metadata=sort_metadata("time"),
+        )
     )
 
 
@@ -23,16 +23,20 @@ LON_TO_KM = 87_578
 def data_dir(file: str) -> str:
     """
     Finds the correct path to a specific file in the data directory and returns that
-    path for an easy way to load files.
+    path for an easy way to load files. The data directory can be moved elsewhere
+    (e.g. for benchmarks on synthetic data) by setting CLEAN_DATA_DIR.
     :param file: The name of the file of which the location has to be found
     :return: A string containing the path to the data file.
     """
     import os
 
-    cwd = os.getcwd()
-    src_pos = cwd.rfind("/src" if os.name != "nt" else r"\src")
-    project_root = cwd if src_pos == -1 else cwd[:src_pos]
-    path = f"{project_root}/data/{file}"
+    if os.environ.get("CLEAN_DATA_DIR"):
+        path = f"{os.environ['CLEAN_DATA_DIR']}/{file}"
+    else:
+        cwd = os.getcwd()
+        src_pos = cwd.rfind("/src" if os.name != "nt" else r"\src")
+        project_root = cwd if src_pos == -1 else cwd[:src_pos]
+        path = f"{project_root}/data/{file}"
 
     if os.name == "nt":
         path = path.replace("/", "\\")
@@ -1,29 +1,55 @@
+import os
+from collections.abc import Callable, Iterator, Mapping
+
 import numpy as np
 import polars as pl
 
+from .artifacts import read_artifact, scan_artifact
 from .constants import data_dir, with_suffix
+from .profiling import profiled
 
 SHUFFLE_SEED = 42
+SPLIT_PARTS = ["i_train", "i_tune", "i_test", "t_train", "t_tune", "t_test"]
+# The fractions of the data that go in the train and tune sets, the rest is test
+SPLIT_FRACTIONS = (0.6, 0.3)
+
+# Splits are stored either as one compressed .npz archive ("npz"), as a directory
+# with an uncompressed .npy file per split ("npy"), which is memory-mapped on load,
+# or as only the shuffled row order of the sample file ("index"), from which the
+# splits are gathered when used. Memory-mapping makes loading instant, and lets
+# processes training on the same splits share their pages. Index splits don't store
+# another copy of the data for every feature set. Can be set with CLEAN_SPLIT_FORMAT.
+SPLIT_FORMAT = os.environ.get("CLEAN_SPLIT_FORMAT", "npy")
+SPLIT_SUFFIXES = {"npz": ".npz", "npy": ".splits", "index": ".index"}
 
+# The number of rows read at a time when streaming splits, the default parquet row
+# group size of Polars
+STREAM_BATCH_ROWS = 512**2
 
+
+@profiled(inputs={"file_name": "samples"}, outputs={"split_file": "samples"})
 def split_data(
     file_name: str,
-    input_columns: list[pl.type_aliases.IntoExprColumn] = None,
+    input_columns: list[str | pl.Expr] = None,
     target_column: str = "sensor_voltage",
     split_file: str = None,
+    streaming: bool = False,
 ) -> None:
     # noinspection PyShadowingNames
     """
     Splits the data file into train, tune, and test sets.
-    :param split_file: Output file for splits
+    :param split_file: Output file for splits, either a .npz archive, an .index file
+    or a directory for separate .npy files (see SPLIT_FORMAT)
     :param file_name: The name of the file to be split
     :param input_columns: The columns to be kept as inputs
     :param target_column: The name of the column containing the target data
+    :param streaming: Whether to stream the splits into .npy files instead of reading
+    the whole file, see split_data_streaming. Needs a .npy directory as split_file.
     :return: None, but makes three separate numpy arrays.
 
     Later usage:
 
-    >>> splits = np.load("simple_joined_splits.npz")  # doctest: +SKIP
+    >>> splits = load_splits("simple_joined_splits.npz")  # doctest: +SKIP
     >>> i_train, i_tune, i_test, t_train, t_tune, t_test = [  # doctest: +SKIP
     ...     splits[part]
     ...     for part in ["i_train", "i_tune", "i_test", "t_train", "t_tune", "t_test"]
@@ -34,9 +60,15 @@ def split_data(
         input_columns = ["volt_1", "volt_2", "volt_7", "distance_to_sensor"]
     if split_file is None:
         split_file = with_suffix(file_name, "_splits.npz")
+    if split_file.endswith(".index"):
+        split_indices(file_name, input_columns, target_column, split_file)
+        return
+    if streaming:
+        split_data_streaming(file_name, input_columns, target_column, split_file)
+        return
 
     df: pl.DataFrame = (
-        pl.read_parquet(data_dir(f"samples/{file_name}"))
+        read_artifact(data_dir(f"samples/{file_name}"))
         .sample(fraction=1, shuffle=True, seed=SHUFFLE_SEED)
         .select(input_columns, target=target_column)
     )
@@ -44,17 +76,311 @@ def split_data(
     arr_target = df.drop_in_place("target").to_numpy()
     arr_input = df.to_numpy()
 
-    splits = [int(len(df) * 0.6), int(len(df) * 0.9)]
+    splits = split_bounds(len(df))
 
     i_train, i_tune, i_test = np.split(arr_input, splits)
     t_train, t_tune, t_test = np.split(arr_target, splits)
 
-    np.savez_compressed(
-        data_dir(f"samples/{split_file}"),
-        i_train=i_train,
-        i_tune=i_tune,
-        i_test=i_test,
-        t_train=t_train,
-        t_tune=t_tune,
-        t_test=t_test,
+    parts = dict(
+        zip(
+            SPLIT_PARTS, [i_train, i_tune, i_test, t_train, t_tune, t_test], strict=True
+        )
+    )
+    if split_file.endswith(".npz"):
+        np.savez_compressed(data_dir(f"samples/{split_file}"), **parts)
+    else:
+        os.makedirs(data_dir(f"samples/{split_file}"), exist_ok=True)
+        for part, arr in parts.items():
+            np.save(data_dir(f"samples/{split_file}/{part}.npy"), arr)
+
+
+def split_bounds(rows: int) -> list[int]:
+    """
+    :param rows: The number of rows in the data.
+    :return: The rows at which the tune and test sets start.
+    """
+    return [int(rows * SPLIT_FRACTIONS[0]), int(rows * sum(SPLIT_FRACTIONS))]
+
+
+def assign_splits(rows: np.ndarray) -> np.ndarray:
+    """
+    Assigns rows to a split with a seeded hash (splitmix64) of their row number, so
+    that the assignment is reproducible without shuffling the whole file.
+    :param rows: The row numbers.
+    :return: The split of every row: 0 for train, 1 for tune and 2 for test.
+    """
+    x = rows.astype(np.uint64) + np.uint64(SHUFFLE_SEED * 0x9E3779B97F4A7C15 % 2**64)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+    return np.searchsorted(np.cumsum(SPLIT_FRACTIONS), x / 2**64, side="right")
+
+
+def split_data_streaming(
+    file_name: str,
+    input_columns: list[str | pl.Expr],
+    target_column: str,
+    split_dir: str,
+    batch_rows: int = STREAM_BATCH_ROWS,
+) -> None:
+    """
+    Splits the data file into train, tune and test sets like split_data, but reads
+    the file in batches and writes every batch into memory-mapped .npy files, so
+    memory use doesn't grow with the size of the file. Rows are assigned with
+    assign_splits, and keep the order of the file within a split.
+    Integer inputs are stored as floats, so that missing values can be NaN.
+    :param file_name: The name of the file to be split.
+    :param input_columns: The columns to be kept as inputs.
+    :param target_column: The name of the column containing the target data.
+    :param split_dir: Output directory for the .npy files.
+    :param batch_rows: The number of rows read at a time.
+    :return: None, but makes six .npy files.
+    """
+    if split_dir.endswith((".npz", ".index")):
+        raise ValueError(
+            f"Can only stream splits into a .npy directory, not {split_dir}"
+        )
+
+    source = scan_artifact(data_dir(f"samples/{file_name}")).select(
+        input_columns, target=target_column
     )
+    rows = source.select(pl.len()).collect().item()
+    batches = range(0, rows, batch_rows)
+
+    # A first pass over only the row numbers, to size the output files
+    counts = sum(
+        np.bincount(
+            assign_splits(np.arange(start, min(start + batch_rows, rows))), minlength=3
+        )
+        for start in batches
+    )
+    empty = source.head(0).collect()
+    target_dtype = np.result_type(empty["target"].to_numpy().dtype, np.float32)
+    input_dtype = np.result_type(empty.drop("target").to_numpy().dtype, np.float32)
+
+    os.makedirs(data_dir(f"samples/{split_dir}"), exist_ok=True)
+    outputs = []
+    for split, count in zip(["train", "tune", "test"], counts, strict=True):
+        outputs.append(
+            (
+                np.lib.format.open_memmap(
+                    data_dir(f"samples/{split_dir}/i_{split}.npy"),
+                    mode="w+",
+                    dtype=input_dtype,
+                    shape=(int(count), empty.width - 1),
+                ),
+                np.lib.format.open_memmap(
+                    data_dir(f"samples/{split_dir}/t_{split}.npy"),
+                    mode="w+",
+                    dtype=target_dtype,
+                    shape=(int(count),),
+                ),
+            )
+        )
+
+    written = [0, 0, 0]
+    for start in batches:
+        batch = source.slice(start, batch_rows).collect()
+        splits = assign_splits(np.arange(start, start + len(batch)))
+        targets = batch.drop_in_place("target").to_numpy()
+        inputs = batch.to_numpy()
+        for split, (i_out, t_out) in enumerate(outputs):
+            mask = splits == split
+            end = written[split] + mask.sum()
+            i_out[written[split] : end] = inputs[mask]
+            t_out[written[split] : end] = targets[mask]
+            written[split] = end
+
+    for i_out, t_out in outputs:
+        i_out.flush()
+        t_out.flush()
+
+
+def _shuffled_chunks(rows: np.ndarray, rng: np.random.Generator) -> list[np.ndarray]:
+    """
+    :param rows: Sorted rows of the sample file.
+    :param rng: The random generator of the shuffle.
+    :return: The rows of every chunk of STREAM_BATCH_ROWS rows of the file, in
+    shuffled order, each shuffled.
+    """
+    chunks = np.split(rows, np.flatnonzero(np.diff(rows // STREAM_BATCH_ROWS)) + 1)
+    return [rng.permutation(chunks[i]) for i in rng.permutation(len(chunks))]
+
+
+def split_indices(
+    file_name: str,
+    input_columns: list[str | pl.Expr],
+    target_column: str,
+    index_file: str,
+) -> None:
+    """
+    Stores the splits of a sample file as only a shuffled order of its rows, see
+    IndexedSplits. The input columns are resolved to names, so the index file is
+    enough to gather the splits later.
+    :param file_name: The name of the file to be split.
+    :param input_columns: The columns to be kept as inputs.
+    :param target_column: The name of the column containing the target data.
+    :param index_file: Output file for the row order.
+    :return: None, but makes a new file.
+    """
+    source = scan_artifact(data_dir(f"samples/{file_name}"))
+    rows = source.select(pl.len()).collect().item()
+    rng = np.random.default_rng(SHUFFLE_SEED)
+    bounds = split_bounds(rows)
+    # The rows of every split are picked at random, but ordered by chunks of the file
+    # (in shuffled order, with the rows of a chunk shuffled), so consecutive rows of
+    # a split are gathered from one range of the file
+    order = np.concatenate(
+        [
+            chunk
+            for split in np.split(rng.permutation(rows), bounds)
+            for chunk in _shuffled_chunks(np.sort(split), rng)
+        ]
+    )
+
+    # Opened as a file, as np.savez would add .npz to the name
+    with open(data_dir(f"samples/{index_file}"), "wb") as file:
+        np.savez(
+            file,
+            order=order.astype(np.min_scalar_type(max(rows - 1, 0))),
+            bounds=np.array(bounds),
+            source=np.array(file_name),
+            input_columns=np.array(
+                source.select(input_columns).collect_schema().names()
+            ),
+            target_column=np.array(target_column),
+        )
+
+
+class IndexedSplits(Mapping):
+    """
+    The splits of a sample file, stored as a shuffled order of its rows. The rows of
+    a split (or of one batch of it) are gathered from the sample file when used, so
+    the input and target columns of the whole file are never read into memory.
+    The rows of a split are in chunks of the file (see split_indices), so a range of
+    them is gathered from a few row groups.
+    """
+
+    def __init__(self, index_file: str):
+        with np.load(data_dir(f"samples/{index_file}")) as index:
+            self.order = index["order"]
+            self.bounds = index["bounds"].tolist()
+            self.source = str(index["source"])
+            self.input_columns = index["input_columns"].tolist()
+            self.target_column = str(index["target_column"])
+        self.path = data_dir(f"samples/{self.source}")
+
+    def gather(self, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Reads some rows of the sample file. The rows are read in file order, from
+        every range of rows without a gap of more than a chunk (only the row groups
+        of those ranges, or the pages of a memory-mapped IPC file), and then put in
+        the given order.
+        :param rows: The rows to read.
+        :return: The inputs and targets of the rows.
+        """
+        ordered = np.sort(rows)
+        source = scan_artifact(self.path).select(
+            *self.input_columns, self.target_column
+        )
+        ranges = np.split(
+            ordered, np.flatnonzero(np.diff(ordered) > STREAM_BATCH_ROWS) + 1
+        )
+        df = pl.concat(
+            [
+                source.slice(int(part[0]), int(part[-1] - part[0]) + 1)
+                .with_row_index("_row", offset=int(part[0]))
+                .filter(pl.col("_row").is_in(pl.Series(part)))
+                .drop("_row")
+                for part in ranges
+                if len(part)
+            ]
+            or [source.clear()]
+        ).collect(engine="streaming")
+        # The rows of the permutation are unique, so every row is found once
+        df = df[np.searchsorted(ordered, rows)]
+        targets = df.drop_in_place(self.target_column).to_numpy()
+        return df.to_numpy(), targets
+
+    def rows(self, split: str) -> np.ndarray:
+        """
+        :param split: The split, one of 'train', 'tune' or 'test'.
+        :return: The rows of the sample file in the split, in shuffled order.
+        """
+        train, tune, test = np.split(self.order, self.bounds)
+        return {"train": train, "tune": tune, "test": test}[split]
+
+    def batches(
+        self, split: str, batch_size: int = 1024
+    ) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """
+        Gathers a split in batches, reading about a chunk of the file at a time (see
+        split_indices), so every row group is read about once.
+        :param split: The split, one of 'train', 'tune' or 'test'.
+        :param batch_size: The number of rows per batch.
+        :return: An iterator of input and target batches.
+        """
+        rows = self.rows(split)
+        block_rows = max(1, STREAM_BATCH_ROWS // batch_size) * batch_size
+        for block in range(0, len(rows), block_rows):
+            inputs, targets = self.gather(rows[block : block + block_rows])
+            for start in range(0, len(targets), batch_size):
+                yield (
+                    inputs[start : start + batch_size],
+                    targets[start : start + batch_size],
+                )
+
+    def __getitem__(self, part: str) -> np.ndarray:
+        if part not in SPLIT_PARTS:
+            raise KeyError(part)
+        kind, split = part.split("_")
+        inputs, targets = self.gather(self.rows(split))
+        return inputs if kind == "i" else targets
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(SPLIT_PARTS)
+
+    def __len__(self) -> int:
+        return len(SPLIT_PARTS)
+
+
+class TransformedSplits(Mapping):
+    """
+    Splits with a transform (e.g. svd_kernels.KernelTransform) applied to the inputs
+    when they are accessed, so the transformed inputs are never stored.
+    """
+
+    def __init__(
+        self,
+        splits: Mapping[str, np.ndarray],
+        transform: Callable[[np.ndarray], np.ndarray],
+    ):
+        self.splits = splits
+        self.transform = transform
+
+    def __getitem__(self, part: str) -> np.ndarray:
+        if part.startswith("i_"):
+            return self.transform(self.splits[part])
+        return self.splits[part]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.splits)
+
+    def __len__(self) -> int:
+        return len(self.splits)
+
+
+def load_splits(split_file: str) -> Mapping[str, np.ndarray]:
+    """
+    Loads the splits made by split_data, from any of the formats.
+    :param split_file: The name of the .npz archive, .index file or .npy directory.
+    :return: A mapping from the split names (see SPLIT_PARTS) to the arrays, which
+    are memory-mapped (read-only) for .npy directories, and gathered on access for
+    .index files.
+    """
+    path = data_dir(f"samples/{split_file}")
+    if split_file.endswith(".npz"):
+        return np.load(path)
+    if split_file.endswith(".index"):
+        return IndexedSplits(split_file)
+    return {part: np.load(f"{path}/{part}.npy", mmap_mode="r") for part in SPLIT_PARTS}
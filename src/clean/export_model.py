@@ -0,0 +1,173 @@
+import json
+
+import keras
+import numpy as np
+
+from .constants import with_suffix
+from .inference import NumpyModel
+
+# Exports the saved .keras models to the plain .npz files that inference.py runs
+# without Keras. Only the layers of the models in the notebooks are supported: Dense,
+# LSTM, Masking, Normalization and the custom InputNorm. Dropout and Input layers do
+# nothing when predicting, so they are left out.
+# Keras is only needed for this module, so `import clean` doesn't import it.
+
+
+@keras.saving.register_keras_serializable()
+class InputNorm(keras.layers.Layer):
+    """
+    The input normalisation layer of the space models (see space_model.ipynb),
+    registered under the same name so their saved models can be loaded outside
+    the notebooks. Missing (NaN) inputs become 0.
+    """
+
+    def __init__(self, n_inputs=4, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mean = self.add_weight(
+            shape=(1, 1, n_inputs),
+            initializer="zero",
+            trainable=False,
+        )
+        self.std = self.add_weight(
+            shape=(1, 1, n_inputs),
+            initializer="zero",
+            trainable=False,
+        )
+
+    def adapt(self, data: np.ndarray):
+        self.mean.assign(np.nanmean(data, axis=(0, 1)).reshape((1, 1, -1)))
+        self.std.assign(np.nanstd(data, axis=(0, 1)).reshape((1, 1, -1)))
+
+    def call(self, inp, **kwargs):
+        return keras.ops.where(
+            keras.ops.isnan(inp),
+            0,
+            keras.ops.divide(keras.ops.subtract(inp, self.mean), self.std),
+        )
+
+
+def _numpy(value) -> np.ndarray:
+    return np.asarray(keras.ops.convert_to_numpy(value))
+
+
+def export_layer(
+    layer: keras.layers.Layer,
+) -> tuple[dict, dict[str, np.ndarray]] | None:
+    """
+    Converts a layer to the config and weights used by inference.py.
+    :param layer: The layer.
+    :return: The config and weights of the layer, or None if it does nothing when
+    predicting.
+    """
+    config = layer.get_config()
+    match layer:
+        case keras.layers.InputLayer() | keras.layers.Dropout():
+            return None
+        case InputNorm():
+            return {"type": "input_norm"}, {
+                "mean": _numpy(layer.mean),
+                "std": _numpy(layer.std),
+            }
+        case keras.layers.Normalization():
+            # Like keras, the standard deviation is at least epsilon
+            std = np.maximum(np.sqrt(_numpy(layer.variance)), keras.config.epsilon())
+            return {"type": "normalization", "invert": config["invert"]}, {
+                "mean": _numpy(layer.mean),
+                "std": std.astype(layer.compute_dtype),
+            }
+        case keras.layers.Masking():
+            return {"type": "masking", "mask_value": config["mask_value"]}, {}
+        case keras.layers.Dense():
+            weights = {"kernel": _numpy(layer.kernel)}
+            if layer.use_bias:
+                weights["bias"] = _numpy(layer.bias)
+            return {"type": "dense", "activation": config["activation"]}, weights
+        case keras.layers.LSTM():
+            if config["go_backwards"] or config["stateful"]:
+                raise ValueError(f"Can't export the backwards or stateful {layer.name}")
+            cell = layer.cell
+            weights = {
+                "kernel": _numpy(cell.kernel),
+                "recurrent_kernel": _numpy(cell.recurrent_kernel),
+            }
+            if cell.use_bias:
+                weights["bias"] = _numpy(cell.bias)
+            return {
+                "type": "lstm",
+                "units": config["units"],
+                "activation": config["activation"],
+                "recurrent_activation": config["recurrent_activation"],
+                "return_sequences": config["return_sequences"],
+            }, weights
+    raise ValueError(f"Can't export {layer.name} of type {type(layer).__name__}")
+
+
+def export_model(model: keras.Model | str, file: str = None) -> str:
+    """
+    Exports a sequential model for inference.NumpyModel.
+    :param model: The model, or the path of its .keras file.
+    :param file: The path of the exported .npz file, by default the path of the
+    .keras file with the .npz suffix.
+    :return: The path of the exported file.
+    """
+    if isinstance(model, str):
+        if file is None:
+            file = with_suffix(model, ".npz")
+        model = keras.models.load_model(model)
+    elif file is None:
+        raise ValueError("The file to export to is required for an unsaved model")
+
+    configs, arrays = [], {}
+    for layer in model.layers:
+        exported = export_layer(layer)
+        if exported is None:
+            continue
+        config, weights = exported
+        for name, weight in weights.items():
+            arrays[f"{len(configs)}.{name}"] = weight
+        configs.append({"name": layer.name, **config})
+
+    with open(file, "wb") as f:
+        np.savez(f, layers=np.array(json.dumps(configs)), **arrays)
+    return file
+
+
+def max_difference(
+    model: keras.Model, exported: NumpyModel, inputs: np.ndarray
+) -> float:
+    """
+    Compares the predictions of a model and its export.
+    :param model: The keras model.
+    :param exported: The exported model.
+    :param inputs: The inputs to predict.
+    :return: The largest absolute difference between the predictions.
+    """
+    expected = model.predict(inputs, verbose=0)
+    return float(np.max(np.abs(expected - exported.predict(inputs))))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Export saved .keras models for inference with NumPy"
+    )
+    parser.add_argument("models", nargs="+", help="The .keras files, e.g. in models/")
+    parser.add_argument(
+        "--check", type=int, default=1_000, help="Random rows to compare, 0 to skip"
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    for model_file in args.models:
+        keras_model = keras.models.load_model(model_file)
+        exported_file = export_model(keras_model, with_suffix(model_file, ".npz"))
+        print(f"Exported {model_file} to {exported_file}")
+        if args.check:
+            shape = (args.check, *keras_model.input_shape[1:])
+            difference = max_difference(
+                keras_model,
+                NumpyModel.load(exported_file),
+                rng.standard_normal(shape, dtype=np.float32),
+            )
+            print(f"Largest difference on {args.check} random inputs: {difference:.3g}")
@@ -0,0 +1,154 @@
+import json
+from collections.abc import Callable
+
+import numpy as np
+
+# Runs the models exported by export_model.py with NumPy alone, so scoring a request
+# doesn't need Keras, JAX or a JIT warmup. The models are small (a few dense layers,
+# or a single LSTM layer) so a whole batch is done with one matrix product per layer,
+# and per time step for the LSTM.
+# An exported model is an .npz file with a 'layers' entry holding the JSON list of
+# layer configs, and the weights of layer i stored as '{i}.{weight name}'.
+
+Layer = Callable[[dict, dict[str, np.ndarray], np.ndarray, np.ndarray], tuple]
+
+
+def _sigmoid(x: np.ndarray) -> np.ndarray:
+    return 0.5 * (np.tanh(0.5 * x) + 1)
+
+
+ACTIVATIONS: dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "tanh": np.tanh,
+    "sigmoid": _sigmoid,
+}
+
+
+def _input_norm(config, weights, x, mask):
+    # The InputNorm layer of the space models, which turns missing values into 0
+    normed = (x - weights["mean"]) / weights["std"]
+    return np.where(np.isnan(x), 0, normed), mask
+
+
+def _normalization(config, weights, x, mask):
+    if config["invert"]:
+        return weights["mean"] + x * weights["std"], mask
+    return (x - weights["mean"]) / weights["std"], mask
+
+
+def _masking(config, weights, x, mask):
+    # Time steps with only the mask value are skipped by the following LSTM layer
+    mask = np.any(x != config["mask_value"], axis=-1)
+    return x * mask[..., None], mask
+
+
+def _dense(config, weights, x, mask):
+    out = x @ weights["kernel"]
+    if "bias" in weights:
+        out += weights["bias"]
+    return ACTIVATIONS[config["activation"]](out), mask
+
+
+def _lstm(config, weights, x, mask):
+    activation = ACTIVATIONS[config["activation"]]
+    recurrent_activation = ACTIVATIONS[config["recurrent_activation"]]
+    units = config["units"]
+    batch, steps, _ = x.shape
+
+    # The input part of every gate for all time steps at once
+    gates_in = x @ weights["kernel"]
+    if "bias" in weights:
+        gates_in += weights["bias"]
+
+    h = np.zeros((batch, units), dtype=x.dtype)
+    c = np.zeros((batch, units), dtype=x.dtype)
+    outputs = []
+    for step in range(steps):
+        gates = gates_in[:, step] + h @ weights["recurrent_kernel"]
+        # Keras orders the gates as input, forget, cell, output
+        i = recurrent_activation(gates[:, :units])
+        f = recurrent_activation(gates[:, units : 2 * units])
+        g = activation(gates[:, 2 * units : 3 * units])
+        o = recurrent_activation(gates[:, 3 * units :])
+        new_c = f * c + i * g
+        new_h = o * activation(new_c)
+        if mask is not None:
+            # Masked time steps keep the previous state
+            keep = mask[:, step, None]
+            new_c = np.where(keep, new_c, c)
+            new_h = np.where(keep, new_h, h)
+        h, c = new_h, new_c
+        outputs.append(h)
+
+    if config["return_sequences"]:
+        return np.stack(outputs, axis=1), mask
+    return h, None
+
+
+LAYERS: dict[str, Layer] = {
+    "input_norm": _input_norm,
+    "normalization": _normalization,
+    "masking": _masking,
+    "dense": _dense,
+    "lstm": _lstm,
+}
+
+
+class NumpyModel:
+    """
+    A model exported by export_model.py, predicting with NumPy only.
+    """
+
+    def __init__(self, layers: list[tuple[dict, dict[str, np.ndarray]]]):
+        """
+        :param layers: The config and weights of every layer, in order.
+        """
+        for config, _ in layers:
+            if config["type"] not in LAYERS:
+                raise ValueError(f"Unsupported layer type {config['type']!r}")
+        self.layers = layers
+        self.dtype = next(
+            (w.dtype for _, weights in layers for w in weights.values()),
+            np.dtype(np.float32),
+        )
+
+    @classmethod
+    def load(cls, file: str) -> "NumpyModel":
+        """
+        Loads an exported model.
+        :param file: The path to the .npz file made by export_model.py.
+        :return: The model.
+        """
+        with np.load(file, allow_pickle=False) as archive:
+            configs = json.loads(str(archive["layers"]))
+            weights = [{} for _ in configs]
+            for key in archive.files:
+                if key != "layers":
+                    index, name = key.split(".", maxsplit=1)
+                    weights[int(index)][name] = archive[key]
+        return cls(list(zip(configs, weights, strict=True)))
+
+    def predict(self, inputs: np.ndarray, batch_size: int = None) -> np.ndarray:
+        """
+        Predicts the outputs for a batch of inputs, like keras' Model.predict.
+        :param inputs: The inputs, with the batch as first axis.
+        :param batch_size: The number of rows done at a time, defaults to all, which
+        is fastest but needs the most memory for the LSTM layers.
+        :return: The outputs.
+        """
+        inputs = np.asarray(inputs, dtype=self.dtype)
+        if batch_size is not None and len(inputs) > batch_size:
+            return np.concatenate(
+                [
+                    self.predict(inputs[start : start + batch_size])
+                    for start in range(0, len(inputs), batch_size)
+                ]
+            )
+
+        x, mask = inputs, None
+        for config, weights in self.layers:
+            x, mask = LAYERS[config["type"]](config, weights, x, mask)
+        return x
+
+    __call__ = predict
@@ -0,0 +1,216 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+
+import numpy as np
+from scipy.linalg import solve_triangular
+
+from .create_splits import STREAM_BATCH_ROWS
+from .least_squares import NormalEquations, kernel_features, normal_equations
+
+# Searches for the subset of kernels (see svd_kernels.py) that gives the lowest
+# tune error. The normal equations of the train and tune splits are made once, after
+# which a subset only needs a solve with a small submatrix of the Gram matrix, and
+# its tune error follows from the tune sums without any predictions:
+#   SSE = w^T (X^T X)_tune w - 2 w^T (X^T y)_tune + (y^T y)_tune
+# Subsets of the same size are solved as a single stack of matrices.
+
+
+class KernelSearch:
+    """
+    Evaluates subsets of the kernel columns by their root mean squared error on the
+    tune split, when fit on the train split.
+    """
+
+    def __init__(
+        self,
+        train: NormalEquations,
+        tune: NormalEquations,
+        columns: list[str],
+        ridge: float = 0.0,
+    ):
+        """
+        :param train: The normal equations of the train split.
+        :param tune: The normal equations of the tune split.
+        :param columns: The names of the features.
+        :param ridge: The ridge penalty, see least_squares.solve_normal_equations.
+        """
+        # Scaled to unit norm columns, like solve_normal_equations, as the kernels
+        # differ in size by many orders of magnitude
+        norms = np.sqrt(np.diag(train.xtx))
+        scale = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+        outer = np.outer(scale, scale)
+
+        self.gram = train.xtx * outer + ridge * np.eye(len(columns))
+        self.moments = train.xty * scale
+        self.tune_gram = tune.xtx * outer
+        self.tune_moments = tune.xty * scale
+        self.tune_yty = tune.yty
+        self.tune_rows = tune.rows
+        self.columns = list(columns)
+
+    @classmethod
+    def from_sample(
+        cls,
+        sample: str,
+        input_columns: list[str] = None,
+        target_column: str = "sensor_voltage",
+        ridge: float = 0.0,
+        batch_rows: int = STREAM_BATCH_ROWS,
+    ) -> "KernelSearch":
+        """
+        Makes the normal equations of the train and tune split in a single pass over
+        a sample file, making the kernels on the fly.
+        :param sample: The name of the sample file, e.g. the linked train file.
+        :param input_columns: The names of the original input columns.
+        :param target_column: The name of the column which contains the target values.
+        :param ridge: The ridge penalty.
+        :param batch_rows: The number of rows read at a time.
+        :return: The search.
+        """
+        features = kernel_features(sample, input_columns, target_column)
+        equations = normal_equations(features, ["train", "tune"], batch_rows)
+        columns = features.collect_schema().names()[:-1]
+        return cls(equations["train"], equations["tune"], columns, ridge)
+
+    def _rmse(self, subsets: np.ndarray) -> np.ndarray:
+        # subsets is an (n, k) array of column indices, all of the same size
+        rows, cols = subsets[:, :, None], subsets[:, None, :]
+        gram = self.gram[rows, cols]
+        moments = self.moments[subsets]
+        try:
+            weights = np.linalg.solve(gram, moments[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            # One of the subsets is singular, the pseudo-inverse gives the minimum
+            # norm solution like np.linalg.lstsq
+            weights = np.einsum("nij,nj->ni", np.linalg.pinv(gram), moments)
+
+        sse = (
+            np.einsum("ni,nij,nj->n", weights, self.tune_gram[rows, cols], weights)
+            - 2 * np.einsum("ni,ni->n", weights, self.tune_moments[subsets])
+            + self.tune_yty
+        )
+        return np.sqrt(np.maximum(sse, 0) / self.tune_rows)
+
+    def evaluate(
+        self, subsets: np.ndarray, workers: int = None, chunk_size: int = 10_000
+    ) -> np.ndarray:
+        """
+        Evaluates many subsets of the same size, in chunks on several threads.
+        :param subsets: An (n, k) array with the column indices of every subset.
+        :param workers: The number of threads, defaults to the number of CPUs.
+        :param chunk_size: The number of subsets solved at a time by a thread.
+        :return: The tune RMSE of every subset.
+        """
+        subsets = np.asarray(subsets)
+        chunks = [
+            subsets[start : start + chunk_size]
+            for start in range(0, len(subsets), chunk_size)
+        ]
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            return np.concatenate(list(pool.map(self._rmse, chunks)) or [[]])
+
+    def best_of_size(
+        self,
+        size: int,
+        samples: int = 100_000,
+        seed: int = 42,
+        workers: int = None,
+    ) -> tuple[float, list[str]]:
+        """
+        Finds the best subset of a given size. All subsets are tried if there are
+        at most `samples` of them, and otherwise a random sample of them.
+        :param size: The number of columns in the subset.
+        :param samples: The maximum number of subsets to try.
+        :param seed: The seed used to sample subsets.
+        :param workers: The number of threads.
+        :return: The tune RMSE and columns of the best subset.
+        """
+        n_columns = len(self.columns)
+        if math.comb(n_columns, size) <= samples:
+            subsets = np.array(list(combinations(range(n_columns), size)))
+        else:
+            rng = np.random.default_rng(seed)
+            subsets = np.argsort(rng.random((samples, n_columns)), axis=1)[:, :size]
+
+        rmse = self.evaluate(subsets, workers)
+        best = int(np.argmin(rmse))
+        return float(rmse[best]), [self.columns[col] for col in sorted(subsets[best])]
+
+    def forward_selection(
+        self, max_columns: int = None
+    ) -> list[tuple[float, list[str]]]:
+        """
+        Greedily adds the column that lowers the tune RMSE the most, keeping a
+        Cholesky factor L of the selected Gram submatrix, and z = L^-1 b of the
+        selected moments. A candidate extends both by one row (a triangular solve),
+        after which its weights take one back substitution, so a candidate costs
+        O(k^2) for k selected columns. The extension of the best candidate is kept.
+        :param max_columns: The number of columns to select, defaults to all.
+        :return: The tune RMSE and columns after every step.
+        """
+        if max_columns is None:
+            max_columns = len(self.columns)
+
+        selected: list[int] = []
+        # The factor of the selected columns is chol[:k, :k], row k is the candidate's
+        chol = np.zeros((max_columns, max_columns))
+        z = np.zeros(max_columns)
+        steps = []
+        for k in range(max_columns):
+            best = None
+            for col in range(len(self.columns)):
+                if col in selected:
+                    continue
+                # The new row of the Cholesky factor when adding this column
+                row = solve_triangular(
+                    chol[:k, :k], self.gram[selected, col], lower=True
+                )
+                diag = self.gram[col, col] - row @ row
+                if diag <= 1e-12:
+                    # Linearly dependent on the selected columns
+                    continue
+                diag = np.sqrt(diag)
+                chol[k, :k], chol[k, k] = row, diag
+                z[k] = (self.moments[col] - row @ z[:k]) / diag
+                # G w = b, with G = L L^T and L z = b
+                weights = solve_triangular(
+                    chol[: k + 1, : k + 1], z[: k + 1], lower=True, trans="T"
+                )
+                subset = [*selected, col]
+                tune_gram = self.tune_gram[np.ix_(subset, subset)]
+                sse = (
+                    weights @ tune_gram @ weights
+                    - 2 * weights @ self.tune_moments[subset]
+                    + self.tune_yty
+                )
+                rmse = np.sqrt(max(sse, 0) / self.tune_rows)
+                if best is None or rmse < best[0]:
+                    best = (rmse, col, row, diag, z[k])
+
+            if best is None:
+                break
+            rmse, col, chol[k, :k], chol[k, k], z[k] = best
+            selected.append(col)
+            steps.append((float(rmse), [self.columns[c] for c in selected]))
+        return steps
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Search for the best kernel subsets")
+    parser.add_argument("sample", help="The linked sample file in data/samples")
+    parser.add_argument("--samples", type=int, default=100_000)
+    parser.add_argument("--ridge", type=float, default=0.0)
+    args = parser.parse_args()
+
+    search = KernelSearch.from_sample(args.sample, ridge=args.ridge)
+    print("Greedy forward selection:")
+    for rmse, columns in search.forward_selection():
+        print(f"{len(columns):0>2} {rmse:.4f} {columns}")
+    print("Best subset per size:")
+    for size in range(1, len(search.columns) + 1):
+        rmse, columns = search.best_of_size(size, args.samples)
+        print(f"{size:0>2} {rmse:.4f} {columns}")
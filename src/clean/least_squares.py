@@ -0,0 +1,132 @@
+from collections.abc import Sequence
+from typing import NamedTuple
+
+import numpy as np
+import polars as pl
+
+from .artifacts import scan_artifact
+from .constants import data_dir
+from .create_splits import STREAM_BATCH_ROWS, assign_splits
+from .svd_kernels import kernel_expressions
+
+SPLIT_IDS = {"train": 0, "tune": 1, "test": 2}
+
+
+def kernel_features(
+    sample: str,
+    input_columns: list[str] = None,
+    target_column: str = "sensor_voltage",
+) -> pl.LazyFrame:
+    """
+    Makes the same features as add_kernels, without writing them to a file.
+    :param sample: The name of the sample file, e.g. the linked train file.
+    :param input_columns: The names of the original input columns.
+    :param target_column: The name of the column which contains the target values.
+    :return: A Polars LazyFrame with the input columns and kernels, then the target.
+    """
+    if input_columns is None:
+        input_columns = ["volt_1", "volt_2", "volt_7", "distance_to_sensor"]
+
+    return (
+        scan_artifact(data_dir(f"samples/{sample}"))
+        .select(*input_columns, target_column)
+        .with_columns(kernel_expressions(input_columns))
+        .select(pl.exclude(target_column), target=target_column)
+    )
+
+
+class NormalEquations(NamedTuple):
+    """
+    The sums that define the least squares problem on one split.
+    """
+
+    xtx: np.ndarray
+    xty: np.ndarray
+    yty: float
+    rows: int
+
+
+def normal_equations(
+    features: pl.LazyFrame,
+    splits: Sequence[str] = ("train",),
+    batch_rows: int = STREAM_BATCH_ROWS,
+) -> dict[str, NormalEquations]:
+    """
+    Accumulates the normal equations X^T X w = X^T y over the rows of some splits,
+    in a single pass over the data, one batch at a time. Rows are assigned to splits
+    like the streamed .npy splits (see create_splits.split_data_streaming).
+    :param features: The features, with the targets in the last column 'target'.
+    :param splits: The splits, out of 'train', 'tune' and 'test'.
+    :param batch_rows: The number of rows read at a time.
+    :return: The normal equations of every split.
+    """
+    n_features = len(features.collect_schema()) - 1
+    sums = {
+        split: [np.zeros((n_features, n_features)), np.zeros(n_features), 0.0, 0]
+        for split in splits
+    }
+
+    rows = features.select(pl.len()).collect().item()
+    for start in range(0, rows, batch_rows):
+        batch = features.slice(start, batch_rows).collect()
+        assigned = assign_splits(np.arange(start, start + len(batch)))
+        y_batch = batch.drop_in_place("target").to_numpy()
+        x_batch = batch.to_numpy().astype(np.float64)
+        for split, acc in sums.items():
+            mask = assigned == SPLIT_IDS[split]
+            x, y = x_batch[mask], y_batch[mask]
+            acc[0] += x.T @ x
+            acc[1] += x.T @ y
+            acc[2] += y @ y
+            acc[3] += len(y)
+
+    return {split: NormalEquations(*acc) for split, acc in sums.items()}
+
+
+def solve_normal_equations(
+    xtx: np.ndarray, xty: np.ndarray, ridge: float = 0.0
+) -> np.ndarray:
+    """
+    Solves the normal equations, optionally with ridge regularisation. The columns
+    are scaled to unit norm first, as the kernels differ in size by many orders of
+    magnitude, so the ridge penalty applies to the scaled weights.
+    :param xtx: X^T X.
+    :param xty: X^T y.
+    :param ridge: The ridge penalty, 0 for ordinary least squares.
+    :return: The weights.
+    """
+    norms = np.sqrt(np.diag(xtx))
+    scale = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+    scaled = xtx * np.outer(scale, scale) + ridge * np.eye(len(xtx))
+    try:
+        weights = np.linalg.solve(scaled, xty * scale)
+    except np.linalg.LinAlgError:
+        # Singular without a ridge penalty (e.g. a constant zero column), in which
+        # case lstsq gives the minimum norm solution like np.linalg.lstsq on X
+        weights = np.linalg.lstsq(scaled, xty * scale, rcond=None)[0]
+    return weights * scale
+
+
+def fit_kernels(
+    sample: str,
+    input_columns: list[str] = None,
+    target_column: str = "sensor_voltage",
+    ridge: float = 0.0,
+    batch_rows: int = STREAM_BATCH_ROWS,
+) -> tuple[np.ndarray, list[str]]:
+    """
+    Fits the linear kernel model on the train split of a sample file, making the
+    kernels on the fly, so that neither the kernels file nor the splits need to fit
+    in memory (or exist). Gives the same weights as np.linalg.lstsq on the train
+    split of get_kernel_splits() (in the streamed .npy format).
+    :param sample: The name of the sample file, e.g. the linked train file.
+    :param input_columns: The names of the original input columns.
+    :param target_column: The name of the column which contains the target values.
+    :param ridge: The ridge penalty, see solve_normal_equations.
+    :param batch_rows: The number of rows read at a time.
+    :return: The weights and the names of the features they belong to.
+    """
+    features = kernel_features(sample, input_columns, target_column)
+    train = normal_equations(features, ["train"], batch_rows)["train"]
+    columns = features.collect_schema().names()[:-1]
+    return solve_normal_equations(train.xtx, train.xty, ridge), columns
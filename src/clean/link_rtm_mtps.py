@@ -1,12 +1,17 @@
 import gc
-import math
 
 import polars as pl
-from tqdm import trange
+from tqdm import tqdm
 
+from .artifacts import scan_artifact, write_artifact
 from .constants import data_dir, with_suffix
+from .memory import BlockSizer, bytes_per_row
+from .profiling import profiled
 
 
+@profiled(
+    inputs={"rtm_file": "rtm", "mtps_file": "mtps"}, outputs={"linked_file": "rtm"}
+)
 def link_rtm_mtps(
     rtm_file: str,
     mtps_file: str,
@@ -20,22 +25,19 @@ def link_rtm_mtps(
     :param rtm_file:
     :param mtps_file:
     :param linked_file:
-    :param block_size:
+    :param block_size: The number of RTM rows of the first block, later blocks are
+    sized to fit in the memory budget (see memory.py).
     :param max_blocks:
     :return:
     """
     if linked_file is None:
         linked_file = with_suffix(rtm_file, "_train.pq")
 
-    # Number of blocks we need to process
-    rtm_blocks = math.ceil(
-        (
-            pl.scan_parquet(data_dir(f"rtm/{rtm_file}"))
-            .select(pl.col("time").len())
-            .collect()
-            / block_size
-        )["time"][0]
-    )
+    rtm_scan = scan_artifact(data_dir(f"rtm/{rtm_file}"))
+    mtps_scan = scan_artifact(data_dir(f"mtps/{mtps_file}"))
+    rtm_rows = rtm_scan.select(pl.len()).collect().item()
+    row_bytes = max(bytes_per_row(rtm_scan), bytes_per_row(mtps_scan))
+    sizer = BlockSizer(rows=block_size)
 
     # We will later be rolling over the dataframe, comparing all rows in a time window
     # with the 'primary' row (namely .first() ) to see if they're close
@@ -63,15 +65,16 @@ def link_rtm_mtps(
     total_dist = coord_distance.add(time_distance).add(pl.col("marker").slice(1))
 
     block_results = []
+    offset = blocks = 0
+    progress = tqdm(total=rtm_rows)
 
-    for block in trange(max_blocks or rtm_blocks):
+    while offset < rtm_rows and (max_blocks is None or blocks < max_blocks):
         # Get the current RTM block to process
         # We offset the primary time index by -30 seconds, so that we can later
         # roll with a window of 1 minute and get 30 seconds before and after
         # every RTM measurement
         df_rtm = (
-            pl.scan_parquet(data_dir(f"rtm/{rtm_file}"))
-            .slice(block * block_size, block_size)
+            rtm_scan.slice(offset, sizer.rows)
             .with_columns(offset_time=pl.col("time").dt.offset_by("-30s"))
             .rename(
                 {
@@ -82,18 +85,23 @@ def link_rtm_mtps(
             .collect()
         )
         # Get the MTPS data around this block
-        df_time_window = (
-            pl.scan_parquet(data_dir(f"mtps/{mtps_file}"))
-            .filter(
-                pl.col("time").is_between(
-                    df_rtm.select(pl.col("time").min()),
-                    df_rtm.select(pl.col("time").max().dt.offset_by("1m")),
-                )
-            )
-            .sort("time")
-            .head(20 * block_size)  # Don't die if the time window is miscalculated
-            .collect()
-        )
+        start, end = df_rtm.select(
+            start=pl.col("time").min(), end=pl.col("time").max().dt.offset_by("1m")
+        ).row(0)
+        mtps_window = mtps_scan.filter(pl.col("time").is_between(start, end))
+
+        # Every row is compared with the rows of the minute after it, so the memory
+        # use grows with the number of rows per minute. If the block is too dense for
+        # the budget, it is retried with fewer rows
+        rows = len(df_rtm) + mtps_window.select(pl.len()).collect().item()
+        per_minute = rows * 60 / max((end - start).total_seconds(), 60)
+        if not sizer.fits(len(df_rtm), rows * row_bytes * per_minute):
+            continue
+
+        df_time_window = mtps_window.sort("time").collect()
+        offset += len(df_rtm)
+        blocks += 1
+        progress.update(len(df_rtm))
         # Combine the two dataframes. This could be done better, but it works
         df_outer = (
             df_time_window.lazy()
@@ -127,8 +135,8 @@ def link_rtm_mtps(
 
         df_joined: pl.DataFrame = (
             df_outer.lazy()
+            .set_sorted("time")
             .rolling(
-                check_sorted=False,
                 index_column="time",
                 period="60s",
                 offset="0s",
@@ -182,12 +190,13 @@ def link_rtm_mtps(
 
         gc.collect()
 
+    progress.close()
     # Finally, we group all the blocks together, and recalculate the trip_step
     # (as we might have lost some MTPS measurements that were too far from their
     #  corresponding RTM measurement)
     pl.concat(block_results).with_columns(
         trip_step=pl.col("time").rle_id().over("trip_id")
-    ).write_parquet(data_dir(f"rtm/{linked_file}"))
+    ).pipe(write_artifact, data_dir(f"rtm/{linked_file}"))
 
 
 def ensure_linked(
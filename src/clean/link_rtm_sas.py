@@ -1,56 +1,174 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import polars as pl
 
+from .artifacts import write_artifact
 from .constants import data_dir
+from .profiling import profiled, record_plan
+from .sortedness import scan_sorted, sort_metadata
+
+# Linking per sensor (see link_rtm_sas_per_sensor) keeps the data of this many sensors
+# in memory at a time, instead of the whole join
+PER_SENSOR_WORKERS = 2
 
 
+def join_sas(rtm: pl.LazyFrame, sas: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Joins rtm and sas data (both sorted by time) based on sensor and approximate time.
+    :param rtm: The rtm data.
+    :param sas: The sas data.
+    :return: A Polars LazyFrame with the rtm rows that have a sas measurement.
+    """
+    # It might be best to lower the tolerance if there's more data available
+    return (
+        rtm.cast({"sensor": pl.UInt8})
+        .join_asof(
+            sas.cast({"sensor": pl.UInt8}),
+            by="sensor",
+            on="time",
+            strategy="nearest",
+            tolerance="20m",
+        )
+        .drop_nulls()
+    )
+
+
+@profiled(
+    inputs={"rtm_name": "rtm", "sas_name": "sas"}, outputs={"linked_file": "samples"}
+)
 def link_rtm_sas(
-    rtm_name: str, sas_name: str, linked_file: str = "simple_joined.pq"
+    rtm_name: str,
+    sas_name: str,
+    linked_file: str = "simple_joined.pq",
+    per_sensor: bool = False,
+    max_workers: int = PER_SENSOR_WORKERS,
 ) -> None:
     """
     Joins the cleaned rtm and sas data based on sensor and approximate time.
     :param linked_file: Output file for result.
     :param rtm_name: The name of the rtm file.
     :param sas_name: The name of the sas file.
+    :param per_sensor: Whether to join every sensor separately, which only needs the
+    memory for one sensor's data per worker, see link_rtm_sas_per_sensor.
+    :param max_workers: The number of sensors joined at the same time, if per_sensor.
     :return: None, but makes a new parquet file.
     """
-    # It might be best to lower the tolerance if there's more data available
+    if per_sensor:
+        link_rtm_sas_per_sensor(rtm_name, sas_name, linked_file, max_workers)
+        return
+
+    # Both inputs are usually sorted already (see sortedness.py), in which case
+    # scan_sorted skips the sort
     (
-        pl.scan_parquet(data_dir(f"rtm/{rtm_name}"))
-        .sort("time")
-        .cast({"sensor": pl.UInt8})
-        .join_asof(
-            pl.scan_parquet(data_dir(f"sas/{sas_name}"))
-            .sort("time")
-            .cast({"sensor": pl.UInt8}),
-            by="sensor",
-            on="time",
-            strategy="nearest",
-            tolerance="20m",
+        join_sas(
+            scan_sorted(f"rtm/{rtm_name}", "time"),
+            scan_sorted(f"sas/{sas_name}", "time"),
         )
-        .drop_nulls()
+        .pipe(record_plan)
         .collect()
-        .write_parquet(data_dir(f"samples/{linked_file}"), compression_level=10)
+        .pipe(
+            write_artifact,
+            data_dir(f"samples/{linked_file}"),
+            compression_level=10,
+            metadata=sort_metadata("time"),
+        )
     )
 
 
-def ensure_linked(linked: str, *, original_rtm: str, original_sas: str) -> None:
+def _partition_by_sensor(lf: pl.LazyFrame, directory: str) -> dict[int, str]:
+    """
+    Streams the data into a file per sensor, keeping the order of the rows.
+    :param lf: The data.
+    :param directory: The directory to make the files in.
+    :return: The glob of the files of every sensor.
+    """
+    lf.sink_parquet(pl.PartitionByKey(f"{directory}/", by="sensor"), mkdir=True)
+    if not os.path.isdir(directory):
+        return {}
+    return {
+        int(part.name.split("=", 1)[1]): f"{part.path}/*.parquet"
+        for part in os.scandir(directory)
+    }
+
+
+def link_rtm_sas_per_sensor(
+    rtm_name: str,
+    sas_name: str,
+    linked_file: str = "simple_joined.pq",
+    max_workers: int = PER_SENSOR_WORKERS,
+) -> None:
+    """
+    Joins the cleaned rtm and sas data like link_rtm_sas, but one sensor at a time.
+    Both sides are first split into a file per sensor (one streaming pass each), the
+    sensors are joined a few at a time, each streamed to its own file, and the files
+    are then streamed into the output in sensor order.
+    :param rtm_name: The name of the rtm file.
+    :param sas_name: The name of the sas file.
+    :param linked_file: Output file for result.
+    :param max_workers: The number of sensors joined at the same time.
+    :return: None, but makes a new parquet file, sorted by sensor and time.
+    """
+    rtm = scan_sorted(f"rtm/{rtm_name}", "time")
+    sas = scan_sorted(f"sas/{sas_name}", "time")
+    output = data_dir(f"samples/{linked_file}")
+    metadata = sort_metadata("sensor", "time")
+
+    with tempfile.TemporaryDirectory(dir=data_dir("samples")) as parts_dir:
+        rtm_parts = _partition_by_sensor(rtm, f"{parts_dir}/rtm")
+        sas_parts = _partition_by_sensor(sas, f"{parts_dir}/sas")
+        # Sensors without SAS measurements have no rows in the join
+        sensors = sorted(rtm_parts.keys() & sas_parts.keys())
+        if not sensors:
+            join_sas(rtm.clear(), sas.clear()).collect().pipe(
+                write_artifact, output, compression_level=10, metadata=metadata
+            )
+            return
+
+        part_files = [f"{parts_dir}/sensor_{sensor:0>2}.pq" for sensor in sensors]
+
+        def link_sensor(sensor: int, part_file: str) -> None:
+            # The partitions keep the time order of the inputs (sinks keep the order
+            # of the rows). Polars releases the GIL while running a query, so threads
+            # are enough
+            join_sas(
+                pl.scan_parquet(rtm_parts[sensor]).set_sorted("time"),
+                pl.scan_parquet(sas_parts[sensor]).set_sorted("time"),
+            ).sink_parquet(part_file)
+
+        with ThreadPoolExecutor(max_workers) as pool:
+            # list() to re-raise any exceptions from the workers
+            list(pool.map(link_sensor, sensors, part_files))
+
+        pl.scan_parquet(part_files).set_sorted("sensor").pipe(
+            write_artifact, output, compression_level=10, metadata=metadata
+        )
+
+
+def ensure_linked(
+    linked: str, *, original_rtm: str, original_sas: str, per_sensor: bool = False
+) -> None:
     """
     Makes sure the linked rtm and sas file exists on the system. If it does not
     it is made.
     :param linked: The name of the linked sas and rtm file.
     :param original_rtm: The name of the original rtm file.
     :param original_sas: The name of the original sas file.
+    :param per_sensor: Whether to link each sensor separately, see link_rtm_sas.
     :return: None, but potentially makes a new file.
     """
-    import os
-
     from .clean_sas import ensure_sas
     from .preprocess_rtm import ensure_rtm_preprocessed
 
     if os.path.isfile(data_dir(f"samples/{linked}")):
         return
 
-    ensure_rtm_preprocessed(original_rtm, original="train.pq")
-    ensure_sas(original_sas, original="voltage-avg-feb-april.pq")
+    # The rtm and sas chains are independent, so they are made concurrently
+    with ThreadPoolExecutor() as pool:
+        rtm = pool.submit(ensure_rtm_preprocessed, original_rtm, original="train.pq")
+        sas = pool.submit(ensure_sas, original_sas, original="voltage-avg-feb-april.pq")
+        rtm.result()
+        sas.result()
     print(f"linking {original_rtm=} and {original_sas=}, into {linked}")
-    link_rtm_sas(original_rtm, original_sas, linked_file=linked)
+    link_rtm_sas(original_rtm, original_sas, linked_file=linked, per_sensor=per_sensor)
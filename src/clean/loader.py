@@ -0,0 +1,237 @@
+import math
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Mapping
+
+import keras
+import numpy as np
+import polars as pl
+
+from .artifacts import scan_artifact
+from .constants import data_dir
+from .create_splits import IndexedSplits, TransformedSplits
+
+# Keras is only needed for this module, so it is not imported by `import clean`.
+# The datasets read the data one block of rows at a time. Split files (and sample
+# files) are in file order within a block, like the time order of the data, so the
+# shuffle is a buffer of several blocks: every epoch, the blocks are shuffled and
+# taken shuffle_blocks at a time, and the rows of those blocks are shuffled together.
+# A batch then holds rows of shuffle_blocks random stretches of the data, and the
+# memory use is bounded by two such windows.
+BLOCK_ROWS = 65_536
+SHUFFLE_BLOCKS = 8
+
+Reader = Callable[[int, int], tuple[np.ndarray, np.ndarray]]
+
+
+class SplitDataset(keras.utils.PyDataset):
+    """
+    Streams the batches of one split to keras' model.fit, reading the data in blocks
+    and preparing batches on worker threads (see keras.utils.PyDataset).
+    Use the from_splits, from_arrays or from_parquet constructors.
+    """
+
+    def __init__(
+        self,
+        read: Reader,
+        rows: int,
+        batch_size: int = 500,
+        shuffle: bool = True,
+        block_rows: int = BLOCK_ROWS,
+        shuffle_blocks: int = SHUFFLE_BLOCKS,
+        seed: int = 42,
+        transform: Callable[[np.ndarray], np.ndarray] = None,
+        workers: int = 4,
+        max_queue_size: int = 10,
+    ):
+        """
+        :param read: Reads the inputs and targets of a range of rows.
+        :param rows: The number of rows in the split.
+        :param batch_size: The number of rows per batch.
+        :param shuffle: Whether to shuffle the blocks and the rows within them.
+        :param block_rows: The number of rows read at a time, rounded down to a
+        multiple of the batch size.
+        :param shuffle_blocks: The number of blocks whose rows are shuffled together.
+        :param seed: The seed of the shuffle, together with the epoch.
+        :param transform: A function applied to every input batch, e.g. to reshape it.
+        :param workers: The number of threads preparing batches.
+        :param max_queue_size: The number of batches prepared ahead.
+        """
+        super().__init__(workers=workers, max_queue_size=max_queue_size)
+        self.read = read
+        self.rows = rows
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.block_rows = max(1, block_rows // batch_size) * batch_size
+        self.shuffle_blocks = shuffle_blocks if shuffle else 1
+        self.seed = seed
+        self.transform = transform
+
+        self.epoch = 0
+        self.blocks = math.ceil(rows / self.block_rows)
+        self.block_order = self._block_order()
+        # Consecutive batches come from the same window of blocks, so the workers
+        # share the most recently read windows
+        self._cache: OrderedDict[int, tuple[np.ndarray, np.ndarray]] = OrderedDict()
+        self._cache_size = 2
+        self._reading: dict[int, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_arrays(
+        cls, inputs: np.ndarray, targets: np.ndarray, **kwargs
+    ) -> "SplitDataset":
+        """
+        Streams batches from arrays, typically memory-mapped .npy files.
+        :param inputs: The input array.
+        :param targets: The target array.
+        :param kwargs: See SplitDataset.
+        :return: The dataset.
+        """
+
+        def read(start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+            return np.asarray(inputs[start:stop]), np.asarray(targets[start:stop])
+
+        return cls(read, len(targets), **kwargs)
+
+    @classmethod
+    def from_splits(
+        cls, splits: Mapping[str, np.ndarray], split: str = "train", **kwargs
+    ) -> "SplitDataset":
+        """
+        Streams batches from a split returned by one of the get_*_splits functions.
+        Index splits (see create_splits.IndexedSplits) are gathered one block at a
+        time, like the inputs of transformed splits are transformed.
+        :param splits: The splits.
+        :param split: The split, one of 'train', 'tune' or 'test'.
+        :param kwargs: See SplitDataset.
+        :return: The dataset.
+        """
+        transform = None
+        if isinstance(splits, TransformedSplits):
+            splits, transform = splits.splits, splits.transform
+
+        if isinstance(splits, IndexedSplits):
+            rows = splits.rows(split)
+
+            def read(start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+                return splits.gather(rows[start:stop])
+
+            size = len(rows)
+        else:
+            inputs, targets = splits[f"i_{split}"], splits[f"t_{split}"]
+
+            def read(start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+                return np.asarray(inputs[start:stop]), np.asarray(targets[start:stop])
+
+            size = len(targets)
+
+        if transform is None:
+            return cls(read, size, **kwargs)
+
+        def read_transformed(start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+            inputs, targets = read(start, stop)
+            return transform(inputs), targets
+
+        return cls(read_transformed, size, **kwargs)
+
+    @classmethod
+    def from_parquet(
+        cls,
+        file: str,
+        input_columns: list[str | pl.Expr],
+        target_column: str = "sensor_voltage",
+        **kwargs,
+    ) -> "SplitDataset":
+        """
+        Streams batches straight from a sample file, e.g. for data that was never
+        split into .npy files.
+        :param file: The name of the sample file in data/samples.
+        :param input_columns: The columns to use as inputs.
+        :param target_column: The name of the column containing the target data.
+        :param kwargs: See SplitDataset.
+        :return: The dataset.
+        """
+        source = scan_artifact(data_dir(f"samples/{file}")).select(
+            input_columns, target=target_column
+        )
+
+        def read(start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+            block = source.slice(start, stop - start).collect()
+            targets = block.drop_in_place("target").to_numpy()
+            return block.to_numpy(), targets
+
+        return cls(read, source.select(pl.len()).collect().item(), **kwargs)
+
+    def _block_order(self) -> np.ndarray:
+        order = np.arange(self.blocks)
+        if self.shuffle:
+            # The last block can have fewer batches, so it stays last
+            rng = np.random.default_rng([self.seed, self.epoch])
+            order[:-1] = rng.permutation(order[:-1])
+        return order
+
+    def _window(self, window: int) -> tuple[np.ndarray, np.ndarray]:
+        while True:
+            with self._lock:
+                if window in self._cache:
+                    self._cache.move_to_end(window)
+                    return self._cache[window]
+                reading = self._reading.get(window)
+                if reading is None:
+                    self._reading[window] = threading.Event()
+                    break
+            # Another worker is reading the window
+            reading.wait()
+
+        # Read outside the lock, so workers can read different windows concurrently
+        try:
+            inputs, targets = self._read_window(window)
+            with self._lock:
+                self._cache[window] = inputs, targets
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        finally:
+            with self._lock:
+                self._reading.pop(window).set()
+        return inputs, targets
+
+    def _read_window(self, window: int) -> tuple[np.ndarray, np.ndarray]:
+        blocks = self.block_order[
+            window * self.shuffle_blocks : (window + 1) * self.shuffle_blocks
+        ]
+        parts = [
+            self.read(
+                block * self.block_rows,
+                min((block + 1) * self.block_rows, self.rows),
+            )
+            for block in blocks.tolist()
+        ]
+        inputs = np.concatenate([part[0] for part in parts])
+        targets = np.concatenate([part[1] for part in parts])
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch, window]).permutation(
+                len(targets)
+            )
+            inputs, targets = inputs[order], targets[order]
+        return inputs, targets
+
+    def __len__(self) -> int:
+        return math.ceil(self.rows / self.batch_size)
+
+    def __getitem__(self, idx: int) -> tuple[np.ndarray, np.ndarray]:
+        # Every window but the last is whole blocks, so a whole number of batches
+        batches_per_window = self.shuffle_blocks * self.block_rows // self.batch_size
+        inputs, targets = self._window(idx // batches_per_window)
+
+        start = (idx % batches_per_window) * self.batch_size
+        batch_inputs = inputs[start : start + self.batch_size]
+        if self.transform is not None:
+            batch_inputs = self.transform(batch_inputs)
+        return batch_inputs, targets[start : start + self.batch_size]
+
+    def on_epoch_end(self) -> None:
+        self.epoch += 1
+        self.block_order = self._block_order()
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,361 @@
+import asyncio
+import glob
+import json
+import os
+import tempfile
+from collections.abc import Callable, Iterator
+from datetime import datetime
+
+import numpy as np
+import polars as pl
+
+from .artifacts import scan_artifact
+from .constants import data_dir
+from .inference import NumpyModel
+from .serve import (
+    FEATURES,
+    RECORD_SCHEMA,
+    Client,
+    MicroBatcher,
+    Predictor,
+    parse_records,
+)
+from .sortedness import recorded_sort
+
+# A load generator for the inference path: replays the cleaned RTM history (e.g.
+# rtm/cleaned.pq or the linked rtm/train.pq) at a multiple of real time, against the
+# HTTP service of serve.py or a predictor in this process, like the live feed would.
+# Every tick (a second of history by default) is sent as one request per train, at
+# the time it would have arrived at the given speed, or as fast as possible with a
+# speed of 0 (burst).
+# The requests are scheduled independently of the responses (an open loop), and the
+# latency is measured from the scheduled time, so a target that falls behind shows up
+# as queueing delay instead of a slower schedule. Requests wait in a bounded queue
+# for one of the concurrent senders; once that is full the replay itself falls
+# behind, which is reported as the lag.
+# The history files are not sorted by time, so unless their metadata records that
+# they are, they are first split into files of chunk_s seconds (a streaming pass),
+# and one chunk at a time is sorted in memory.
+RESULTS_FILE = "bench/replay.jsonl"
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def _sorted_chunks(file: str, chunk_rows: int) -> Iterator[pl.DataFrame]:
+    lf = scan_artifact(data_dir(file))
+    rows = lf.select(pl.len()).collect().item()
+    for offset in range(0, rows, chunk_rows):
+        yield lf.slice(offset, chunk_rows).collect()
+
+
+def _spilled_chunks(file: str, chunk_s: int) -> Iterator[pl.DataFrame]:
+    with tempfile.TemporaryDirectory(prefix="clean-replay-") as tmp:
+        scan_artifact(data_dir(file)).with_columns(
+            _chunk=pl.col("time").dt.epoch("s") // chunk_s
+        ).sink_parquet(
+            pl.PartitionByKey(f"{tmp}/", by="_chunk", include_key=False), mkdir=True
+        )
+        chunks = sorted(
+            glob.glob(f"{tmp}/_chunk=*"), key=lambda d: int(d.rsplit("=", 1)[1])
+        )
+        for chunk in chunks:
+            yield pl.read_parquet(f"{chunk}/*.parquet").sort("time")
+
+
+def history_ticks(
+    file: str,
+    every: str = "1s",
+    chunk_s: int = 3_600,
+    chunk_rows: int = 1_000_000,
+) -> Iterator[tuple[datetime, pl.DataFrame]]:
+    """
+    Reads a history file in time order, with bounded memory, in ticks of a period
+    of time.
+    :param file: The cleaned RTM file in the data directory, with at least 'time',
+    'lat', 'lon' and the voltages.
+    :param every: The period of time of a tick, e.g. '1s'.
+    :param chunk_s: The seconds of history sorted at once, if the file isn't sorted.
+    :param chunk_rows: The rows read at once, if the file is sorted by time.
+    :return: An iterator of the start and rows of every tick, sorted by time.
+    """
+    if recorded_sort(file)[:1] == ("time",):
+        chunks = _sorted_chunks(file, chunk_rows)
+    else:
+        chunks = _spilled_chunks(file, chunk_s)
+
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pl.concat([carry, chunk])
+        ticks = chunk.with_columns(
+            _tick=pl.col("time").dt.truncate(every)
+        ).partition_by("_tick", maintain_order=True)
+        # The last tick of a chunk can continue in the next one
+        carry = ticks.pop().drop("_tick")
+        for tick in ticks:
+            yield tick["_tick"][0], tick.drop("_tick")
+    if carry is not None:
+        yield carry.select(pl.col("time").dt.truncate(every)).item(0, 0), carry
+
+
+def to_requests(tick: pl.DataFrame, max_rows: int = 256) -> list[pl.DataFrame]:
+    """
+    Splits the records of a tick into the requests of the trains, as in
+    serve.RECORD_SCHEMA. Files without a 'train_nr' (like rtm/cleaned.pq) are sent as
+    if from one train.
+    :param tick: The rows of one tick.
+    :param max_rows: The most records in one request.
+    :return: The records of every request.
+    """
+    train_nr = pl.col("train_nr") if "train_nr" in tick.columns else pl.lit(0)
+    records = tick.select(
+        train_nr=train_nr.cast(pl.Int64),
+        time=pl.col("time").dt.to_string("%+"),
+        **{
+            col: pl.col(col).cast(dtype)
+            for col, dtype in RECORD_SCHEMA.items()
+            if col not in ("train_nr", "time")
+        },
+    )
+    return [
+        part.slice(start, max_rows)
+        for part in records.partition_by("train_nr", maintain_order=True)
+        for start in range(0, len(part), max_rows)
+    ]
+
+
+class HttpTarget:
+    """
+    Sends requests to the service of serve.py, over a pool of keep-alive connections.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8080, connections: int = 8):
+        self.clients = [Client(host, port) for _ in range(connections)]
+        self.idle: asyncio.Queue[Client] = asyncio.Queue()
+
+    async def __aenter__(self) -> "HttpTarget":
+        for client in self.clients:
+            await client.__aenter__()
+            self.idle.put_nowait(client)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        for client in self.clients:
+            await client.__aexit__(*exc)
+
+    async def __call__(self, records: pl.DataFrame) -> None:
+        client = await self.idle.get()
+        try:
+            await client.predict(records.to_dicts())
+        finally:
+            self.idle.put_nowait(client)
+
+
+class LocalTarget:
+    """
+    Sends requests to a scoring function in this process, batched like the service
+    (see serve.MicroBatcher), without the HTTP and JSON overhead.
+    """
+
+    def __init__(
+        self,
+        predict: Callable[[pl.DataFrame], pl.DataFrame],
+        max_rows: int = 4_096,
+        max_delay_ms: float = 2.0,
+    ):
+        """
+        :param predict: Predicts a batch of records, see serve.Predictor.
+        :param max_rows: The number of records at which a batch is started at once.
+        :param max_delay_ms: The longest time a request waits for others to batch.
+        """
+        self.batcher = MicroBatcher(predict, max_rows, max_delay_ms)
+
+    async def __aenter__(self) -> "LocalTarget":
+        self._batcher = asyncio.create_task(self.batcher.run())
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._batcher.cancel()
+
+    async def __call__(self, records: pl.DataFrame) -> None:
+        await self.batcher.submit(parse_records(records))
+
+
+def _percentiles(values: list[float]) -> dict[str, float] | None:
+    if not values:
+        return None
+    ms = np.array(values) * 1_000
+    return {
+        f"p{p:g}_ms": v
+        for p, v in zip(PERCENTILES, np.percentile(ms, PERCENTILES), strict=True)
+    } | {"max_ms": ms.max()}
+
+
+async def replay(
+    ticks: Iterator[tuple[datetime, pl.DataFrame]],
+    target: Callable[[pl.DataFrame], object],
+    speed: float = 1.0,
+    concurrency: int = 8,
+    max_pending: int = 10_000,
+    request_rows: int = 256,
+) -> dict:
+    """
+    Replays ticks of history against a target, and measures the latency and
+    throughput.
+    :param ticks: The ticks of history, see history_ticks.
+    :param target: Sends the records of a request, see HttpTarget and LocalTarget.
+    :param speed: The multiple of real time to replay at, or 0 to send every request
+    as soon as a sender is free.
+    :param concurrency: The number of requests in flight at the same time.
+    :param max_pending: The most requests waiting for a sender, when paced.
+    :param request_rows: The most records in one request.
+    :return: The report, with the latency (from the scheduled time), the queueing
+    delay and service time percentiles, and the throughput per second.
+    """
+    loop = asyncio.get_running_loop()
+    # In a burst, the queue only holds the next requests of the senders, so the
+    # latency isn't the time spent waiting behind the whole history
+    queue: asyncio.Queue[tuple[float, pl.DataFrame] | None] = asyncio.Queue(
+        max_pending if speed else concurrency
+    )
+    latencies, waits, services, finished = [], [], [], []
+    rows, errors = [], 0
+    max_lag, max_depth = 0.0, 0
+
+    async def sender() -> None:
+        nonlocal errors
+        while (item := await queue.get()) is not None:
+            scheduled, records = item
+            sent = loop.time()
+            try:
+                await target(records)
+            except Exception:
+                errors += 1
+                continue
+            done = loop.time()
+            latencies.append(done - scheduled)
+            waits.append(sent - scheduled)
+            services.append(done - sent)
+            finished.append(done)
+            rows.append(len(records))
+
+    senders = [asyncio.create_task(sender()) for _ in range(concurrency)]
+    ticks = iter(ticks)
+    start = first = last = None
+    # Reading (and sorting) the next chunk of history blocks, so ticks are read on a
+    # thread to keep the senders going
+    while item := await asyncio.to_thread(next, ticks, None):
+        tick, records = item
+        if first is None:
+            start, first = loop.time(), tick
+        last = tick
+        if speed:
+            scheduled = start + (tick - first).total_seconds() / speed
+            if (delay := scheduled - loop.time()) > 0:
+                await asyncio.sleep(delay)
+        for request in to_requests(records, request_rows):
+            now = loop.time()
+            if not speed:
+                scheduled = now
+            max_lag = max(max_lag, now - scheduled)
+            max_depth = max(max_depth, queue.qsize())
+            await queue.put((scheduled, request))
+    for _ in senders:
+        await queue.put(None)
+    await asyncio.gather(*senders)
+    if start is None:
+        start = loop.time()
+    wall = loop.time() - start
+
+    per_second = (
+        np.bincount((np.array(finished) - start).astype(int), weights=rows, minlength=1)
+        if finished
+        else np.zeros(1)
+    )
+    history = (last - first).total_seconds() if first else 0.0
+    return {
+        "speed": speed,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "rows": int(sum(rows)),
+        "errors": errors,
+        "history_s": history,
+        "wall_s": wall,
+        "achieved_speed": history / wall if wall else None,
+        "rows_per_s": sum(rows) / wall if wall else None,
+        "requests_per_s": len(latencies) / wall if wall else None,
+        # The throughput of the slowest and median full second, without the first
+        # and last second
+        "sustained_rows_per_s": float(np.median(per_second[1:-1]))
+        if len(per_second) > 2
+        else None,
+        "min_rows_per_s": float(per_second[1:-1].min())
+        if len(per_second) > 2
+        else None,
+        "max_lag_s": max_lag,
+        "max_pending": max_depth,
+        "latency": _percentiles(latencies),
+        "queue_wait": _percentiles(waits),
+        "service": _percentiles(services),
+    }
+
+
+def save_report(report: dict, file: str = RESULTS_FILE) -> None:
+    """
+    Appends a report to the results in the data directory.
+    :param report: The report, see replay.
+    :param file: The JSON lines file in the data directory.
+    """
+    path = data_dir(file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(report, default=float) + "\n")
+
+
+if __name__ == "__main__":
+    import argparse
+    import itertools
+
+    parser = argparse.ArgumentParser(
+        description="Replay the cleaned RTM history against the prediction service"
+    )
+    parser.add_argument("file", help="The history, e.g. rtm/cleaned.pq or rtm/train.pq")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="Multiple of real time, 0 to burst"
+    )
+    parser.add_argument("--every", default="1s", help="The period of a tick")
+    parser.add_argument("--ticks", type=int, help="Only replay this many ticks")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--request-rows", type=int, default=256)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--model", help="Predict in this process with this exported model instead"
+    )
+    parser.add_argument("--features", choices=FEATURES, default="base")
+    parser.add_argument("--max-rows", type=int, default=4_096)
+    parser.add_argument("--max-delay-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    async def main() -> dict:
+        if args.model:
+            predictor = Predictor(NumpyModel.load(args.model), FEATURES[args.features])
+            target = LocalTarget(predictor, args.max_rows, args.max_delay_ms)
+        else:
+            target = HttpTarget(args.host, args.port, args.concurrency)
+        ticks = itertools.islice(history_ticks(args.file, args.every), args.ticks)
+        async with target:
+            return await replay(
+                ticks,
+                target,
+                args.speed,
+                args.concurrency,
+                request_rows=args.request_rows,
+            )
+
+    report = {
+        "file": args.file,
+        "target": args.model or f"{args.host}:{args.port}",
+        "time": datetime.now().isoformat(timespec="seconds"),
+    } | asyncio.run(main())
+    save_report(report)
+    print(json.dumps(report, indent=2, default=float))
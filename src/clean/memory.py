@@ -0,0 +1,108 @@
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+import polars as pl
+
+# The memory budget of the stages that process their input in blocks (link_rtm_mtps,
+# space_extra_gps). Set CLEAN_MEMORY_GB for the budget of a whole build: build_all
+# (see pipeline.py --memory-gb) schedules stages within it, and gives every stage
+# running at the same time an equal share, in CLEAN_STAGE_MEMORY_GB. Without a
+# budget, a stage may use a quarter of the physical memory.
+# A block needs more memory where the data is dense (e.g. around rush hour, the
+# rolling windows of a block hold more rows), so instead of a fixed number of rows,
+# the size of the next block is picked from the memory the previous ones needed per
+# row. A block that would not fit is retried smaller, down to min_rows.
+DEFAULT_SHARE = 0.25
+
+
+def budget_gb() -> float | None:
+    """
+    :return: The memory budget of a whole build in GB, from CLEAN_MEMORY_GB, if set.
+    """
+    budget = os.environ.get("CLEAN_MEMORY_GB")
+    return float(budget) if budget else None
+
+
+def stage_budget() -> int:
+    """
+    :return: The memory a stage may use for its blocks, in bytes.
+    """
+    for key in ["CLEAN_STAGE_MEMORY_GB", "CLEAN_MEMORY_GB"]:
+        if budget := os.environ.get(key):
+            return int(float(budget) * 1e9)
+    return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * DEFAULT_SHARE)
+
+
+@contextmanager
+def stage_memory(budget_gb: float) -> Iterator[None]:
+    """
+    Gives the stages run within the context a memory budget, through the environment
+    (so worker processes inherit it), and restores the previous budget after.
+    :param budget_gb: The memory a stage may use in GB, or None to leave it as is.
+    """
+    previous = os.environ.get("CLEAN_STAGE_MEMORY_GB")
+    if budget_gb is not None:
+        os.environ["CLEAN_STAGE_MEMORY_GB"] = str(budget_gb)
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("CLEAN_STAGE_MEMORY_GB", None)
+        else:
+            os.environ["CLEAN_STAGE_MEMORY_GB"] = previous
+
+
+def bytes_per_row(lf: pl.LazyFrame, sample_rows: int = 10_000) -> float:
+    """
+    Estimates the in-memory size of a row, from the first rows.
+    :param lf: The data.
+    :param sample_rows: The number of rows to measure.
+    :return: The size of a row in bytes.
+    """
+    sample = lf.head(sample_rows).collect()
+    return sample.estimated_size() / max(len(sample), 1)
+
+
+class BlockSizer:
+    """
+    Picks the number of rows of the next block, so its estimated memory use stays
+    within the budget.
+    """
+
+    def __init__(
+        self,
+        rows: int = 10_000,
+        min_rows: int = 1_000,
+        max_rows: int = 10_000_000,
+        budget: int = None,
+        headroom: float = 0.8,
+    ):
+        """
+        :param rows: The size of the first block.
+        :param min_rows: The smallest block, which is processed even if it doesn't
+        fit.
+        :param max_rows: The largest block.
+        :param budget: The memory a block may use in bytes, defaults to stage_budget.
+        :param headroom: The fraction of the budget that blocks are sized for, as the
+        memory use is only an estimate.
+        """
+        self.rows = rows
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.budget = budget or stage_budget()
+        self.headroom = headroom
+
+    def fits(self, rows: int, block_bytes: float) -> bool:
+        """
+        Records the estimated memory use of a block, and sizes the next one (or the
+        retry of this one) from it. Blocks at most double in size, so a sparse stretch
+        of data doesn't make the next block far too large.
+        :param rows: The number of rows of the block.
+        :param block_bytes: Its estimated memory use.
+        :return: Whether the block should be processed, or retried with self.rows.
+        """
+        per_row = max(block_bytes / max(rows, 1), 1.0)
+        target = int(self.budget * self.headroom / per_row)
+        self.rows = max(self.min_rows, min(target, 2 * rows, self.max_rows))
+        return block_bytes <= self.budget or rows <= self.min_rows
@@ -0,0 +1,635 @@
+import ast
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import json
+import math
+import multiprocessing as mp
+import os
+import sys
+from collections.abc import Callable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from functools import cache
+from typing import Union
+
+import polars as pl
+
+from . import preview, profiling
+from .artifacts import artifact_codec, artifact_suffix
+from .constants import data_dir, with_suffix
+from .create_splits import SPLIT_FORMAT, SPLIT_SUFFIXES, split_data
+from .memory import budget_gb, stage_memory
+
+# The preprocessing chain as a DAG of stages. Every artifact is stored under a name
+# containing a fingerprint of its inputs, parameters and code, so a changed parameter
+# or input only rebuilds the stages that depend on it, and several variants of the
+# same artifact can exist next to each other.
+
+
+def fingerprint(*parts) -> str:
+    """
+    Hashes JSON-serializable values (other values are hashed by their string form).
+    :param parts: The values to hash.
+    :return: A hexadecimal sha256 digest.
+    """
+    encoded = json.dumps(parts, default=str, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+@cache
+def package_imports(module: str) -> frozenset[str]:
+    """
+    Finds the modules of this package a module imports, directly or through the
+    modules it imports, including imports within functions (but not those of its
+    __main__ block).
+    :param module: The name of the module, e.g. 'clean.link_rtm_sas'.
+    :return: The names of the modules, including the module itself.
+    """
+    package = __name__.rpartition(".")[0]
+    found = set()
+    pending = [module]
+    while pending:
+        name = pending.pop()
+        if name in found:
+            continue
+        found.add(name)
+        tree = ast.parse(inspect.getsource(importlib.import_module(name)))
+        for node in tree.body:
+            if isinstance(node, ast.If) and "__main__" in ast.unparse(node.test):
+                continue
+            for imp in ast.walk(node):
+                if not isinstance(imp, ast.ImportFrom):
+                    continue
+                if imp.level:
+                    base = name.rsplit(".", imp.level)[0]
+                    base = f"{base}.{imp.module}" if imp.module else base
+                elif (imp.module or "").startswith(f"{package}."):
+                    base = imp.module
+                else:
+                    continue
+                if base != package:
+                    pending.append(base)
+                    continue
+                # Like 'from . import preview', which imports modules of the package
+                pending.extend(
+                    f"{package}.{alias.name}"
+                    for alias in imp.names
+                    if importlib.util.find_spec(f"{package}.{alias.name}")
+                )
+    return frozenset(found)
+
+
+@cache
+def code_version(module: str) -> str:
+    """
+    Hashes the source code of a module and of the modules of this package it uses
+    (see package_imports), so that editing a stage, or e.g. the constants it uses,
+    invalidates its outputs.
+    :param module: The name of the module, e.g. 'clean.link_rtm_sas'.
+    :return: A hexadecimal sha256 digest.
+    """
+    return fingerprint(
+        {
+            name: inspect.getsource(sys.modules[name])
+            for name in sorted(package_imports(module))
+        }
+    )
+
+
+@dataclass(frozen=True)
+class Source:
+    """
+    A base data file, which is not made by the pipeline (see data/README.md).
+    """
+
+    directory: str
+    file: str
+
+    @property
+    def filename(self) -> str:
+        return self.file
+
+    @property
+    def path(self) -> str:
+        return data_dir(f"{self.directory}/{self.file}")
+
+    def fingerprint(self) -> str:
+        # Hashing the contents of the base files would take minutes, so we rely on
+        # the size and modification time instead
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(
+                f"Missing base data file {self.directory}/{self.file}"
+            )
+        stat = os.stat(self.path)
+        return fingerprint(self.directory, self.file, stat.st_size, stat.st_mtime_ns)
+
+    def build(self, force: bool = False) -> str:
+        self.fingerprint()
+        return self.filename
+
+
+@dataclass(frozen=True, eq=False)
+class Stage:
+    """
+    A step in the pipeline, calling func with the filenames of its inputs, the
+    filename of its output and its parameters, all as keyword arguments.
+    """
+
+    name: str
+    directory: str
+    func: Callable[..., None]
+    output: str
+    inputs: dict[str, Union["Stage", Source]] = field(default_factory=dict)
+    params: dict[str, object] = field(default_factory=dict)
+    # The suffix of the output, defaults to that of the artifact format (see
+    # artifacts.py), so a build in another format doesn't reuse the old outputs
+    suffix: str = None
+    # Estimated peak memory use per byte of input on disk, used by the scheduler
+    memory_factor: float = 5.0
+
+    def fingerprint(self) -> str:
+        return fingerprint(
+            self.name,
+            self.func.__qualname__,
+            code_version(self.func.__module__),
+            self.params,
+            {arg: inp.fingerprint() for arg, inp in self.inputs.items()},
+        )
+
+    @property
+    def filename(self) -> str:
+        suffix = self.suffix or artifact_suffix()
+        return f"{self.name}.{self.fingerprint()[:12]}{suffix}"
+
+    @property
+    def path(self) -> str:
+        return data_dir(f"{self.directory}/{self.filename}")
+
+    @property
+    def manifest(self) -> str:
+        return with_suffix(self.path, ".json")
+
+    def is_built(self) -> bool:
+        # The manifest is written after the stage finishes, so an interrupted stage
+        # is not mistaken for a finished one. Outputs in other formats (see
+        # artifacts.py) share the manifest, so it names the output it was written for
+        if not (os.path.exists(self.path) and os.path.isfile(self.manifest)):
+            return False
+        with open(self.manifest) as file:
+            return json.load(file).get("output", self.filename) == self.filename
+
+    def memory_estimate(self) -> float:
+        """
+        Estimates the peak memory use of this stage, once its inputs are built.
+        :return: The estimate in GB.
+        """
+        input_bytes = sum(os.path.getsize(inp.path) for inp in self.inputs.values())
+        return self.memory_factor * input_bytes / 1e9
+
+    def run(self) -> str:
+        """
+        Runs this stage, assuming its inputs are built.
+        :return: The filename of the output.
+        """
+        print(f"building {self.directory}/{self.filename}")
+        self.func(
+            **{arg: inp.filename for arg, inp in self.inputs.items()},
+            **{self.output: self.filename},
+            **self.params,
+        )
+        with open(self.manifest, "w") as file:
+            json.dump(
+                {
+                    "stage": self.name,
+                    "func": f"{self.func.__module__}.{self.func.__qualname__}",
+                    "fingerprint": self.fingerprint(),
+                    "output": self.filename,
+                    "params": self.params,
+                    "codec": None if self.suffix else artifact_codec(self.path),
+                    "inputs": {
+                        arg: f"{inp.directory}/{inp.filename}"
+                        for arg, inp in self.inputs.items()
+                    },
+                },
+                file,
+                default=str,
+                indent=2,
+            )
+        return self.filename
+
+    def build(self, force: bool = False) -> str:
+        """
+        Builds the inputs of this stage one after the other, and then the stage itself
+        if its output with the current fingerprint does not exist yet. See build_all
+        for building independent stages concurrently.
+        :param force: Whether to rebuild this stage (but not its inputs) regardless.
+        :return: The filename of the output.
+        """
+        for inp in self.inputs.values():
+            inp.build()
+
+        if force or not self.is_built():
+            self.run()
+        return self.filename
+
+
+def build_all(
+    *targets: Stage,
+    max_jobs: int = None,
+    memory_budget_gb: float = None,
+    processes: bool = False,
+) -> list[str]:
+    """
+    Builds the target stages and everything they depend on, running stages that do
+    not depend on each other concurrently. A stage is only started if its memory
+    estimate fits in what is left of the budget, unless nothing else is running.
+    :param targets: The stages to build.
+    :param max_jobs: The maximum number of stages running at the same time, defaults
+    to the number of CPUs.
+    :param memory_budget_gb: The total memory the running stages may use, in GB.
+    Defaults to CLEAN_MEMORY_GB, or unlimited.
+    :param processes: Whether to run the stages in separate processes instead of
+    threads. Polars releases the GIL, so threads are usually enough, but stages with
+    Python loops (time_window, link_rtm_mtps) run faster in separate processes.
+    :return: The filenames of the targets.
+    """
+    # The preview has to be active before the paths of the stages are made, and the
+    # workers are started
+    with preview.active():
+        # The stages in topological order, deduplicated by the artifact they make, as
+        # several stage objects can describe the same artifact
+        stages: dict[str, Stage] = {}
+
+        def visit(node: Stage | Source) -> None:
+            if isinstance(node, Source):
+                node.fingerprint()
+                return
+            for inp in node.inputs.values():
+                visit(inp)
+            stages.setdefault(node.path, node)
+
+        for target in targets:
+            visit(target)
+
+        # Group the stage records in the profile log (see profiling.py) by build
+        profiling.new_run()
+
+        done = {path for path, stage in stages.items() if stage.is_built()}
+        pending = [stage for path, stage in stages.items() if path not in done]
+        running: dict[Future, tuple[str, float]] = {}
+
+        if max_jobs is None:
+            max_jobs = os.cpu_count()
+        if memory_budget_gb is None:
+            memory_budget_gb = budget_gb() or math.inf
+        # Stages that work in blocks size them to their share of the budget, see
+        # memory.py, for as long as the build runs
+        share_gb = (
+            memory_budget_gb / max_jobs if math.isfinite(memory_budget_gb) else None
+        )
+
+        if processes:
+            # Forking a process that is running Polars' thread pool can deadlock
+            pool = ProcessPoolExecutor(max_jobs, mp_context=mp.get_context("spawn"))
+        else:
+            pool = ThreadPoolExecutor(max_jobs)
+
+        with stage_memory(share_gb), pool:
+            while pending or running:
+                for stage in list(pending):
+                    if len(running) >= max_jobs:
+                        break
+                    if any(
+                        isinstance(inp, Stage) and inp.path not in done
+                        for inp in stage.inputs.values()
+                    ):
+                        continue
+                    memory = stage.memory_estimate()
+                    in_use = sum(memory for _, memory in running.values())
+                    if running and in_use + memory > memory_budget_gb:
+                        continue
+                    pending.remove(stage)
+                    running[pool.submit(stage.run)] = (stage.path, memory)
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path, _ = running.pop(future)
+                    # Re-raises any exception from the stage
+                    future.result()
+                    done.add(path)
+
+        return [target.filename for target in targets]
+
+
+# The stages of the preprocessing chain, starting from the base data files. The stage
+# modules are imported when a stage is made, so importing the pipeline stays cheap
+
+
+def cleaned_gps_stage() -> Stage:
+    from .clean_gps import clean_gps
+
+    return Stage(
+        "gps",
+        "mtps",
+        clean_gps,
+        output="cleaned_file",
+        inputs={"filename": Source("mtps", "GPS_filter.csv")},
+    )
+
+
+def gps_stage() -> Stage:
+    from .preprocess_mtps import preprocess_mtps
+
+    return Stage(
+        "gps_preprocessed",
+        "mtps",
+        preprocess_mtps,
+        output="preprocessed_file",
+        inputs={"file": cleaned_gps_stage()},
+    )
+
+
+def train_stage(block_size: int = 10_000) -> Stage:
+    from .link_rtm_mtps import link_rtm_mtps
+
+    return Stage(
+        "train",
+        "rtm",
+        link_rtm_mtps,
+        output="linked_file",
+        inputs={"rtm_file": Source("rtm", "cleaned.pq"), "mtps_file": gps_stage()},
+        params={"block_size": block_size},
+        # Only one block is in memory at a time
+        memory_factor=1.0,
+    )
+
+
+def rtm_trips_stage(max_gap_s: float = 20, max_dist_m: float = 1_000) -> Stage:
+    # The trips of the RTM measurements without the MTPS data, instead of train_stage
+    from .rtm_trips import rtm_trips
+
+    return Stage(
+        "rtm_trips",
+        "rtm",
+        rtm_trips,
+        output="trips_file",
+        inputs={"rtm_file": Source("rtm", "cleaned.pq")},
+        params={"max_gap_s": max_gap_s, "max_dist_m": max_dist_m},
+    )
+
+
+def train_preprocessed_stage(window_dist: int = 10_000) -> Stage:
+    from .preprocess_rtm import preprocess_rtm
+
+    return Stage(
+        "train_preprocessed",
+        "rtm",
+        preprocess_rtm,
+        output="cleaned_file",
+        inputs={"filename": train_stage()},
+        params={"window_dist": window_dist},
+    )
+
+
+def rtm_index_stage(row_group_rows: int = 2**16) -> Stage:
+    # The preprocessed RTM data sorted by sensor and time, for lookups
+    from .rtm_index import index_rtm
+
+    return Stage(
+        "train_indexed",
+        "rtm",
+        index_rtm,
+        output="index_file",
+        inputs={"rtm_file": train_preprocessed_stage()},
+        params={"row_group_rows": row_group_rows},
+    )
+
+
+def sas_stage() -> Stage:
+    from .clean_sas import clean_sas
+
+    return Stage(
+        "avg_cleaned",
+        "sas",
+        clean_sas,
+        output="cleaned_file",
+        inputs={"filename": Source("sas", "voltage-avg-feb-april.pq")},
+    )
+
+
+def linked_stage(name: str, rtm: Stage, per_sensor: bool = None) -> Stage:
+    # Joining one sensor at a time needs far less memory, but is slower. Defaults to
+    # CLEAN_LINK_PER_SENSOR, see --per-sensor
+    from .link_rtm_sas import link_rtm_sas
+
+    if per_sensor is None:
+        per_sensor = os.environ.get("CLEAN_LINK_PER_SENSOR", "0") not in ("", "0")
+    return Stage(
+        name,
+        "samples",
+        link_rtm_sas,
+        output="linked_file",
+        inputs={"rtm_name": rtm, "sas_name": sas_stage()},
+        params={"per_sensor": per_sensor},
+        memory_factor=1.0 if per_sensor else 5.0,
+    )
+
+
+def time_window_stage(include_interpolated: bool = True) -> Stage:
+    from .time_window import time_window
+
+    return Stage(
+        "time_train_joined" if include_interpolated else "time_ni_train_joined",
+        "samples",
+        time_window,
+        output="out_file",
+        inputs={"name": linked_stage("train_joined", train_preprocessed_stage())},
+        params={"include_interpolated": include_interpolated},
+        memory_factor=20.0,
+    )
+
+
+def space_padded_stage(window_size_m: int = 5_000) -> Stage:
+    from .space_pad import space_window_pad
+    from .space_window import space_window
+
+    window = Stage(
+        "space_window",
+        "rtm",
+        space_window,
+        output="window_name",
+        inputs={
+            "train_name": train_stage(),
+            "preprocessed_train_name": train_preprocessed_stage(),
+        },
+        params={"window_size_m": window_size_m},
+        # See the note at the top of space_window.py
+        memory_factor=50.0,
+    )
+    return Stage(
+        "space_padded",
+        "samples",
+        space_window_pad,
+        output="out_name",
+        inputs={"joined_name": linked_stage("space_joined", window)},
+    )
+
+
+def kernels_stage(linked_name: str = "train_joined") -> Stage:
+    from .svd_kernels import add_kernels
+
+    return Stage(
+        "kernels",
+        "samples",
+        add_kernels,
+        output="out_file",
+        inputs={"sample": linked_stage(linked_name, train_preprocessed_stage())},
+    )
+
+
+def rollups_stage(resolutions: list[str] = None, bin_v: float = 1.0) -> Stage:
+    from .rollups import rollup
+
+    return Stage(
+        "rollups",
+        "samples",
+        rollup,
+        output="rollup_dir",
+        inputs={
+            "sas_file": sas_stage(),
+            "joined_file": linked_stage("train_joined", train_preprocessed_stage()),
+        },
+        params={"resolutions": resolutions, "bin_v": bin_v},
+        suffix=".rollups",
+        memory_factor=2.0,
+    )
+
+
+def splits_stage(
+    name: str,
+    sample: Stage,
+    input_columns: list[str | pl.Expr],
+    target_column: str = "sensor_voltage",
+    streaming: bool = False,
+) -> Stage:
+    return Stage(
+        with_suffix(name, ""),
+        "samples",
+        split_data,
+        output="split_file",
+        inputs={"file_name": sample},
+        params={
+            "input_columns": input_columns,
+            "target_column": target_column,
+            "streaming": streaming,
+        },
+        suffix=SPLIT_SUFFIXES[SPLIT_FORMAT],
+    )
+
+
+# The train/tune/test splits used by the models, see the get_*_splits functions
+
+BASE_COLUMNS = ["volt_1", "volt_2", "volt_7", "distance_to_sensor"]
+TIME_COLUMNS = [
+    *BASE_COLUMNS,
+    *[f"pre_{col}" for col in BASE_COLUMNS],
+    *[f"pos_{col}" for col in BASE_COLUMNS],
+]
+
+
+def base_splits_stage(name: str = "simple_splits.npz") -> Stage:
+    return splits_stage(
+        name,
+        linked_stage("train_joined", train_preprocessed_stage()),
+        input_columns=BASE_COLUMNS,
+    )
+
+
+def time_splits_stage(
+    name: str = "train_splits.npz", include_interpolated: bool = True
+) -> Stage:
+    return splits_stage(
+        name,
+        time_window_stage(include_interpolated),
+        input_columns=TIME_COLUMNS,
+    )
+
+
+def space_splits_stage(
+    name: str = "space_splits.npz", window_size_m: int = 5_000
+) -> Stage:
+    return splits_stage(
+        name,
+        space_padded_stage(window_size_m),
+        input_columns=[pl.exclude("sensor_voltage")],
+        # These samples are the largest, too large to split in memory at full scale
+        streaming=SPLIT_FORMAT == "npy",
+    )
+
+
+def kernel_splits_stage(
+    name: str = "kernel_splits.npz", original: str = "train_joined.pq"
+) -> Stage:
+    return splits_stage(
+        name,
+        kernels_stage(with_suffix(original, "")),
+        input_columns=[pl.exclude("sensor_voltage")],
+        # These samples are the largest, too large to split in memory at full scale
+        streaming=SPLIT_FORMAT == "npy",
+    )
+
+
+def build_all_splits(
+    max_jobs: int = None, memory_budget_gb: float = None, processes: bool = False
+) -> list[str]:
+    """
+    Builds the default variant of all four split sets, e.g. for a nightly retrain.
+    :param max_jobs: The maximum number of stages running at the same time.
+    :param memory_budget_gb: The total memory the running stages may use, in GB.
+    :param processes: Whether to run the stages in separate processes.
+    :return: The filenames of the split files.
+    """
+    return build_all(
+        base_splits_stage(),
+        time_splits_stage(),
+        space_splits_stage(),
+        kernel_splits_stage(),
+        max_jobs=max_jobs,
+        memory_budget_gb=memory_budget_gb,
+        processes=processes,
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build all train/tune/test splits")
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--memory-gb", type=float, default=None)
+    parser.add_argument("--processes", action="store_true")
+    parser.add_argument(
+        "--preview",
+        metavar="START..END[@SENSORS]",
+        help="Only build these days and sensors, e.g. 2024-02-01..2024-02-03@1,3",
+    )
+    parser.add_argument(
+        "--per-sensor",
+        action="store_true",
+        help="Link the RTM and SAS data one sensor at a time, with less memory",
+    )
+    args = parser.parse_args()
+
+    if args.preview:
+        os.environ["CLEAN_PREVIEW"] = args.preview
+    if args.per_sensor:
+        os.environ["CLEAN_LINK_PER_SENSOR"] = "1"
+
+    print(build_all_splits(args.jobs, args.memory_gb, args.processes))
@@ -1,8 +1,12 @@
 import polars as pl
 
+from .artifacts import scan_artifact, write_artifact
 from .constants import LAT_TO_KM, LON_TO_KM, data_dir, with_suffix
+from .profiling import profiled, record_plan
+from .sortedness import sort_metadata
 
 
+@profiled(inputs={"file": "mtps"}, outputs={"preprocessed_file": "mtps"})
 def preprocess_mtps(
     file: str,
     preprocessed_file: str = None,
@@ -51,8 +55,9 @@ def preprocess_mtps(
     with pl.StringCache():
         # Most of this code is identifying which measurements belong to the same train
         (
-            pl.scan_parquet(data_dir(f"mtps/{file}"))
-            .drop("null")
+            scan_artifact(data_dir(f"mtps/{file}"))
+            # Only present in some exports of the GPS data
+            .drop("null", strict=False)
             .filter(pl.col("train_nr").ne(0))
             .sort("train_nr", "mat_nr", "time")
             # We assume that successive measurements within 20m with the same
@@ -73,7 +78,7 @@ def preprocess_mtps(
             .rolling(
                 "time",
                 period=local_time_window,
-                offset="0",
+                offset="0s",
                 group_by="trip_id",
                 closed="left",
             )
@@ -114,10 +119,16 @@ def preprocess_mtps(
             )
             .with_columns(pl.col("trip_id").rle_id())
             .with_columns(trip_step=pl.col("time").rle_id().over("trip_id"))
-            .drop("trip_dur", "trip_dist", "speed")
+            .drop("trip_dur", "trip_dist", "speed", strict=False)
             .sort("trip_id", "time")
+            .pipe(record_plan)
             .collect()
-            .write_parquet(data_dir(f"mtps/{preprocessed_file}"), compression_level=10)
+            .pipe(
+                write_artifact,
+                data_dir(f"mtps/{preprocessed_file}"),
+                compression_level=10,
+                metadata=sort_metadata("trip_id", "time"),
+            )
         )
 
 
@@ -1,6 +1,9 @@
 import polars as pl
 
+from .artifacts import scan_artifact, write_artifact
 from .constants import LAT_TO_KM, LON_TO_KM, SENSOR_POSITIONS, data_dir, with_suffix
+from .profiling import profiled, record_plan
+from .sortedness import sort_metadata
 
 
 def is_min(num: int) -> pl.Expr:
@@ -11,24 +14,15 @@ def is_min(num: int) -> pl.Expr:
     )
 
 
-def preprocess_rtm(
-    filename: str, cleaned_file: str = None, window_dist: int = 10_000
-) -> None:
+def nearest_sensor(df: pl.LazyFrame) -> pl.LazyFrame:
     """
-    Takes the filename of an RTM dataset check which sensor is the closest
-
-    :param filename: A string containing the filename of the
-            RTM dataset without the extension.
-    :param cleaned_file: Destination filename for cleaned data
-    :param window_dist: Maximum distance a measurement can have to the closest sensor
-    :return: None, but makes a new parquet file.
+    Adds the closest sensor to every measurement, and the distance to it in metres.
+    Also used to make the features of live measurements, see serve.py.
+    :param df: The measurements, with 'lat' and 'lon' columns.
+    :return: The measurements with 'sensor' and 'distance_to_sensor' columns.
     """
-
-    if cleaned_file is None:
-        cleaned_file = with_suffix(filename, "_preprocessed.pq")
-    (
-        pl.scan_parquet(data_dir(f"rtm/{filename}"))
-        .with_columns(
+    return (
+        df.with_columns(
             [
                 (
                     (pl.col("lat").sub(s_lat).mul(LAT_TO_KM).pow(2))
@@ -39,15 +33,42 @@ def preprocess_rtm(
                 for i, (s_lat, s_lon) in enumerate(SENSOR_POSITIONS, start=1)
             ]
         )
-        # .drop("lat", "lon")
         .with_columns(min=pl.min_horizontal("^sensor.*$"))
         .with_columns([is_min(i) for i in range(1, 13)])
         .with_columns(sensor=pl.min_horizontal("^sensor.*$"))
         .drop([f"sensor{i}_distance" for i in range(1, 13)])
-        .filter(pl.col("min") <= window_dist)
         .rename({"min": "distance_to_sensor"})
+    )
+
+
+@profiled(inputs={"filename": "rtm"}, outputs={"cleaned_file": "rtm"})
+def preprocess_rtm(
+    filename: str, cleaned_file: str = None, window_dist: int = 10_000
+) -> None:
+    """
+    Takes the filename of an RTM dataset check which sensor is the closest
+
+    :param filename: A string containing the filename of the
+            RTM dataset without the extension.
+    :param cleaned_file: Destination filename for cleaned data
+    :param window_dist: Maximum distance a measurement can have to the closest sensor
+    :return: None, but makes a new parquet file.
+    """
+
+    if cleaned_file is None:
+        cleaned_file = with_suffix(filename, "_preprocessed.pq")
+    (
+        scan_artifact(data_dir(f"rtm/{filename}"))
+        .pipe(nearest_sensor)
+        .filter(pl.col("distance_to_sensor") <= window_dist)
         .sort("time")
-        .sink_parquet(data_dir(f"rtm/{cleaned_file}"), compression_level=10)
+        .pipe(record_plan)
+        .pipe(
+            write_artifact,
+            data_dir(f"rtm/{cleaned_file}"),
+            compression_level=10,
+            metadata=sort_metadata("time"),
+        )
     )
 
 
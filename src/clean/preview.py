@@ -0,0 +1,190 @@
+import json
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+import polars as pl
+
+from .constants import LAT_TO_KM, LON_TO_KM, SENSOR_POSITIONS, data_dir
+
+# A preview mode for iterating on the preprocessing chain, which restricts every stage
+# to the same subset of the data: a range of days, and optionally the surroundings of
+# some sensors. The base data files (see data/README.md) are filtered as they are
+# scanned, into a data directory of their own under data/preview, and the data
+# directory is then moved there (like CLEAN_DATA_DIR), so every stage, cache and
+# profile log of the preview is kept apart from the full data.
+# RTM and GPS records are kept within radius_m of a chosen sensor, so the trips and
+# the space window around the sensors are the same as in the full data: the default
+# is the 10km of preprocess_rtm plus the 5km of space_window.
+# Set CLEAN_PREVIEW to 'start..end' or 'start..end@sensor,sensor' (e.g.
+# '2024-02-01..2024-02-03@1,3') to preview every build, or see pipeline.py --preview.
+# The data directory is only moved while a build (or a get_* function) runs, see
+# active, so the rest of the process keeps using the data directory it was given.
+PREVIEW_DIR = "preview"
+PREVIEW_VARIABLES = ["CLEAN_DATA_DIR", "CLEAN_PREVIEW_BASE"]
+
+
+@dataclass(frozen=True)
+class Preview:
+    """
+    A subset of the base data, of the days from start up to (not including) end.
+    """
+
+    start: str
+    end: str
+    sensors: tuple[int, ...] = ()
+    radius_m: float = 15_000
+
+    @classmethod
+    def parse(cls, spec: str) -> "Preview":
+        """
+        :param spec: The days and sensors, as 'start..end' or 'start..end@1,3'.
+        :return: The preview.
+        """
+        days, _, sensors = spec.partition("@")
+        start, end = days.split("..")
+        return cls(start, end, tuple(int(s) for s in sensors.split(",") if s))
+
+    @classmethod
+    def from_env(cls) -> "Preview | None":
+        spec = os.environ.get("CLEAN_PREVIEW")
+        return cls.parse(spec) if spec else None
+
+    def in_range(self, time: pl.Expr) -> pl.Expr:
+        # The days are local days, like the times in all data files
+        start, end = (
+            pl.lit(day).str.to_datetime("%F").dt.replace_time_zone("Europe/Amsterdam")
+            for day in (self.start, self.end)
+        )
+        return time.ge(start) & time.lt(end)
+
+    def near_sensors(self, lat: pl.Expr, lon: pl.Expr) -> pl.Expr:
+        if not self.sensors:
+            return pl.lit(True)
+        return pl.min_horizontal(
+            lat.sub(s_lat)
+            .mul(LAT_TO_KM)
+            .pow(2)
+            .add(lon.sub(s_lon).mul(LON_TO_KM).pow(2))
+            for s_lat, s_lon in (SENSOR_POSITIONS[s - 1] for s in self.sensors)
+        ).le(self.radius_m**2)
+
+    def subset_rtm(self, source: str, target: str) -> None:
+        (
+            pl.scan_parquet(source)
+            .filter(
+                self.in_range(pl.col("time"))
+                & self.near_sensors(pl.col("lat"), pl.col("lon"))
+            )
+            .sink_parquet(target)
+        )
+
+    def subset_gps(self, source: str, target: str) -> None:
+        # The file is kept in the GPS_filter format, for clean_gps
+        (
+            pl.scan_csv(source, separator=";", infer_schema=False)
+            .filter(
+                self.in_range(
+                    pl.col("Tijdstip")
+                    .str.to_datetime("%F %T")
+                    .dt.replace_time_zone(
+                        "Europe/Amsterdam", ambiguous="earliest", non_existent="null"
+                    )
+                )
+                & self.near_sensors(
+                    *(
+                        pl.col(col).str.replace(",", ".").cast(pl.Float64)
+                        for col in ["Latitude", "Longitude"]
+                    )
+                )
+            )
+            .sink_csv(target, separator=";")
+        )
+
+    def subset_sas(self, source: str, target: str) -> None:
+        sensors = self.sensors or range(1, len(SENSOR_POSITIONS) + 1)
+        (
+            pl.scan_parquet(source)
+            .filter(
+                self.in_range(
+                    pl.from_epoch("t_max", time_unit="s")
+                    .cast(pl.Datetime)
+                    .dt.replace_time_zone("Europe/Amsterdam", non_existent="null")
+                )
+                & pl.any_horizontal(
+                    (pl.col("latitude") == s_lat) & (pl.col("longitude") == s_lon)
+                    for s_lat, s_lon in (SENSOR_POSITIONS[s - 1] for s in sensors)
+                )
+            )
+            .sink_parquet(target)
+        )
+
+    def activate(self) -> str:
+        """
+        Makes the subset of the base data files if it doesn't exist yet (or the base
+        files changed), and moves the data directory to it for this process and the
+        processes it starts, until it is moved back (see active).
+        :return: The data directory of the preview.
+        """
+        from .pipeline import fingerprint
+
+        # Activating twice (or in a worker) still subsets the full data
+        base = os.environ.get("CLEAN_PREVIEW_BASE") or data_dir("").rstrip("/\\")
+        directory = f"{base}/{PREVIEW_DIR}/{fingerprint(asdict(self))[:12]}"
+        subsets = {
+            "rtm/cleaned.pq": self.subset_rtm,
+            "mtps/GPS_filter.csv": self.subset_gps,
+            "sas/voltage-avg-feb-april.pq": self.subset_sas,
+        }
+
+        sources = {}
+        for file in subsets:
+            if not os.path.isfile(f"{base}/{file}"):
+                raise FileNotFoundError(f"Missing base data file {file}")
+            stat = os.stat(f"{base}/{file}")
+            sources[file] = fingerprint(file, stat.st_size, stat.st_mtime_ns)
+        manifest = {"preview": asdict(self), "sources": sources}
+
+        manifest_file = f"{directory}/preview.json"
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                built = json.load(f) == json.loads(json.dumps(manifest))
+        else:
+            built = False
+
+        if not built:
+            print(f"building preview {directory}")
+            # The stages write to the same subdirectories as in the full data
+            for entry in os.scandir(base):
+                if entry.is_dir() and entry.name != PREVIEW_DIR:
+                    os.makedirs(f"{directory}/{entry.name}", exist_ok=True)
+            for file, subset in subsets.items():
+                subset(f"{base}/{file}", f"{directory}/{file}")
+            with open(manifest_file, "w") as f:
+                json.dump(manifest, f, indent=2)
+
+        os.environ["CLEAN_PREVIEW_BASE"] = base
+        os.environ["CLEAN_DATA_DIR"] = directory
+        return directory
+
+
+@contextmanager
+def active() -> Iterator[str | None]:
+    """
+    Activates the preview set in CLEAN_PREVIEW (if any) within the context, for this
+    process and the processes it starts, and restores the data directory after. Used
+    by pipeline.build_all, and by the get_* functions to also load what they built
+    from the preview. Nested contexts use the same preview.
+    :return: The data directory of the preview, or None.
+    """
+    previous = {key: os.environ.get(key) for key in PREVIEW_VARIABLES}
+    preview = Preview.from_env()
+    try:
+        yield preview.activate() if preview else None
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
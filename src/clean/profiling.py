@@ -0,0 +1,249 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from datetime import datetime
+
+import polars as pl
+
+from .artifacts import scan_artifact
+from .constants import data_dir
+
+# Every stage appends a record with its wall time, CPU time, peak memory, rows and
+# bytes to a JSON-lines log, summarised with `python -m clean.profiling`.
+# The CPU time, memory and I/O counters are per process, so they are only recorded
+# for stages that ran alone in their process: a stage running at the same time as
+# another in a thread (see pipeline.build_all) would reset the peak memory of the
+# other, and count its reads and writes. Those records are marked 'concurrent'
+# instead; build with --processes for the numbers of every stage.
+PROFILE = os.environ.get("CLEAN_PROFILE", "1") not in ("", "0")
+# Whether to also record the optimized Polars query plan of each stage
+PROFILE_PLANS = os.environ.get("CLEAN_PROFILE_PLANS", "0") not in ("", "0")
+
+_current_record: contextvars.ContextVar[dict] = contextvars.ContextVar("record")
+_log_lock = threading.Lock()
+# The stages running in this process, and the number started so far
+_stages_lock = threading.Lock()
+_stages_running = 0
+_stages_started = 0
+
+
+def profile_log() -> str:
+    """
+    :return: The path to the profile log, CLEAN_PROFILE_LOG or data/profile.jsonl.
+    """
+    return os.environ.get("CLEAN_PROFILE_LOG") or data_dir("profile.jsonl")
+
+
+def new_run() -> str:
+    """
+    Starts a new profiling run, which groups the records in the summary. The run id is
+    stored in the environment, so that worker processes inherit it.
+    :return: The new run id.
+    """
+    run = f"{datetime.now():%Y-%m-%dT%H:%M:%S}-{uuid.uuid4().hex[:6]}"
+    os.environ["CLEAN_PROFILE_RUN"] = run
+    return run
+
+
+def current_run() -> str:
+    """
+    :return: The id of the current profiling run, starting one if needed.
+    """
+    return os.environ.get("CLEAN_PROFILE_RUN") or new_run()
+
+
+def count_rows(paths: list[str]) -> int | None:
+    """
+    Counts the rows of parquet and Arrow IPC files from their metadata.
+    :param paths: The paths to the files.
+    :return: The total number of rows, or None if none of the files are parquet or
+    IPC files.
+    """
+    counts = [
+        scan_artifact(path).select(pl.len()).collect().item()
+        for path in paths
+        if path.endswith((".pq", ".arrow")) and os.path.isfile(path)
+    ]
+    return sum(counts) if counts else None
+
+
+def _io_counters() -> tuple[int, int] | None:
+    # Bytes read and written by this process (including from the page cache),
+    # only available on Linux
+    try:
+        with open("/proc/self/io") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except OSError:
+        return None
+
+
+def _reset_peak_rss() -> bool:
+    # Resets the peak memory ('VmHWM') of this process, only available on Linux
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Peak of the whole process lifetime, in kB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def record_plan(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Adds the optimized query plan of a LazyFrame to the record of the running stage,
+    if PROFILE_PLANS is set. Meant to be used with .pipe() right before collecting.
+    :param lf: The query of the stage.
+    :return: The same LazyFrame.
+    """
+    record = _current_record.get(None)
+    if PROFILE_PLANS and record is not None:
+        record.setdefault("plans", []).append(lf.explain())
+    return lf
+
+
+def profiled(
+    inputs: dict[str, str] = None, outputs: dict[str, str] = None
+) -> Callable[[Callable], Callable]:
+    """
+    Decorates a stage function so that every call appends a record to the profile log.
+    :param inputs: The arguments that name input files, mapped to their directory
+    in data/ (used to count the rows read).
+    :param outputs: The arguments that name output files, mapped to their directory.
+    :return: The decorator.
+    """
+    inputs = inputs or {}
+    outputs = outputs or {}
+
+    def decorator(func: Callable) -> Callable:
+        signature = inspect.signature(func)
+
+        def paths(args: dict, files: dict[str, str]) -> list[str]:
+            return [
+                data_dir(f"{directory}/{args[arg]}".lstrip("/"))
+                for arg, directory in files.items()
+                if args.get(arg) is not None
+            ]
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Nested stage calls are part of the outer record
+            if not PROFILE or _current_record.get(None) is not None:
+                return func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            record = {
+                "run": current_run(),
+                "stage": f"{func.__module__}.{func.__qualname__}",
+                "started": datetime.now().isoformat(timespec="seconds"),
+                "pid": os.getpid(),
+                "rows_in": count_rows(paths(bound.arguments, inputs)),
+                "failed": True,
+            }
+            token = _current_record.set(record)
+
+            global _stages_running, _stages_started
+            with _stages_lock:
+                alone = _stages_running == 0
+                _stages_running += 1
+                _stages_started += 1
+                started = _stages_started
+                # Only reset while no other stage is running, as it resets theirs too
+                peak_reset = alone and _reset_peak_rss()
+            io_before = _io_counters()
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                result = func(*args, **kwargs)
+                record["failed"] = False
+                return result
+            finally:
+                record["wall_s"] = time.perf_counter() - wall
+                with _stages_lock:
+                    _stages_running -= 1
+                    alone = alone and _stages_started == started
+                record["concurrent"] = not alone
+                if alone:
+                    record["cpu_s"] = time.process_time() - cpu
+                    record["peak_rss_mb"] = _peak_rss_mb()
+                    record["peak_rss_is_lifetime"] = not peak_reset
+                    io_after = _io_counters()
+                    if io_before is not None and io_after is not None:
+                        record["bytes_read"] = io_after[0] - io_before[0]
+                        record["bytes_written"] = io_after[1] - io_before[1]
+                record["rows_out"] = count_rows(paths(bound.arguments, outputs))
+                _current_record.reset(token)
+
+                with _log_lock, open(profile_log(), "a") as file:
+                    file.write(json.dumps(record) + "\n")
+
+        return wrapper
+
+    return decorator
+
+
+def summary(run: str = None, top: int = 10) -> dict[str, pl.DataFrame]:
+    """
+    Summarises the profile log for one run.
+    :param run: The run id, defaults to the latest run in the log.
+    :param top: The number of stages to show per table.
+    :return: The slowest stages, and the most memory-hungry of those that ran alone
+    in their process.
+    """
+    records = pl.read_ndjson(profile_log(), infer_schema_length=None)
+    if run is None:
+        run = records.sort("started")["run"][-1]
+
+    if "concurrent" not in records.columns:
+        records = records.with_columns(concurrent=pl.lit(False))
+    stages = records.filter(pl.col("run").eq(run)).select(
+        "stage",
+        "started",
+        "failed",
+        "concurrent",
+        pl.col("wall_s", "cpu_s").round(2),
+        pl.col("peak_rss_mb").round(),
+        "rows_in",
+        "rows_out",
+    )
+    return {
+        "wall time": stages.sort("wall_s", descending=True).head(top),
+        # The peak memory of stages that ran concurrently isn't known
+        "peak memory": stages.drop_nulls("peak_rss_mb")
+        .sort("peak_rss_mb", descending=True)
+        .head(top),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarise the stage profile log")
+    parser.add_argument("--run", default=None, help="Run id, defaults to the latest")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    with pl.Config(tbl_rows=args.top, fmt_str_lengths=60, tbl_width_chars=160):
+        for title, table in summary(args.run, args.top).items():
+            print(f"Stages with the highest {title}:")
+            print(table)
@@ -0,0 +1,337 @@
+import json
+import os
+from collections.abc import Sequence
+
+import polars as pl
+
+from .artifacts import artifact_suffix, read_artifact, scan_artifact, write_artifact
+from .constants import data_dir
+from .profiling import profiled
+
+# Precomputed per-sensor aggregates of the SAS voltage and the linked RTM voltages,
+# for the distributions and statistics of the analysis notebooks (see sas_graphs.ipynb),
+# which would otherwise read the whole SAS and linked files for every graph.
+# For every sensor, measure and bucket of time, the rollups store the count, sum, sum
+# of squares, minimum and maximum ('stats'), and a histogram of the values in bins of
+# bin_v volts ('hist'), which is the quantile sketch: any grouping of buckets merges
+# into a histogram that gives its quantiles to within half a bin. Both merge by
+# summing, so every resolution is made from the previous (finer) one, and queries
+# merge the buckets they need. A bucket of a resolution has to be made of whole
+# buckets of the previous one (e.g. '15m', '1h', '1d').
+# The rollups are a directory of small files, with a rollups.json manifest. Queries
+# filter and group the buckets (by sensor, or by expressions of the bucket 'time'
+# like the hour of day), on tables that are kept in memory once read.
+RESOLUTIONS = ["1h", "1d"]
+MEASURES = {
+    "sas": ["sensor_voltage"],
+    "joined": ["sensor_voltage", "volt_1", "volt_2", "volt_7"],
+}
+BIN_V = 1.0
+MANIFEST = "rollups.json"
+
+
+def measure_values(lf: pl.LazyFrame, source: str) -> pl.LazyFrame:
+    """
+    :param lf: The SAS or linked data.
+    :param source: The key of the data in MEASURES.
+    :return: A row per value of every measure, with its 'sensor', 'time', 'measure'
+    (like 'sas.sensor_voltage') and 'value'.
+    """
+    return lf.select(
+        pl.col("sensor").cast(pl.Int32),
+        "time",
+        *(
+            pl.col(col).cast(pl.Float64).alias(f"{source}.{col}")
+            for col in MEASURES[source]
+        ),
+    ).unpivot(index=["sensor", "time"], variable_name="measure", value_name="value")
+
+
+def bucket_stats(
+    values: pl.LazyFrame, every: str, bin_v: float
+) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+    """
+    Aggregates the values of every sensor and measure per bucket of time.
+    :param values: The values, see measure_values.
+    :param every: The length of a bucket, e.g. '1h'.
+    :param bin_v: The width of a histogram bin, in volts.
+    :return: The 'stats' and 'hist' of the buckets.
+    """
+    values = values.drop_nulls("value").with_columns(pl.col("time").dt.truncate(every))
+    keys = ["measure", "sensor", "time"]
+    stats = values.group_by(keys).agg(
+        count=pl.len().cast(pl.UInt64),
+        sum=pl.col("value").sum(),
+        sum_sq=pl.col("value").pow(2).sum(),
+        min=pl.col("value").min(),
+        max=pl.col("value").max(),
+    )
+    hist = values.group_by(
+        *keys, bin=pl.col("value").truediv(bin_v).round().mul(bin_v)
+    ).agg(count=pl.len().cast(pl.UInt64))
+    return stats, hist
+
+
+def merge_buckets(
+    stats: pl.LazyFrame, hist: pl.LazyFrame, every: str
+) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+    """
+    Merges the buckets of a rollup into longer ones.
+    :param stats: The 'stats' of the shorter buckets.
+    :param hist: The 'hist' of the shorter buckets.
+    :param every: The length of the longer buckets, a multiple of the shorter.
+    :return: The 'stats' and 'hist' of the longer buckets.
+    """
+    keys = ["measure", "sensor", pl.col("time").dt.truncate(every)]
+    return (
+        stats.group_by(keys).agg(
+            pl.col("count", "sum", "sum_sq").sum(),
+            pl.col("min").min(),
+            pl.col("max").max(),
+        ),
+        hist.group_by(*keys, "bin").agg(pl.col("count").sum()),
+    )
+
+
+@profiled(
+    inputs={"sas_file": "sas", "joined_file": "samples"},
+    outputs={"rollup_dir": "samples"},
+)
+def rollup(
+    sas_file: str,
+    joined_file: str,
+    rollup_dir: str,
+    resolutions: Sequence[str] = None,
+    bin_v: float = BIN_V,
+) -> None:
+    """
+    Makes the per-sensor rollups of the cleaned SAS data and the linked RTM data.
+    :param sas_file: The cleaned SAS file in data/sas, see clean_sas.py.
+    :param joined_file: The linked file in data/samples, see link_rtm_sas.py.
+    :param rollup_dir: The output directory in data/samples.
+    :param resolutions: The lengths of the buckets, from short to long, each made of
+    whole buckets of the one before, defaults to RESOLUTIONS.
+    :param bin_v: The width of a histogram bin, in volts.
+    :return: None, but makes a directory with a stats and hist file per resolution.
+    """
+    if resolutions is None:
+        resolutions = RESOLUTIONS
+
+    directory = data_dir(f"samples/{rollup_dir}")
+    os.makedirs(directory, exist_ok=True)
+    values = pl.concat(
+        [
+            measure_values(scan_artifact(data_dir(f"sas/{sas_file}")), "sas"),
+            measure_values(scan_artifact(data_dir(f"samples/{joined_file}")), "joined"),
+        ]
+    )
+
+    files = {}
+    stats, hist = bucket_stats(values, resolutions[0], bin_v)
+    for i, every in enumerate(resolutions):
+        if i:
+            stats, hist = merge_buckets(stats, hist, every)
+        for kind, table in [("stats", stats), ("hist", hist)]:
+            file = f"{kind}_{every}{artifact_suffix()}"
+            table = table.sort("measure", "sensor", "time")
+            table.collect().pipe(write_artifact, f"{directory}/{file}")
+            files[f"{kind}_{every}"] = file
+        # The next resolution is made from this one's files
+        stats, hist = (
+            scan_artifact(f"{directory}/{files[f'{kind}_{every}']}")
+            for kind in ["stats", "hist"]
+        )
+
+    with open(f"{directory}/{MANIFEST}", "w") as f:
+        json.dump(
+            {
+                "resolutions": list(resolutions),
+                "measures": [
+                    f"{s}.{col}" for s, cols in MEASURES.items() for col in cols
+                ],
+                "bin_v": bin_v,
+                "files": files,
+            },
+            f,
+            indent=2,
+        )
+
+
+class Rollups:
+    """
+    Answers questions about the distribution of the measures per sensor and period of
+    time from the rollups, see rollup. Every query takes the measure (e.g.
+    'sas.sensor_voltage'), the groups to aggregate over (names or expressions of the
+    'sensor' and bucket 'time' columns), the resolution and which sensors and buckets
+    to include. Start and end select the buckets that start in that range.
+    """
+
+    def __init__(self, rollup_dir: str):
+        """
+        :param rollup_dir: The rollup directory in data/samples.
+        """
+        self.directory = data_dir(f"samples/{rollup_dir}")
+        with open(f"{self.directory}/{MANIFEST}") as f:
+            manifest = json.load(f)
+        self.resolutions: list[str] = manifest["resolutions"]
+        self.measures: list[str] = manifest["measures"]
+        self.bin_v: float = manifest["bin_v"]
+        self._files: dict[str, str] = manifest["files"]
+        self._tables: dict[str, pl.DataFrame] = {}
+
+    def table(self, kind: str, every: str = None) -> pl.DataFrame:
+        """
+        :param kind: 'stats' or 'hist'.
+        :param every: The resolution, defaults to the shortest.
+        :return: The rollup table, read on first use.
+        """
+        key = f"{kind}_{every or self.resolutions[0]}"
+        if key not in self._files:
+            raise ValueError(f"No {kind} rollup at {every}, only {self.resolutions}")
+        if key not in self._tables:
+            self._tables[key] = read_artifact(f"{self.directory}/{self._files[key]}")
+        return self._tables[key]
+
+    def _select(
+        self,
+        kind: str,
+        measure: str,
+        by: Sequence[str | pl.Expr],
+        every: str,
+        sensors: Sequence[int],
+        start: object,
+        end: object,
+    ) -> tuple[pl.LazyFrame, list[str]]:
+        if measure not in self.measures:
+            raise ValueError(
+                f"Unknown measure {measure}, expected one of {self.measures}"
+            )
+        table = self.table(kind, every).lazy().filter(pl.col("measure").eq(measure))
+        if sensors is not None:
+            table = table.filter(pl.col("sensor").is_in(sensors))
+        if start is not None:
+            table = table.filter(pl.col("time").ge(start))
+        if end is not None:
+            table = table.filter(pl.col("time").lt(end))
+
+        # Without groups, all selected buckets are merged into one
+        by = [pl.col(key) if isinstance(key, str) else key for key in by] or [
+            pl.lit(measure).alias("measure")
+        ]
+        keys = [key.meta.output_name() for key in by]
+        return table.with_columns(by), keys
+
+    def summary(
+        self,
+        measure: str,
+        by: Sequence[str | pl.Expr] = ("sensor",),
+        every: str = None,
+        sensors: Sequence[int] = None,
+        start: object = None,
+        end: object = None,
+    ) -> pl.DataFrame:
+        """
+        :return: The count, mean, standard deviation, minimum and maximum of the
+        measure per group, see Rollups.
+        """
+        table, keys = self._select("stats", measure, by, every, sensors, start, end)
+        return (
+            table.group_by(keys)
+            .agg(
+                pl.col("count", "sum", "sum_sq").sum(),
+                pl.col("min").min(),
+                pl.col("max").max(),
+            )
+            .select(
+                *keys,
+                "count",
+                mean=pl.col("sum") / pl.col("count"),
+                std=(
+                    (pl.col("sum_sq") - pl.col("sum").pow(2) / pl.col("count"))
+                    / (pl.col("count") - 1)
+                )
+                .clip(0)
+                .sqrt(),
+                min="min",
+                max="max",
+            )
+            .sort(keys)
+            .collect()
+        )
+
+    def histogram(
+        self,
+        measure: str,
+        by: Sequence[str | pl.Expr] = (),
+        every: str = None,
+        sensors: Sequence[int] = None,
+        start: object = None,
+        end: object = None,
+    ) -> pl.DataFrame:
+        """
+        :return: The number of values in every bin of the measure per group, and the
+        fraction of the group's values in it ('frequency'), see Rollups.
+        """
+        table, keys = self._select("hist", measure, by, every, sensors, start, end)
+        return (
+            table.group_by(*keys, "bin")
+            .agg(pl.col("count").sum())
+            .with_columns(frequency=pl.col("count") / pl.col("count").sum().over(keys))
+            .sort(*keys, "bin")
+            .collect()
+        )
+
+    def quantiles(
+        self,
+        measure: str,
+        qs: Sequence[float] = (0.0, 0.5, 0.95, 0.99, 1.0),
+        by: Sequence[str | pl.Expr] = ("sensor",),
+        every: str = None,
+        sensors: Sequence[int] = None,
+        start: object = None,
+        end: object = None,
+    ) -> pl.DataFrame:
+        """
+        :param qs: The quantiles, between 0 and 1.
+        :return: The quantiles of the measure per group (as columns like 'q95'), to
+        within half a histogram bin, see Rollups.
+        """
+        hist = self.histogram(measure, by, every, sensors, start, end)
+        keys = hist.columns[: hist.columns.index("bin")]
+        return (
+            hist.lazy()
+            .with_columns(rank=pl.col("frequency").cum_sum().over(keys))
+            .group_by(keys)
+            .agg(
+                pl.col("bin")
+                # Rounding errors could leave the last rank just under 1
+                .filter(pl.col("rank").ge(min(q, 1 - 1e-9)))
+                .first()
+                .alias(f"q{q * 100:g}")
+                for q in qs
+            )
+            .sort(keys)
+            .collect()
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from . import preview
+    from .pipeline import build_all, rollups_stage
+
+    parser = argparse.ArgumentParser(description="Summarise a measure per sensor")
+    parser.add_argument("measure", nargs="?", default="sas.sensor_voltage")
+    parser.add_argument("--every", default=None, help="The resolution to query")
+    parser.add_argument(
+        "--hour", action="store_true", help="Group by hour of day instead of sensor"
+    )
+    args = parser.parse_args()
+
+    with preview.active():
+        (rollup_dir,) = build_all(rollups_stage())
+        rollups = Rollups(rollup_dir)
+    by = [pl.col("time").dt.hour().alias("hour")] if args.hour else ["sensor"]
+    print(rollups.summary(args.measure, by, args.every))
+    print(rollups.quantiles(args.measure, by=by, every=args.every))
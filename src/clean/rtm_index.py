@@ -0,0 +1,176 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import polars as pl
+
+from .artifacts import read_artifact, scan_artifact, write_artifact
+from .constants import data_dir, with_suffix
+from .profiling import profiled
+from .sortedness import scan_sorted, sort_metadata
+
+# An index over the preprocessed (linked) RTM measurements, to find every measurement
+# near a sensor in a span of time without scanning the whole file, e.g. when
+# investigating an incident. The measurements are stored sorted by (sensor, time), so
+# those of a sensor in any span of time are one contiguous range of rows. A sidecar
+# file holds the first row and number of rows of every sensor and hour, from which a
+# query finds its range of rows. Polars pushes the slice of that range into the scan,
+# so only the row groups overlapping it are read (or, for an IPC artifact, only its
+# pages of the memory-mapped file are touched).
+# Smaller row groups read less around the range, but compress worse.
+ROW_GROUP_ROWS = 2**16
+TIME_ZONE = ZoneInfo("Europe/Amsterdam")
+
+
+def hours_file(index_file: str) -> str:
+    """
+    :param index_file: The index file.
+    :return: The name of its sidecar with the rows of every sensor and hour.
+    """
+    return with_suffix(index_file, ".hours." + index_file.rsplit(".", maxsplit=1)[1])
+
+
+@profiled(inputs={"rtm_file": "rtm"}, outputs={"index_file": "rtm"})
+def index_rtm(
+    rtm_file: str, index_file: str = None, row_group_rows: int = ROW_GROUP_ROWS
+) -> None:
+    """
+    Makes the sensor and time index of preprocessed RTM data.
+    :param rtm_file: The preprocessed RTM file in data/rtm, see preprocess_rtm.py.
+    :param index_file: The output file in data/rtm.
+    :param row_group_rows: The rows per row group of the output.
+    :return: None, but makes a new file sorted by sensor and time, and its sidecar.
+    """
+    if index_file is None:
+        index_file = with_suffix(rtm_file, "_indexed.pq")
+
+    df = (
+        scan_sorted(f"rtm/{rtm_file}", "time")
+        # The sort is stable, so the rows of a sensor stay in time order
+        .sort("sensor", maintain_order=True)
+        .collect()
+    )
+    hours = (
+        df.lazy()
+        .select("sensor", "time")
+        .with_row_index("offset")
+        .group_by("sensor", hour=pl.col("time").dt.truncate("1h"))
+        .agg(pl.col("offset").min(), rows=pl.len().cast(pl.UInt32))
+        .with_columns(
+            first_group=pl.col("offset") // row_group_rows,
+            last_group=(pl.col("offset") + pl.col("rows") - 1) // row_group_rows,
+        )
+        .sort("sensor", "hour")
+        .collect()
+    )
+
+    hours.pipe(write_artifact, data_dir(f"rtm/{hours_file(index_file)}"))
+    df.pipe(
+        write_artifact,
+        data_dir(f"rtm/{index_file}"),
+        metadata=sort_metadata("sensor", "time"),
+        row_group_size=row_group_rows,
+    )
+
+
+def local_time(time: str | datetime) -> datetime:
+    """
+    :param time: A time, as a datetime or ISO 8601 string, in local time if it has no
+    time zone (like all data files).
+    :return: The time, with a time zone.
+    """
+    if isinstance(time, str):
+        time = datetime.fromisoformat(time)
+    return time if time.tzinfo else time.replace(tzinfo=TIME_ZONE)
+
+
+class RtmIndex:
+    """
+    Finds the RTM measurements near a sensor in a span of time, see index_rtm.
+    """
+
+    def __init__(self, index_file: str):
+        """
+        :param index_file: The index file in data/rtm.
+        """
+        self.path = data_dir(f"rtm/{index_file}")
+        self.hours = read_artifact(data_dir(f"rtm/{hours_file(index_file)}"))
+
+    def rows(
+        self, sensor: int, start: str | datetime, end: str | datetime
+    ) -> tuple[int, int]:
+        """
+        :param sensor: The sensor.
+        :param start: The start of the span of time.
+        :param end: The end of the span of time (not included).
+        :return: The range of rows holding the measurements near the sensor in the
+        hours overlapping the span, as the first row and the row after the last.
+        """
+        start, end = local_time(start), local_time(end)
+        hours = self.hours.filter(
+            pl.col("sensor").eq(sensor)
+            & pl.col("hour").add(pl.duration(hours=1)).gt(start)
+            & pl.col("hour").lt(end)
+        )
+        if hours.is_empty():
+            return 0, 0
+        return hours["offset"].min(), (hours["offset"] + hours["rows"]).max()
+
+    def query(
+        self,
+        sensor: int,
+        start: str | datetime,
+        end: str | datetime,
+        columns: list[str] = None,
+        max_distance_m: float = None,
+    ) -> pl.DataFrame:
+        """
+        Reads the measurements near a sensor in a span of time, reading only the row
+        groups of the index holding them.
+        :param sensor: The sensor the measurements are closest to.
+        :param start: The start of the span of time, see local_time.
+        :param end: The end of the span of time (not included).
+        :param columns: The columns to read, defaults to all.
+        :param max_distance_m: The largest distance to the sensor, defaults to all
+        measurements in the index (within the window_dist of preprocess_rtm).
+        :return: The measurements, sorted by time.
+        """
+        start, end = local_time(start), local_time(end)
+        first, stop = self.rows(sensor, start, end)
+        lf = (
+            scan_artifact(self.path)
+            .slice(first, stop - first)
+            .filter(pl.col("time").is_between(start, end, closed="left"))
+        )
+        if max_distance_m is not None:
+            lf = lf.filter(pl.col("distance_to_sensor").le(max_distance_m))
+        if columns is not None:
+            lf = lf.select(columns)
+        return lf.collect()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from . import preview
+    from .pipeline import build_all, rtm_index_stage
+
+    parser = argparse.ArgumentParser(
+        description="Find the RTM measurements near a sensor in a span of time"
+    )
+    parser.add_argument("sensor", type=int)
+    parser.add_argument("start", help="e.g. 2024-02-01T08:00")
+    parser.add_argument("end", help="e.g. 2024-02-01T09:00")
+    parser.add_argument("--max-distance-m", type=float, default=None)
+    args = parser.parse_args()
+
+    with preview.active():
+        (index_file,) = build_all(rtm_index_stage())
+        index = RtmIndex(index_file)
+    print(
+        index.query(
+            args.sensor,
+            args.start,
+            args.end,
+            max_distance_m=args.max_distance_m,
+        )
+    )
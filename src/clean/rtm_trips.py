@@ -0,0 +1,194 @@
+import numpy as np
+import polars as pl
+from tqdm import tqdm
+
+from .artifacts import write_artifact
+from .constants import LAT_TO_KM, LON_TO_KM, data_dir, with_suffix
+from .profiling import profiled
+from .sortedness import scan_sorted, sort_metadata
+
+# Identifies the trips of the RTM measurements without the MTPS data, for when the
+# GPS records of a fleet are missing (see non_mtps_trips.ipynb for the prototype).
+# Nearby measurements are probably from the same train, so every measurement is
+# linked to its closest successor within max_gap_s and max_dist_m, by the distance of
+# link_rtm_mtps.py (the distance in space, plus the distance two trains would drift
+# apart in the time between them). A measurement only keeps the closest of the links
+# to it, so the links form chains, and the connected components of the links (with a
+# vectorized union-find) are the trips.
+# The candidate pairs come from a sweep over the measurements sorted by time, one
+# block of time at a time: the measurements are put in buckets of max_gap_s seconds
+# and max_dist_m metres, and only compared to those in the same and neighbouring
+# buckets. Apart from the sort, this is linear in the number of measurements, as long
+# as the number of trains close to each other is bounded.
+
+
+def connected_components(u: np.ndarray, v: np.ndarray, n: int) -> np.ndarray:
+    """
+    Labels the connected components of a graph, with a union-find over all edges at
+    once: every round the root of each edge's endpoints is hooked onto the smaller
+    of the two roots, and the paths to the roots are compressed by pointer jumping.
+    The number of trees at least halves every round.
+    :param u: The first vertex of every edge.
+    :param v: The second vertex of every edge.
+    :param n: The number of vertices.
+    :return: The component of every vertex, as its smallest vertex.
+    """
+    parent = np.arange(n)
+    while len(u):
+        root_u, root_v = parent[u], parent[v]
+        # Edges within one tree stay within it, so they are dropped
+        crossing = root_u != root_v
+        u, v = u[crossing], v[crossing]
+        root_u, root_v = root_u[crossing], root_v[crossing]
+        np.minimum.at(parent, np.maximum(root_u, root_v), np.minimum(root_u, root_v))
+        while not np.array_equal(grandparent := parent[parent], parent):
+            parent = grandparent
+    return parent
+
+
+def candidate_links(
+    points: pl.DataFrame, max_gap_s: float, max_dist_m: float, speed_ms: float
+) -> pl.DataFrame:
+    """
+    Finds the closest successor of every measurement, among the measurements in the
+    same or neighbouring buckets.
+    :param points: The measurements, sorted by time, with an 'id', the time 't' in
+    seconds, the position 'x' and 'y' in metres and the bucket 'bucket_t',
+    'bucket_x' and 'bucket_y'.
+    :param max_gap_s: The most seconds between linked measurements.
+    :param max_dist_m: The largest distance between linked measurements.
+    :param speed_ms: The speed trains are assumed to drift apart at.
+    :return: The 'id' and 'next' id of the links, with their 'cost'.
+    """
+    offsets = pl.DataFrame(
+        {
+            "dt": np.repeat([0, 1], 9),
+            "dx": np.tile(np.repeat([-1, 0, 1], 3), 2),
+            "dy": np.tile([-1, 0, 1], 6),
+        }
+    )
+    return (
+        points.lazy()
+        .join(offsets.lazy(), how="cross")
+        .with_columns(
+            pl.col("bucket_t") + pl.col("dt"),
+            pl.col("bucket_x") + pl.col("dx"),
+            pl.col("bucket_y") + pl.col("dy"),
+        )
+        .join(
+            points.lazy(),
+            on=["bucket_t", "bucket_x", "bucket_y"],
+            suffix="_next",
+        )
+        .filter(
+            pl.col("id_next").gt(pl.col("id"))
+            & pl.col("t_next").sub(pl.col("t")).le(max_gap_s)
+        )
+        .select(
+            "id",
+            next="id_next",
+            distance=(
+                (pl.col("x_next") - pl.col("x")).pow(2)
+                + (pl.col("y_next") - pl.col("y")).pow(2)
+            ).sqrt(),
+            drift=(pl.col("t_next") - pl.col("t")).mul(speed_ms),
+        )
+        .filter(pl.col("distance").le(max_dist_m))
+        .with_columns(cost=pl.col("distance") + pl.col("drift"))
+        .sort("cost", "next")
+        .unique("id", keep="first")
+        .select("id", "next", "cost")
+        .collect()
+    )
+
+
+@profiled(inputs={"rtm_file": "rtm"}, outputs={"trips_file": "rtm"})
+def rtm_trips(
+    rtm_file: str,
+    trips_file: str = None,
+    max_gap_s: float = 20,
+    max_dist_m: float = 1_000,
+    speed_kmh: float = 70,
+    min_count: int = 10,
+    block_s: int = 3_600,
+) -> None:
+    """
+    Identifies the trips of cleaned RTM measurements without the MTPS data, like
+    link_rtm_mtps.py does with it.
+    :param rtm_file: The cleaned RTM file in data/rtm, see clean_rtm.py.
+    :param trips_file: The output file in data/rtm.
+    :param max_gap_s: The most seconds between successive measurements of a trip.
+    :param max_dist_m: The largest distance between successive measurements of a trip.
+    :param speed_kmh: The speed trains are assumed to drift apart at, which makes
+    measurements further apart in time count as further away.
+    :param min_count: The fewest measurements a trip needs to be kept.
+    :param block_s: The seconds of measurements compared at once, which bounds the
+    memory use of the candidate pairs.
+    :return: None, but makes a new parquet file of the measurements with a 'trip_id'
+    and 'trip_step', sorted by both.
+    """
+    if trips_file is None:
+        trips_file = with_suffix(rtm_file, "_trips.pq")
+
+    df = scan_sorted(f"rtm/{rtm_file}", "time").collect()
+    points = df.select(
+        id=pl.int_range(pl.len(), dtype=pl.UInt32),
+        t=pl.col("time").dt.epoch("ms") / 1_000,
+        x=pl.col("lat") * LAT_TO_KM,
+        y=pl.col("lon") * LON_TO_KM,
+    ).with_columns(
+        bucket_t=(pl.col("t") // max_gap_s).cast(pl.Int64),
+        bucket_x=(pl.col("x") // max_dist_m).cast(pl.Int64),
+        bucket_y=(pl.col("y") // max_dist_m).cast(pl.Int64),
+    )
+
+    # Every block is compared with the max_gap_s after it, so the successors of its
+    # last measurements are found too
+    t = points["t"]
+    links = []
+    for start in tqdm(np.arange(t[0], t[-1] + block_s, block_s) if len(t) else []):
+        first, last, end = t.search_sorted(
+            [start, start + block_s, start + block_s + max_gap_s]
+        )
+        if first == last:
+            continue
+        block = points.slice(first, end - first)
+        links.append(
+            candidate_links(block, max_gap_s, max_dist_m, speed_kmh / 3.6).filter(
+                pl.col("id") < last
+            )
+        )
+
+    # A measurement keeps the closest of the links to it
+    edges = (
+        pl.concat(links)
+        .sort("cost", "id")
+        .unique("next", keep="first")
+        .select("id", "next")
+        if links
+        else pl.DataFrame(schema={"id": pl.UInt32, "next": pl.UInt32})
+    )
+    components = connected_components(
+        edges["id"].to_numpy(), edges["next"].to_numpy(), len(df)
+    )
+
+    (
+        df.lazy()
+        .with_columns(trip_id=pl.Series(components))
+        .filter(pl.col("time").count().over("trip_id").ge(min_count))
+        # The components are labelled by their first measurement, so in time order
+        .with_columns(pl.col("trip_id").rank("dense").cast(pl.UInt32) - 1)
+        .with_columns(trip_step=pl.col("time").rle_id().over("trip_id"))
+        .sort("trip_id", "time")
+        .collect()
+        .pipe(
+            write_artifact,
+            data_dir(f"rtm/{trips_file}"),
+            compression_level=10,
+            metadata=sort_metadata("trip_id", "time"),
+        )
+    )
+
+
+if __name__ == "__main__":
+    rtm_trips("cleaned.pq")
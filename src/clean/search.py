@@ -0,0 +1,184 @@
+import multiprocessing as mp
+import os
+import traceback
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+import keras
+import keras_tuner
+import numpy as np
+
+from .create_splits import load_splits
+
+# Runs the trials of a keras_tuner search in a pool of worker processes, instead of
+# one after the other. The tuner's oracle stays in this process and keeps its state
+# in the tuner's directory as usual, so a search can be resumed, or inspected with
+# the tuner. The workers memory-map the same .npy split files (see create_splits.py),
+# so the data is in memory once, however many workers there are.
+# Keras and keras_tuner are only needed for this module, so `import clean` doesn't
+# import them.
+
+
+def _cpus() -> list[int]:
+    # The CPUs this process may run on, or all of them where that can't be set
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def _init_worker(threads: int, started: "mp.sharedctypes.Synchronized") -> None:
+    # Every worker trains one small model, so a few threads per worker (and more
+    # workers) keep more cores busy than one process with many threads. JAX has no
+    # setting for its number of threads, but sizes its thread pools to the CPUs the
+    # process may run on, so every worker is pinned to its own `threads` CPUs. Where
+    # that isn't possible (macOS), the workers only train single-threaded
+    with started.get_lock():
+        index = started.value
+        started.value += 1
+    if hasattr(os, "sched_setaffinity"):
+        cpus = _cpus()
+        first = index * threads
+        os.sched_setaffinity(
+            0, {cpus[(first + i) % len(cpus)] for i in range(min(threads, len(cpus)))}
+        )
+    else:
+        threads = 1
+    if threads == 1:
+        os.environ["XLA_FLAGS"] = (
+            os.environ.get("XLA_FLAGS", "") + " --xla_cpu_multi_thread_eigen=false"
+        )
+    for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[var] = str(threads)
+
+
+def run_trial(
+    build_model: Callable[[keras_tuner.HyperParameters], keras.Model],
+    hyperparameters: dict,
+    split_file: str,
+    objective: str,
+    direction: str,
+    executions: int = 1,
+    fit_kwargs: dict = None,
+    transform: Callable[[np.ndarray], np.ndarray] = None,
+) -> float:
+    """
+    Trains the model of one trial on the train split and scores it on the tune split,
+    like keras_tuner's Tuner.run_trial. Runs in a worker process.
+    :param build_model: The model building function of the search.
+    :param hyperparameters: The config of the trial's hyperparameters.
+    :param split_file: The name of the splits, see create_splits.load_splits.
+    :param objective: The name of the metric to optimise, e.g. 'val_loss'.
+    :param direction: Whether the objective should be 'min'imised or 'max'imised.
+    :param executions: The number of models to train, averaging their scores.
+    :param fit_kwargs: Extra keyword arguments for model.fit, e.g. epochs.
+    :param transform: A function applied to the input splits, e.g. to reshape them.
+    :return: The average over the executions of the best epoch's objective.
+    """
+    splits = load_splits(split_file)
+    i_train, i_tune = splits["i_train"], splits["i_tune"]
+    if transform is not None:
+        i_train, i_tune = transform(i_train), transform(i_tune)
+
+    hp = keras_tuner.HyperParameters.from_config(hyperparameters)
+    best = np.min if direction == "min" else np.max
+    scores = []
+    for _ in range(executions):
+        model = build_model(hp)
+        history = model.fit(
+            i_train,
+            splits["t_train"],
+            validation_data=(i_tune, splits["t_tune"]),
+            verbose=0,
+            **(fit_kwargs or {}),
+        )
+        scores.append(best(history.history[objective]))
+    return float(np.mean(scores))
+
+
+def parallel_search(
+    tuner: keras_tuner.Tuner,
+    split_file: str,
+    workers: int = None,
+    threads_per_worker: int = 1,
+    fit_kwargs: dict = None,
+    transform: Callable[[np.ndarray], np.ndarray] = None,
+) -> keras_tuner.HyperParameters:
+    """
+    Runs the search of a tuner with its trials spread over worker processes.
+    The workers are started fresh (not forked), so the tuner's model building
+    function, and the transform, need to be importable from a module rather than
+    defined in a notebook.
+    :param tuner: The tuner, whose oracle proposes the trials and keeps the results.
+    :param split_file: The name of the splits, as returned by the pipeline (see
+    pipeline.py), preferably in the memory-mapped .npy format.
+    :param workers: The number of worker processes, defaults to the number of CPUs
+    divided by threads_per_worker.
+    :param threads_per_worker: The number of CPUs each worker is pinned to and trains
+    with (on Linux, elsewhere workers are single-threaded).
+    :param fit_kwargs: Extra keyword arguments for model.fit, e.g. epochs and
+    batch_size. Callbacks need to be picklable.
+    :param transform: A function applied to the input splits, e.g. to reshape them.
+    :return: The best hyperparameters found.
+    """
+    if workers is None:
+        workers = max(1, len(_cpus()) // threads_per_worker)
+
+    oracle = tuner.oracle
+    objective = oracle.objective
+    build_model = tuner.hypermodel.build
+
+    context = mp.get_context("spawn")
+    pool = ProcessPoolExecutor(
+        workers,
+        mp_context=context,
+        initializer=_init_worker,
+        # Counts the started workers, so each is pinned to different CPUs
+        initargs=(threads_per_worker, context.Value("i", 0)),
+    )
+    # Every running trial needs its own tuner id, otherwise the oracle hands out
+    # the same trial again
+    free_ids = [f"worker{i}" for i in range(workers)]
+    running: dict[Future, tuple[keras_tuner.engine.trial.Trial, str]] = {}
+    with pool:
+        while True:
+            while free_ids:
+                tuner_id = free_ids.pop()
+                trial = oracle.create_trial(tuner_id)
+                if trial.status != "RUNNING":
+                    # STOPPED when the search is done, IDLE when the oracle waits
+                    # for running trials to finish
+                    free_ids.append(tuner_id)
+                    break
+                future = pool.submit(
+                    run_trial,
+                    build_model,
+                    trial.hyperparameters.get_config(),
+                    split_file,
+                    objective.name,
+                    objective.direction,
+                    tuner.executions_per_trial,
+                    fit_kwargs,
+                    transform,
+                )
+                running[future] = trial, tuner_id
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                trial, tuner_id = running.pop(future)
+                try:
+                    oracle.update_trial(
+                        trial.trial_id, {objective.name: future.result()}
+                    )
+                    trial.status = "COMPLETED"
+                except Exception:
+                    # Invalid trials are retried by the oracle, up to its
+                    # max_retries_per_trial
+                    trial.status = "INVALID"
+                    trial.message = traceback.format_exc()
+                oracle.end_trial(trial)
+                free_ids.append(tuner_id)
+
+    return tuner.get_best_hyperparameters()[0]
@@ -0,0 +1,501 @@
+import asyncio
+import contextlib
+import json
+import time
+from collections import deque
+from collections.abc import Callable
+
+import numpy as np
+import polars as pl
+
+from .inference import NumpyModel
+from .pipeline import BASE_COLUMNS, TIME_COLUMNS
+from .preprocess_rtm import nearest_sensor
+from .time_window import window_features
+
+# A small HTTP service predicting the rail-ground voltage of live RTM measurements,
+# with a model exported by export_model.py. Requests are JSON objects with a list of
+# 'records', each with the train_nr, time (ISO 8601), lat, lon, volt_1, volt_2 and
+# volt_7 of a measurement, like the cleaned RTM data. The features are made like in
+# preprocess_rtm.py (the closest sensor) and time_window.py (the values 3 seconds
+# before and after), so the records of a request should contain the whole window
+# around the measurements of the time model: like at the ends of a trip, the window
+# is cut short otherwise.
+# The records of a request are checked (like their times) before it joins a batch, so
+# a malformed request fails alone instead of failing the batch it would be part of.
+# Concurrent requests are gathered into one batch for up to max_delay_ms (or until
+# max_rows), so the features and predictions are made once per batch. The latency
+# and throughput are served at /metrics.
+
+FEATURES = {"base": BASE_COLUMNS, "time": TIME_COLUMNS}
+
+RECORD_SCHEMA = {
+    "train_nr": pl.Int64,
+    "time": pl.String,
+    "lat": pl.Float64,
+    "lon": pl.Float64,
+    "volt_1": pl.Float64,
+    "volt_2": pl.Float64,
+    "volt_7": pl.Float64,
+}
+
+
+def parse_records(records: pl.DataFrame) -> pl.DataFrame:
+    """
+    Parses the times of the records of one request.
+    :param records: The records, as in RECORD_SCHEMA.
+    :return: The records, with 'time' as a UTC datetime.
+    :raises pl.exceptions.PolarsError: If a time is not in ISO 8601.
+    """
+    return records.with_columns(
+        pl.col("time").str.to_datetime(time_unit="us", time_zone="UTC")
+    )
+
+
+def request_features(
+    records: pl.DataFrame, input_columns: list[str], window_dist: int = 10_000
+) -> pl.DataFrame:
+    """
+    Makes the model inputs of a batch of records, from one or more requests.
+    :param records: The records, see parse_records, with a 'request' column
+    identifying their request.
+    :param input_columns: The features the model was trained on, see FEATURES.
+    :param window_dist: The maximum distance to the closest sensor, like in
+    preprocess_rtm.py. Farther measurements are not predicted.
+    :return: The features, 'sensor' and 'valid' columns, in the order of the records.
+    """
+    keys = ["request", "train_nr"]
+    measurements = (
+        records.lazy()
+        .with_row_index("row")
+        .with_columns(pl.col("train_nr").fill_null(0))
+        .pipe(nearest_sensor)
+    )
+    if any(col.startswith(("pre_", "pos_")) for col in input_columns):
+        # Like time_window.py, the trips are interpolated to every second first
+        per_second = (
+            measurements.select(
+                *keys, "time", "volt_1", "volt_2", "volt_7", "distance_to_sensor"
+            )
+            .with_columns(pl.col("time").dt.truncate("1s"))
+            .unique([*keys, "time"], keep="last")
+            .sort(*keys, "time")
+            .collect()
+            .upsample("time", every="1s", group_by=keys)
+            # The new rows of a trip follow its first row, but without its keys
+            .with_columns(pl.col(keys).forward_fill())
+            .sort(*keys, "time")
+            .with_columns(
+                pl.col("volt_1", "volt_2", "volt_7", "distance_to_sensor")
+                .interpolate()
+                .over(keys)
+            )
+        )
+        measurements = measurements.with_columns(pl.col("time").dt.truncate("1s")).join(
+            window_features(per_second.lazy(), group_by=keys),
+            on=[*keys, "time"],
+            how="left",
+        )
+
+    return (
+        measurements.sort("row")
+        .select(
+            *input_columns,
+            "sensor",
+            valid=pl.col("distance_to_sensor").le(window_dist)
+            & pl.all_horizontal(pl.col(input_columns).is_not_null()),
+        )
+        .collect()
+    )
+
+
+class Predictor:
+    """
+    Makes the features of a batch of records and predicts them with a model.
+    """
+
+    def __init__(
+        self,
+        model: NumpyModel,
+        input_columns: list[str],
+        window_dist: int = 10_000,
+    ):
+        """
+        :param model: The exported model.
+        :param input_columns: The features the model was trained on, see FEATURES.
+        :param window_dist: The maximum distance to the closest sensor.
+        """
+        self.model = model
+        self.input_columns = input_columns
+        self.window_dist = window_dist
+
+    def __call__(self, records: pl.DataFrame) -> pl.DataFrame:
+        """
+        :param records: The records, see parse_records, with a 'request' column.
+        :return: The 'prediction' (null if not valid) and 'sensor' of every record.
+        """
+        features = request_features(records, self.input_columns, self.window_dist)
+        inputs = features.select(self.input_columns).to_numpy()
+        predictions = self.model.predict(inputs).reshape(len(inputs), -1)[:, 0]
+        return pl.DataFrame(
+            {
+                "prediction": np.where(features["valid"], predictions, np.nan),
+                "sensor": features["sensor"],
+            }
+        ).with_columns(pl.col("prediction").fill_nan(None))
+
+
+class Metrics:
+    """
+    Keeps the latency of the most recent requests and the totals since the start.
+    """
+
+    def __init__(self, window: int = 10_000):
+        """
+        :param window: The number of most recent requests used for the percentiles.
+        """
+        self.started = time.perf_counter()
+        self.recent: deque[tuple[float, float]] = deque(maxlen=window)
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+
+    def record(self, latency: float, rows: int) -> None:
+        self.recent.append((time.perf_counter(), latency))
+        self.requests += 1
+        self.rows += rows
+
+    def summary(self) -> dict:
+        """
+        :return: The latency percentiles (in ms) and throughput (per second), over the
+        recent requests and since the start.
+        """
+        now = time.perf_counter()
+        summary = {
+            "requests": self.requests,
+            "rows": self.rows,
+            "batches": self.batches,
+            "errors": self.errors,
+            "rows_per_batch": self.rows / max(self.batches, 1),
+            "requests_per_s": self.requests / (now - self.started),
+            "rows_per_s": self.rows / (now - self.started),
+        }
+        if self.recent:
+            finished, latencies = np.array(self.recent).T
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1_000
+            span = now - finished[0]
+            summary |= {
+                "p50_ms": p50,
+                "p99_ms": p99,
+                "recent_requests_per_s": len(latencies) / span if span else None,
+            }
+        return summary
+
+
+class MicroBatcher:
+    """
+    Gathers the records of concurrent requests into batches for a predictor, which
+    runs on a thread so requests keep being received while a batch is predicted.
+    """
+
+    def __init__(
+        self,
+        predict: Callable[[pl.DataFrame], pl.DataFrame],
+        max_rows: int = 4_096,
+        max_delay_ms: float = 2.0,
+        metrics: Metrics = None,
+    ):
+        """
+        :param predict: Predicts a batch of records, see Predictor.
+        :param max_rows: The number of records at which a batch is started at once.
+        :param max_delay_ms: The longest time the first request of a batch waits for
+        others.
+        :param metrics: The metrics to count the batches in.
+        """
+        self.predict = predict
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1_000
+        self.metrics = metrics or Metrics()
+        self.queue: asyncio.Queue[tuple[pl.DataFrame, asyncio.Future]] = asyncio.Queue()
+
+    async def submit(self, records: pl.DataFrame) -> pl.DataFrame:
+        """
+        :param records: The records of one request, see parse_records.
+        :return: The predictions of the records.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((records, future))
+        return await future
+
+    async def _next_batch(self) -> list[tuple[pl.DataFrame, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        rows = len(batch[0][0])
+        deadline = loop.time() + self.max_delay
+        while rows < self.max_rows:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except TimeoutError:
+                    break
+            else:
+                # Requests that arrived while the previous batch was predicted
+                item = self.queue.get_nowait()
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    async def run(self) -> None:
+        """
+        Predicts batches until cancelled.
+        """
+        while True:
+            batch = await self._next_batch()
+            records = pl.concat(
+                [
+                    frame.with_columns(request=pl.lit(i, pl.UInt32))
+                    for i, (frame, _) in enumerate(batch)
+                ]
+            )
+            try:
+                predictions = await asyncio.to_thread(self.predict, records)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.metrics.batches += 1
+            start = 0
+            for frame, future in batch:
+                if not future.done():
+                    future.set_result(predictions.slice(start, len(frame)))
+                start += len(frame)
+
+
+async def read_request(
+    reader: asyncio.StreamReader,
+) -> tuple[str, str, dict[str, str], bytes] | None:
+    """
+    Reads an HTTP/1.1 request.
+    :param reader: The connection.
+    :return: The method, path, headers (lowercase) and body, or None if the
+    connection was closed.
+    """
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, path, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while (line := await reader.readline()).strip():
+        name, value = line.decode("latin-1").split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+
+def write_response(
+    writer: asyncio.StreamWriter, status: int, content: dict, close: bool = False
+) -> None:
+    """
+    Writes an HTTP/1.1 response with a JSON body.
+    :param writer: The connection.
+    :param status: The status code.
+    :param content: The content of the body.
+    :param close: Whether the connection is closed afterwards.
+    """
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Server Error"}
+    body = json.dumps(content).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {reasons[status]}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode()
+        + body
+    )
+
+
+class PredictionServer:
+    """
+    Serves predictions at POST /predict, and the metrics at GET /metrics.
+    """
+
+    def __init__(
+        self,
+        model: NumpyModel,
+        features: str = "base",
+        max_rows: int = 4_096,
+        max_delay_ms: float = 2.0,
+        window_dist: int = 10_000,
+    ):
+        """
+        :param model: The exported model.
+        :param features: The features the model was trained on, see FEATURES.
+        :param max_rows: The number of records at which a batch is started at once.
+        :param max_delay_ms: The longest time a request waits for others to batch.
+        :param window_dist: The maximum distance to the closest sensor.
+        """
+        self.metrics = Metrics()
+        self.batcher = MicroBatcher(
+            Predictor(model, FEATURES[features], window_dist),
+            max_rows,
+            max_delay_ms,
+            self.metrics,
+        )
+
+    async def predict(self, body: bytes) -> dict:
+        start = time.perf_counter()
+        records = pl.DataFrame(json.loads(body)["records"], schema=RECORD_SCHEMA)
+        records = parse_records(records)
+        predictions = await self.batcher.submit(records)
+        self.metrics.record(time.perf_counter() - start, len(records))
+        return {
+            "predictions": predictions["prediction"].to_list(),
+            "sensors": predictions["sensor"].to_list(),
+        }
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while request := await read_request(reader):
+                method, path, headers, body = request
+                close = headers.get("connection", "").lower() == "close"
+                try:
+                    if (method, path) == ("POST", "/predict"):
+                        status, content = 200, await self.predict(body)
+                    elif (method, path) == ("GET", "/metrics"):
+                        status, content = 200, self.metrics.summary()
+                    elif (method, path) == ("GET", "/health"):
+                        status, content = 200, {"status": "ok"}
+                    else:
+                        status, content = 404, {"error": f"No route {method} {path}"}
+                except (
+                    KeyError,
+                    TypeError,
+                    ValueError,
+                    pl.exceptions.PolarsError,
+                ) as e:
+                    self.metrics.errors += 1
+                    status, content = 400, {"error": f"{type(e).__name__}: {e}"}
+                except Exception as e:
+                    self.metrics.errors += 1
+                    status, content = 500, {"error": f"{type(e).__name__}: {e}"}
+                write_response(writer, status, content, close)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080) -> asyncio.Server:
+        """
+        Starts listening, and predicting batches in the background.
+        :param host: The address to listen on.
+        :param port: The port to listen on, 0 for any free port.
+        :return: The server, whose sockets give the port.
+        """
+        server = await asyncio.start_server(self.handle, host, port)
+        self._batcher = asyncio.create_task(self.batcher.run())
+        return server
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        """
+        Serves until cancelled.
+        :param host: The address to listen on.
+        :param port: The port to listen on.
+        """
+        server = await self.start(host, port)
+        print(f"Serving on {', '.join(str(s.getsockname()) for s in server.sockets)}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._batcher.cancel()
+
+
+class Client:
+    """
+    A client of the service over one keep-alive connection, e.g. for tests and load
+    generation. Requests over the same client are sent one after the other, so use
+    several clients for concurrent requests.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8080):
+        self.host = host
+        self.port = port
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+
+    async def __aenter__(self) -> "Client":
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def request(self, method: str, path: str, content: dict = None) -> dict:
+        """
+        :param method: The HTTP method.
+        :param path: The path.
+        :param content: The JSON body, if any.
+        :return: The JSON response body.
+        """
+        body = b"" if content is None else json.dumps(content).encode()
+        self.writer.write(
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        headers = {}
+        while (line := await self.reader.readline()).strip():
+            name, value = line.decode("latin-1").split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        response = json.loads(
+            await self.reader.readexactly(int(headers["content-length"]))
+        )
+        status = int(status_line.split()[1])
+        if status != 200:
+            raise RuntimeError(f"{status}: {response.get('error')}")
+        return response
+
+    async def predict(self, records: list[dict]) -> dict:
+        """
+        :param records: The measurements, see RECORD_SCHEMA.
+        :return: The 'predictions' and 'sensors' of the records.
+        """
+        return await self.request("POST", "/predict", {"records": records})
+
+    async def metrics(self) -> dict:
+        return await self.request("GET", "/metrics")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Serve rail-ground voltage predictions"
+    )
+    parser.add_argument("model", help="The exported model, e.g. models/time.npz")
+    parser.add_argument("--features", choices=FEATURES, default="base")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-rows", type=int, default=4_096)
+    parser.add_argument("--max-delay-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    service = PredictionServer(
+        NumpyModel.load(args.model), args.features, args.max_rows, args.max_delay_ms
+    )
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(service.serve(args.host, args.port))
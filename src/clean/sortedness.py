@@ -0,0 +1,83 @@
+import os
+
+import polars as pl
+
+from .artifacts import artifact_metadata, scan_artifact
+from .constants import data_dir
+
+# Stages record the columns their output is sorted by in the parquet key-value
+# metadata (or the .meta.json file of an IPC artifact, see artifacts.py), so that
+# later stages can skip re-sorting hundreds of millions of rows.
+# Writing key-value metadata needs Polars 1.30 or newer.
+SORTED_BY_KEY = "clean.sorted_by"
+
+# If set, the recorded sort order is verified (a single streaming pass over the
+# sort column) before it is trusted. Can also be enabled with CLEAN_VALIDATE_SORTED=1
+VALIDATE_SORTED = os.environ.get("CLEAN_VALIDATE_SORTED", "0") not in ("", "0")
+
+
+def sort_metadata(*columns: str) -> dict[str, str]:
+    """
+    Creates the key-value metadata recording the sort order of a file.
+    :param columns: The columns the data is sorted by, in order of priority.
+    :return: A metadata dictionary, to be passed to write_artifact.
+    """
+    return {SORTED_BY_KEY: ",".join(columns)}
+
+
+def recorded_sort(file: str) -> tuple[str, ...]:
+    """
+    Reads the sort order recorded in the metadata of an artifact.
+    :param file: The name of the file, relative to the data directory.
+    :return: The columns the file is sorted by, or an empty tuple if unknown.
+    """
+    sorted_by = artifact_metadata(data_dir(file)).get(SORTED_BY_KEY)
+    return tuple(sorted_by.split(",")) if sorted_by else ()
+
+
+def scan_sorted(file: str, *by: str, validate: bool = None) -> pl.LazyFrame:
+    """
+    Scans an artifact, making sure it is sorted by the given columns. If the file
+    metadata records that it already is, the sort is skipped and the leading column is
+    flagged as sorted instead.
+    :param file: The name of the file, relative to the data directory.
+    :param by: The columns the data should be sorted by.
+    :param validate: Whether to verify the recorded sort order before trusting it,
+    defaults to VALIDATE_SORTED.
+    :return: A Polars LazyFrame, sorted by the given columns.
+    """
+    if validate is None:
+        validate = VALIDATE_SORTED
+
+    lf = scan_artifact(data_dir(file))
+    if recorded_sort(file)[: len(by)] != by:
+        return lf.sort(*by)
+
+    if validate and not is_sorted(lf, *by):
+        raise ValueError(f"{file} is not sorted by {by}, despite its metadata")
+
+    return lf.set_sorted(by[0])
+
+
+def is_sorted(lf: pl.LazyFrame, *by: str) -> bool:
+    """
+    Checks whether the data is sorted by the given columns, in a single streaming pass
+    that only reads those columns.
+    :param lf: The data to check.
+    :param by: The columns the data should be sorted by.
+    :return: Whether the data is sorted.
+    """
+    # A row is out of order when it is smaller than the previous row on the first
+    # column where the two differ
+    out_of_order = pl.lit(False)
+    for col in reversed(by):
+        out_of_order = (
+            pl.when(pl.col(col).eq(pl.col(col).shift(1)))
+            .then(out_of_order)
+            .otherwise(pl.col(col).lt(pl.col(col).shift(1)))
+        )
+    return not (
+        lf.select(out_of_order.fill_null(False).any())
+        .collect(engine="streaming")
+        .item()
+    )
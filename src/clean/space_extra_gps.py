@@ -1,10 +1,14 @@
-import math
+from datetime import timedelta
 
 import polars as pl
 import tqdm
 
+from .artifacts import scan_artifact, write_artifact
 from .constants import LAT_TO_KM, LON_TO_KM, SENSOR_POSITIONS, data_dir, with_suffix
+from .memory import BlockSizer
 from .preprocess_rtm import ensure_rtm_preprocessed
+from .profiling import profiled
+from .sortedness import sort_metadata
 
 # This thing is an extension of `space_window.py` to make it also merge in the MTPS/GPS
 # data a second time, so that it can count how many trains there are in the area while
@@ -13,6 +17,10 @@ from .preprocess_rtm import ensure_rtm_preprocessed
 
 
 # noinspection DuplicatedCode
+@profiled(
+    inputs={"train_name": "rtm", "preprocessed_train_name": "rtm", "mtps_name": "mtps"},
+    outputs={"window_name": "rtm"},
+)
 def space_window(
     train_name: str = "train.pq",
     preprocessed_train_name: str = "train_preprocessed.pq",
@@ -47,18 +55,18 @@ def space_window(
         .cast(pl.UInt32)
     )
 
-    linked_rtm: pl.LazyFrame = pl.scan_parquet(data_dir(f"rtm/{train_name}"))
+    linked_rtm: pl.LazyFrame = scan_artifact(data_dir(f"rtm/{train_name}"))
 
     roll_df = (
         pl.concat(
             (
                 linked_rtm.join(
-                    pl.scan_parquet(data_dir(f"rtm/{preprocessed_train_name}")),
+                    scan_artifact(data_dir(f"rtm/{preprocessed_train_name}")),
                     on=linked_rtm.columns,
                     how="left",
                     coalesce=True,
                 ),
-                pl.scan_parquet(data_dir(f"mtps/{mtps_name}")),
+                scan_artifact(data_dir(f"mtps/{mtps_name}")),
             ),
             how="diagonal",
         )
@@ -74,20 +82,31 @@ def space_window(
         )
         .collect()
     )
+    # The blocks are sized to the memory budget (see memory.py): every row of a block
+    # is compared with the rows of the minute before it, so dense stretches of time
+    # get smaller blocks. Those rows are read along with the block, but only the
+    # windows of the block's own rows are kept
+    times = roll_df["roll_time"]
+    row_bytes = roll_df.estimated_size() / max(len(roll_df), 1)
+    sizer = BlockSizer(rows=block_size)
     res = [pl.DataFrame()]
-    for block in tqdm.trange(math.ceil(len(roll_df) / block_size), desc="Space window"):
-        if (
-            roll_df.lazy()
-            .slice(block * block_size, block_size)
-            .select(pl.col("sensor").null_count())
-            .collect()["sensor"][0]
-            == block_size
-        ):
+    start = 0
+    progress = tqdm.tqdm(total=len(roll_df), desc="Space window")
+    while start < len(roll_df):
+        end = min(start + sizer.rows, len(roll_df))
+        lookback = times.search_sorted(times[start] - timedelta(minutes=1))
+        per_minute = max(start - lookback, 1)
+        if not sizer.fits(end - start, (end - lookback) * row_bytes * per_minute):
+            continue
+
+        block = roll_df.slice(lookback, end - lookback)
+        block_start, start = start, end
+        progress.update(end - block_start)
+        if block["sensor"].slice(block_start - lookback).is_null().all():
             continue
 
         res.append(
-            roll_df.lazy()
-            .slice(max(block * block_size - 10_000, 0), block_size)
+            block.lazy()
             .rolling("roll_time", period="1m")
             .agg(
                 pl.col("time", "lat", "lon", "sensor", "index").last(),
@@ -111,6 +130,7 @@ def space_window(
                 )
                 .n_unique(),
             )
+            .filter(pl.col("index").ge(block_start))
             .filter(pl.col("sensor").is_not_null())
             .with_columns(
                 pl.col("trains")
@@ -126,17 +146,23 @@ def space_window(
                 .list.drop_nulls()
             )
             .filter(pl.col("trains").list.len().gt(0))
-            .drop("roll_time", "latitude", "longitude")
+            .drop("roll_time", "latitude", "longitude", strict=False)
             .collect()
         )
 
+    progress.close()
+
     (
         pl.concat(res)
         .lazy()
         .unique("index")
         .drop("index")
         .sort("time")
-        .sink_parquet(data_dir(f"rtm/{window_name}"))
+        .pipe(
+            write_artifact,
+            data_dir(f"rtm/{window_name}"),
+            metadata=sort_metadata("time"),
+        )
     )
 
 
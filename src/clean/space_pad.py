@@ -1,11 +1,14 @@
 import polars as pl
 
+from .artifacts import scan_artifact, write_artifact
 from .constants import data_dir
+from .profiling import profiled, record_plan
 
 # For the models (even the LSTM) it's good practice to pad to a fixed length.
 # Therefore, we pad all the samples to length 10
 
 
+@profiled(inputs={"joined_name": "samples"}, outputs={"out_name": "samples"})
 def space_window_pad(
     joined_name: str = "space_window.pq",
     out_name: str = "space_padded.pq",
@@ -20,17 +23,17 @@ def space_window_pad(
     :param pad_size:
     :return: None, but makes a new file.
     """
-    pl.scan_parquet(data_dir(f"samples/{joined_name}")).select(
+    scan_artifact(data_dir(f"samples/{joined_name}")).select(
         target_column,
         pl.col("trains").list.len().cast(pl.UInt8).alias("length"),
         *[
             pl.col("trains")
-            .list.get(i)
+            .list.get(i, null_on_oob=True)
             .struct.field("*")
             .name.prefix(f"train_{i + 1:0>2}_")
             for i in range(pad_size)
         ],
-    ).sink_parquet(data_dir(f"samples/{out_name}"))
+    ).pipe(record_plan).pipe(write_artifact, data_dir(f"samples/{out_name}"))
 
 
 def ensure_space_padded(cleaned: str, *, original: str):
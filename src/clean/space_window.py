@@ -1,7 +1,10 @@
 import polars as pl
 
+from .artifacts import scan_artifact, write_artifact
 from .constants import LAT_TO_KM, LON_TO_KM, SENSOR_POSITIONS, data_dir, with_suffix
 from .preprocess_rtm import ensure_rtm_preprocessed
+from .profiling import profiled, record_plan
+from .sortedness import sort_metadata
 
 # FYI: this lovely thing uses ~200GB of RAM if you run in on the full 3-month dataset.
 # If you don't have a 256GB box, you can split the operation into blocks
@@ -9,6 +12,10 @@ from .preprocess_rtm import ensure_rtm_preprocessed
 
 
 # noinspection DuplicatedCode
+@profiled(
+    inputs={"train_name": "rtm", "preprocessed_train_name": "rtm"},
+    outputs={"window_name": "rtm"},
+)
 def space_window(
     train_name: str = "train.pq",
     preprocessed_train_name: str = "train_preprocessed.pq",
@@ -52,11 +59,11 @@ def space_window(
         .cast(pl.UInt32)
     )
 
-    linked_rtm: pl.LazyFrame = pl.scan_parquet(data_dir(f"rtm/{train_name}"))
+    linked_rtm: pl.LazyFrame = scan_artifact(data_dir(f"rtm/{train_name}"))
 
     (
         linked_rtm.join(
-            pl.scan_parquet(data_dir(f"rtm/{preprocessed_train_name}")),
+            scan_artifact(data_dir(f"rtm/{preprocessed_train_name}")),
             on=linked_rtm.columns,
             how="left",
             coalesce=True,
@@ -108,9 +115,14 @@ def space_window(
             .list.drop_nulls()
         )
         .filter(pl.col("trains").list.len().gt(0))
-        .drop("roll_time", "latitude", "longitude")
+        .drop("roll_time", "latitude", "longitude", strict=False)
+        .pipe(record_plan)
         .collect()
-        .write_parquet(data_dir(f"rtm/{window_name}"))
+        .pipe(
+            write_artifact,
+            data_dir(f"rtm/{window_name}"),
+            metadata=sort_metadata("time"),
+        )
     )
 
 
@@ -0,0 +1,408 @@
+import glob
+import heapq
+import time
+from collections import deque
+from collections.abc import Iterator
+from datetime import timedelta
+
+import numpy as np
+import polars as pl
+
+from . import preview
+from .artifacts import scan_artifact
+from .clean_rtm import clean_measurements
+from .constants import data_dir
+from .inference import NumpyModel
+from .pipeline import TIME_COLUMNS, build_all, cleaned_gps_stage
+from .preprocess_rtm import nearest_sensor
+from .time_window import window_features
+
+# A streaming version of the preprocessing chain, from raw RTM messages and GPS records
+# to the inputs of the time model, one small batch at a time:
+#   clean_rtm -> link_rtm_mtps -> preprocess_rtm -> time_window
+# GPS records are given trip ids like the first step of preprocess_mtps (the same
+# train_nr and mat_nr, with no gap of more than max_gap), and RTM measurements are
+# linked to the closest GPS record by the distance of link_rtm_mtps, but only to the
+# GPS records received so far, within the last link_window.
+# The time window needs the values 3 seconds after a measurement, so a measurement is
+# emitted once its trip has reached 3 seconds further, and like time_window.py only if
+# the trip started at least 3 seconds before it.
+# The state is bounded: the GPS records of the link window, the last 7 seconds of
+# every trip and the measurements waiting for their window. Trips are dropped when
+# they haven't been seen for max_gap.
+# Every batch costs a few milliseconds regardless of its size, so batches of a
+# second of the whole fleet keep up with far more records than one at a time.
+
+TRIP_KEYS = ["train_nr", "mat_nr"]
+WINDOW_VALUES = ["volt_1", "volt_2", "volt_7", "distance_to_sensor"]
+WINDOW_S = 3
+
+
+class StreamingPipeline:
+    """
+    Turns batches of raw RTM messages and GPS records into feature rows, keeping the
+    state between batches.
+    """
+
+    def __init__(
+        self,
+        window_dist: int = 10_000,
+        link_window: timedelta = timedelta(seconds=30),
+        max_link_dist_m: float = 1_000,
+        max_gap: timedelta = timedelta(minutes=10),
+        model: NumpyModel = None,
+    ):
+        """
+        :param window_dist: The maximum distance to the closest sensor, like
+        preprocess_rtm.
+        :param link_window: How far apart in time RTM and GPS records can be linked.
+        :param max_link_dist_m: The maximum link distance, see link_rtm_mtps.py.
+        :param max_gap: The longest gap within a trip, like preprocess_mtps.
+        :param model: A time model exported by export_model.py, to add predictions.
+        """
+        self.window_dist = window_dist
+        self.link_window = link_window
+        self.max_link_dist_m = max_link_dist_m
+        self.max_gap = max_gap
+        self.model = model
+
+        self.watermark = None
+        self.next_trip_id = 0
+        # The last GPS record of every active trip
+        self.trips = pl.DataFrame(
+            schema={
+                "train_nr": pl.UInt32,
+                "mat_nr": pl.UInt32,
+                "trip_id": pl.UInt32,
+                "last_time": pl.Datetime("us", "Europe/Amsterdam"),
+            }
+        )
+        self.gps: pl.DataFrame = None
+        # The last seconds of every trip, interpolated, and its first second
+        self.history: pl.DataFrame = None
+        self.starts = pl.DataFrame(
+            schema={
+                "trip_id": pl.UInt32,
+                "start": pl.Datetime("us", "Europe/Amsterdam"),
+            }
+        )
+        self.pending: pl.DataFrame = None
+
+        self.latencies: deque[float] = deque(maxlen=10_000)
+        self.counts = {"rtm": 0, "gps": 0, "linked": 0, "emitted": 0}
+
+    def _advance(self, times: pl.Series) -> None:
+        if len(times) and (self.watermark is None or times.max() > self.watermark):
+            self.watermark = times.max()
+
+    def push_gps(self, gps: pl.DataFrame) -> None:
+        """
+        Adds GPS records, like the output of clean_gps.
+        :param gps: The train_nr, mat_nr, time, lat and lon of the records.
+        """
+        start = time.perf_counter()
+        self.counts["gps"] += len(gps)
+        gps = (
+            gps.lazy()
+            .select(
+                pl.col(TRIP_KEYS).cast(pl.UInt32),
+                pl.col("time").dt.cast_time_unit("us"),
+                pl.col("lat", "lon").cast(pl.Float64),
+            )
+            .filter(pl.col("train_nr").ne(0))
+            .join(self.trips.lazy(), on=TRIP_KEYS, how="left")
+            .sort(*TRIP_KEYS, "time")
+            .with_columns(
+                new_trip=pl.col("time")
+                .sub(
+                    pl.col("time")
+                    .shift()
+                    .over(TRIP_KEYS)
+                    .fill_null(pl.col("last_time"))
+                )
+                .gt(self.max_gap)
+                .fill_null(True)
+            )
+            .with_columns(
+                new_id=pl.col("new_trip").cum_sum().cast(pl.UInt32)
+                + (self.next_trip_id - 1)
+            )
+            .with_columns(
+                trip_id=pl.when("new_trip")
+                .then("new_id")
+                .forward_fill()
+                .over(TRIP_KEYS)
+                .fill_null(pl.col("trip_id"))
+                .cast(pl.UInt32)
+            )
+            .collect()
+        )
+        self.next_trip_id += int(gps["new_trip"].sum())
+        self._advance(gps["time"])
+
+        latest = gps.group_by(TRIP_KEYS).agg(
+            pl.col("trip_id").last(), last_time=pl.col("time").last()
+        )
+        self.trips = pl.concat(
+            [self.trips.join(latest, on=TRIP_KEYS, how="anti"), latest],
+            how="vertical_relaxed",
+        )
+        gps = gps.select("trip_id", *TRIP_KEYS, "time", "lat", "lon")
+        self.gps = gps if self.gps is None else pl.concat([self.gps, gps])
+        self._prune()
+        self.latencies.append(time.perf_counter() - start)
+
+    def _link(self, rtm: pl.LazyFrame) -> pl.LazyFrame:
+        # The distance of link_rtm_mtps: the distance in metres plus the distance the
+        # trains would be apart after the time difference, at 70 km/h
+        distance = (
+            pl.col("lat").sub("gps_lat").mul(111 * 1000).pow(2)
+            + pl.col("lon").sub("gps_lon").mul(68 * 1000).pow(2)
+        ).sqrt() + pl.col("time").sub("gps_time").dt.total_seconds().abs().mul(70 / 3.6)
+        gps = self.gps.lazy().rename(
+            {"time": "gps_time", "lat": "gps_lat", "lon": "gps_lon"}
+        )
+        return (
+            rtm.with_row_index("row")
+            .join_where(
+                gps,
+                pl.col("gps_time") >= pl.col("time") - self.link_window,
+                pl.col("gps_time") <= pl.col("time") + self.link_window,
+            )
+            .with_columns(link_dist=distance)
+            .filter(pl.col("link_dist") < self.max_link_dist_m)
+            .sort("row", "link_dist")
+            .unique("row", keep="first")
+            .drop("row", "gps_time", "gps_lat", "gps_lon", "link_dist")
+        )
+
+    def push_rtm(self, raw: pl.DataFrame) -> pl.DataFrame:
+        """
+        Adds raw RTM messages, in the measurements_filtered_normalized format read by
+        clean_rtm.
+        :param raw: The raw messages.
+        :return: The feature rows that are complete after these messages.
+        """
+        start = time.perf_counter()
+        self.counts["rtm"] += len(raw)
+        measurements = raw.lazy().pipe(clean_measurements).collect()
+        self._advance(measurements["time"])
+        if self.gps is None or measurements.is_empty():
+            return self._emit(None, start)
+
+        linked = (
+            measurements.lazy()
+            .pipe(self._link)
+            .pipe(nearest_sensor)
+            .filter(pl.col("distance_to_sensor") <= self.window_dist)
+            .select(
+                "trip_id",
+                *TRIP_KEYS,
+                pl.col("time").dt.truncate("1s"),
+                "lat",
+                "lon",
+                "sensor",
+                pl.col(WINDOW_VALUES).cast(pl.Float64),
+            )
+            # Like the per second grid of time_window, one measurement per second
+            .unique(["trip_id", "time"], keep="last")
+            .collect()
+        )
+        self.counts["linked"] += len(linked)
+        return self._emit(linked, start)
+
+    def _emit(self, linked: pl.DataFrame | None, start: float) -> pl.DataFrame:
+        if linked is not None and not linked.is_empty():
+            self._update_windows(linked)
+        ready = self._ready()
+        self._prune()
+        self.counts["emitted"] += len(ready)
+        self.latencies.append(time.perf_counter() - start)
+        return ready
+
+    def _update_windows(self, linked: pl.DataFrame) -> None:
+        keys = ["trip_id"]
+        points = linked.select(*keys, "time", *WINDOW_VALUES)
+        if self.history is not None:
+            points = pl.concat([self.history, points])
+        self.history = (
+            points.unique([*keys, "time"], keep="last")
+            .sort(*keys, "time")
+            .upsample("time", every="1s", group_by=keys)
+            # The new rows of a trip follow its first row, but without its keys
+            .with_columns(pl.col(keys).forward_fill())
+            .sort(*keys, "time")
+            .select(*keys, "time", pl.col(WINDOW_VALUES).interpolate().over(keys))
+        )
+        starts = linked.group_by(keys).agg(start=pl.col("time").min())
+        self.starts = (
+            pl.concat([self.starts, starts]).group_by(keys).agg(pl.col("start").min())
+        )
+        self.pending = (
+            linked if self.pending is None else pl.concat([self.pending, linked])
+        )
+
+    def _ready(self) -> pl.DataFrame:
+        if self.pending is None or self.pending.is_empty():
+            return pl.DataFrame()
+        window = timedelta(seconds=WINDOW_S)
+        latest = self.history.group_by("trip_id").agg(latest=pl.col("time").max())
+        pending = self.pending.join(latest, on="trip_id").join(
+            self.starts, on="trip_id"
+        )
+        is_ready = pl.col("time").add(window).le(pl.col("latest"))
+        complete = pl.col("time").sub(window).ge(pl.col("start"))
+        ready = pending.filter(is_ready & complete)
+        self.pending = pending.filter(is_ready.not_()).select(self.pending.columns)
+
+        features = (
+            ready.lazy()
+            .join(
+                window_features(self.history.lazy(), group_by=["trip_id"]),
+                on=["trip_id", "time"],
+            )
+            .select(
+                "trip_id", *TRIP_KEYS, "time", "lat", "lon", "sensor", *TIME_COLUMNS
+            )
+            .sort("time", "trip_id")
+            .collect()
+        )
+        # Only the last seconds of every trip are needed for the next windows
+        self.history = self.history.filter(
+            pl.col("time") >= pl.col("time").max().over("trip_id") - 2 * window
+        )
+        if self.model is not None and not features.is_empty():
+            inputs = features.select(TIME_COLUMNS).to_numpy()
+            features = features.with_columns(
+                prediction=pl.Series(self.model.predict(inputs).reshape(-1))
+            )
+        return features
+
+    def _prune(self) -> None:
+        if self.watermark is None:
+            return
+        self.trips = self.trips.filter(
+            pl.col("last_time") >= self.watermark - self.max_gap
+        )
+        if self.gps is not None:
+            self.gps = self.gps.filter(
+                pl.col("time") >= self.watermark - self.link_window
+            )
+        if self.history is not None:
+            # Trips that haven't had measurements for max_gap
+            active = (
+                self.history.group_by("trip_id")
+                .agg(latest=pl.col("time").max())
+                .filter(pl.col("latest") >= self.watermark - self.max_gap)
+            )
+            self.history = self.history.join(active, on="trip_id", how="semi")
+            self.starts = self.starts.join(active, on="trip_id", how="semi")
+        if self.pending is not None:
+            self.pending = self.pending.join(self.starts, on="trip_id", how="semi")
+
+    def state_rows(self) -> int:
+        """
+        :return: The number of rows kept between batches.
+        """
+        frames = [self.trips, self.gps, self.history, self.starts, self.pending]
+        return sum(len(frame) for frame in frames if frame is not None)
+
+    def summary(self) -> dict:
+        """
+        :return: The record counts, the processing time per batch (in ms) and the
+        size of the state.
+        """
+        summary = {**self.counts, "state_rows": self.state_rows()}
+        if self.latencies:
+            p50, p99 = np.percentile(self.latencies, [50, 99]) * 1_000
+            summary |= {"batch_p50_ms": p50, "batch_p99_ms": p99}
+        return summary
+
+
+def file_batches(
+    files: list[str], time_column: pl.Expr, every: str
+) -> Iterator[tuple[object, pl.DataFrame]]:
+    """
+    Reads files one at a time, sorted by time, in batches of a period of time.
+    :param files: The paths of the files, in time order.
+    :param time_column: An expression for the time of a row.
+    :param every: The period of time of a batch, e.g. '1s'.
+    :return: An iterator of the start and rows of every batch.
+    """
+    for file in files:
+        df = (
+            scan_artifact(file)
+            .with_columns(_batch=time_column.dt.truncate(every))
+            .sort("_batch")
+            .collect()
+        )
+        for batch in df.partition_by("_batch", maintain_order=True):
+            yield batch["_batch"][0], batch.drop("_batch")
+
+
+def replay(
+    rtm: str = "rtm/raw",
+    gps: str = None,
+    every: str = "1s",
+) -> Iterator[tuple[str, pl.DataFrame]]:
+    """
+    Replays raw RTM files and a cleaned GPS file as a live feed, in time order.
+    Every file is sorted in memory, so the memory use is bounded by the largest file
+    (e.g. a day of raw RTM messages).
+    :param rtm: The raw RTM file or directory of files in the data directory.
+    :param gps: The cleaned GPS file in the data directory, see clean_gps.py,
+    defaults to the one of the pipeline (built if needed).
+    :param every: The period of time of a batch. Records are only linked to GPS
+    records of the same or earlier batches, so this should be short.
+    :return: An iterator of ('rtm', raw messages) and ('gps', records) batches.
+    """
+    if gps is None:
+        with preview.active():
+            (gps_file,) = build_all(cleaned_gps_stage())
+            gps_path = data_dir(f"mtps/{gps_file}")
+    else:
+        gps_path = data_dir(gps)
+    rtm_files = sorted(glob.glob(data_dir(f"{rtm}/*.parquet"))) or [data_dir(rtm)]
+    rtm_time = (
+        pl.col("datetime")
+        .struct.field("local")
+        .str.to_datetime("%+")
+        .dt.convert_time_zone("Europe/Amsterdam")
+    )
+    merged = heapq.merge(
+        # In the same period, GPS records go first so they can be linked
+        ((t, 0, "gps", b) for t, b in file_batches([gps_path], pl.col("time"), every)),
+        ((t, 1, "rtm", b) for t, b in file_batches(rtm_files, rtm_time, every)),
+        key=lambda item: item[:2],
+    )
+    for _, _, kind, batch in merged:
+        yield kind, batch
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Replay raw RTM and GPS files through the streaming pipeline"
+    )
+    parser.add_argument("--rtm", default="rtm/raw", help="Raw RTM file or directory")
+    parser.add_argument(
+        "--gps", help="Cleaned GPS file, defaults to the one of the pipeline"
+    )
+    parser.add_argument("--every", default="1s", help="The period of a batch")
+    parser.add_argument("--model", help="An exported time model, see export_model.py")
+    parser.add_argument("--out", help="Write the feature rows to this file in samples")
+    args = parser.parse_args()
+
+    pipeline = StreamingPipeline(
+        model=NumpyModel.load(args.model) if args.model else None
+    )
+    outputs = []
+    for kind, batch in replay(args.rtm, args.gps, args.every):
+        if kind == "gps":
+            pipeline.push_gps(batch)
+        elif not (rows := pipeline.push_rtm(batch)).is_empty():
+            outputs.append(rows)
+    print(pipeline.summary())
+    if args.out and outputs:
+        pl.concat(outputs).write_parquet(data_dir(f"samples/{args.out}"))
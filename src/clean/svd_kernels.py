@@ -1,14 +1,138 @@
-from itertools import chain, combinations
+from collections import Counter
+from itertools import chain, combinations, combinations_with_replacement
 
+import numpy as np
 import polars as pl
 
+from .artifacts import scan_artifact, write_artifact
 from .constants import data_dir, with_suffix
+from .profiling import profiled, record_plan
 
 
+class KernelTransform:
+    """
+    Products of the input columns (monomials), which can be applied to NumPy arrays
+    at load or batch time, or to Polars data as expressions, instead of storing the
+    expanded data. A monomial is a tuple of input column indices, e.g. (0, 0, 2) for
+    x0 * x0 * x2.
+    """
+
+    def __init__(self, monomials: list[tuple[int, ...]]):
+        self.monomials = [tuple(sorted(monomial)) for monomial in monomials]
+
+    @classmethod
+    def svd(cls, n_inputs: int) -> "KernelTransform":
+        """
+        The kernels of the linear kernel model: the products of every combination
+        of up to n_inputs - 1 different inputs (including the inputs themselves),
+        followed by the squares of the inputs.
+        :param n_inputs: The number of input columns.
+        :return: The transform.
+        """
+        return cls(
+            [
+                *chain.from_iterable(
+                    combinations(range(n_inputs), i) for i in range(1, n_inputs)
+                ),
+                *((col, col) for col in range(n_inputs)),
+            ]
+        )
+
+    @classmethod
+    def polynomial(
+        cls, n_inputs: int, degree: int, interaction_only: bool = False
+    ) -> "KernelTransform":
+        """
+        All monomials of the inputs up to a degree, starting with the inputs.
+        :param n_inputs: The number of input columns.
+        :param degree: The highest degree.
+        :param interaction_only: Whether to only multiply different inputs.
+        :return: The transform.
+        """
+        combine = combinations if interaction_only else combinations_with_replacement
+        return cls(
+            list(
+                chain.from_iterable(
+                    combine(range(n_inputs), d) for d in range(1, degree + 1)
+                )
+            )
+        )
+
+    def names(self, input_columns: list[str]) -> list[str]:
+        """
+        :param input_columns: The names of the input columns.
+        :return: The names of the kernels, like the columns made by add_kernels.
+        """
+        names = []
+        for monomial in self.monomials:
+            powers = Counter(monomial)
+            if len(monomial) == 2 and len(powers) == 1:
+                names.append(f"{input_columns[monomial[0]]}_squared")
+            else:
+                names.append(
+                    "*".join(
+                        input_columns[col] + (f"^{power}" if power > 1 else "")
+                        for col, power in powers.items()
+                    )
+                )
+        return names
+
+    def expressions(self, input_columns: list[str]) -> list[pl.Expr]:
+        """
+        :param input_columns: The names of the input columns.
+        :return: A Polars Expression for every kernel.
+        """
+        expressions = []
+        for monomial, name in zip(
+            self.monomials, self.names(input_columns), strict=True
+        ):
+            # As floats, as the product of three voltages doesn't fit in 32-bit integers
+            expr = pl.lit(1.0)
+            for col in monomial:
+                expr = expr.mul(input_columns[col])
+            expressions.append(expr.alias(name))
+        return expressions
+
+    def __call__(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        Applies the transform to a batch of inputs.
+        :param inputs: An (n, n_inputs) array.
+        :return: An (n, n_kernels) array of floats.
+        """
+        inputs = np.asarray(inputs, dtype=np.float64)
+        # Products are built from the product of their first factors, which are
+        # often kernels themselves
+        products: dict[tuple[int, ...], np.ndarray] = {}
+
+        def product(monomial: tuple[int, ...]) -> np.ndarray:
+            if monomial not in products:
+                last = inputs[:, monomial[-1]]
+                products[monomial] = (
+                    last if len(monomial) == 1 else product(monomial[:-1]) * last
+                )
+            return products[monomial]
+
+        out = np.empty((len(inputs), len(self.monomials)))
+        for j, monomial in enumerate(self.monomials):
+            out[:, j] = product(monomial)
+        return out
+
+
+def kernel_expressions(input_columns: list[str]) -> list[pl.Expr]:
+    """
+    Creates the kernels: the products of every combination of the input columns, and
+    their squares.
+    :param input_columns: The names of the original input columns.
+    :return: A Polars Expression for every kernel.
+    """
+    return KernelTransform.svd(len(input_columns)).expressions(input_columns)
+
+
+@profiled(inputs={"sample": "samples"}, outputs={"out_file": "samples"})
 def add_kernels(
     sample: str,
     out_file: str = None,
-    input_columns: list[pl.type_aliases.IntoExprColumn] = None,
+    input_columns: list[str | pl.Expr] = None,
     target_column: str = "sensor_voltage",
 ) -> None:
     """
@@ -27,25 +151,12 @@ def add_kernels(
     if out_file is None:
         out_file = with_suffix(sample, "_kernels.pq")
 
-    expressions: list[pl.Expr] = []
-
-    for column_combination in chain.from_iterable(
-        combinations(input_columns, i) for i in range(1, len(input_columns))
-    ):
-        expr = pl.lit(1)
-        for col in column_combination:
-            expr = expr.mul(col)
-
-        expressions.append(expr.alias("*".join(column_combination)))
-
-    for col in input_columns:
-        expressions.append((pl.col(col).pow(2)).alias(f"{col}_squared"))
-
     (
-        pl.scan_parquet(data_dir(f"samples/{sample}"))
+        scan_artifact(data_dir(f"samples/{sample}"))
         .select(*input_columns, target_column)
-        .with_columns(expressions)
-        .sink_parquet(data_dir(f"samples/{out_file}"))
+        .with_columns(kernel_expressions(input_columns))
+        .pipe(record_plan)
+        .pipe(write_artifact, data_dir(f"samples/{out_file}"))
     )
 
 
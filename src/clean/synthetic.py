@@ -0,0 +1,334 @@
+import datetime as dt
+import os
+
+import numpy as np
+import polars as pl
+
+from .clean_rtm import measurement_names
+from .constants import LAT_TO_KM, LON_TO_KM, SENSOR_POSITIONS, data_dir
+
+# The RTM, MTPS and SAS data is under NDA, so for benchmarks and tests we generate
+# synthetic data in the same formats. Trains drive straight trips through the
+# sensors at realistic speeds, sampled by both the RTM and MTPS (GPS) systems, and
+# the sensor voltage rises with the number of trains near the sensor.
+
+SHERLOCK_FILE = "sherlock.csv"
+GPS_FILE = "GPS_filter.csv"
+SAS_FILE = "voltage-avg-feb-april.pq"
+RAW_RTM_DIR = "raw"
+
+
+def generate_trips(
+    rng: np.random.Generator, trains: int, sensors: int, day: dt.datetime
+) -> pl.DataFrame:
+    """
+    Plans the trips of all trains for one day. Every trip is a straight line through
+    one of the sensors, followed by a stop long enough to end the trip in MTPS.
+    :param rng: The random generator.
+    :param trains: The number of trains.
+    :param sensors: The number of sensors (from SENSOR_POSITIONS) trains drive past.
+    :param day: The start of the day.
+    :return: A Polars DataFrame with one row per trip.
+    """
+    trips = []
+    for train in range(trains):
+        start = 6 * 60 * 60 + rng.integers(0, 30 * 60)
+        while start < 23 * 60 * 60:
+            s_lat, s_lon = SENSOR_POSITIONS[rng.integers(0, sensors)]
+            heading = rng.uniform(0, 2 * np.pi)
+            half_km = rng.uniform(10, 30)
+            speed_kmh = rng.uniform(80, 140)
+            d_lat = np.sin(heading) * half_km * 1000 / LAT_TO_KM
+            d_lon = np.cos(heading) * half_km * 1000 / LON_TO_KM
+            duration = int(2 * half_km / speed_kmh * 60 * 60)
+            trips.append(
+                (
+                    # Train numbers change per service, material numbers don't
+                    int(rng.integers(100, 99_999)),
+                    1_000 + train,
+                    day + dt.timedelta(seconds=int(start)),
+                    duration,
+                    s_lat - d_lat,
+                    s_lon - d_lon,
+                    s_lat + d_lat,
+                    s_lon + d_lon,
+                )
+            )
+            start += duration + rng.integers(12 * 60, 30 * 60)
+
+    return pl.DataFrame(
+        trips,
+        schema=[
+            "train_nr",
+            "mat_nr",
+            "start",
+            "duration",
+            "lat_0",
+            "lon_0",
+            "lat_1",
+            "lon_1",
+        ],
+        orient="row",
+    ).with_row_index("trip")
+
+
+def sample_trips(
+    rng: np.random.Generator, trips: pl.DataFrame, interval_s: float, noise_m: float
+) -> pl.DataFrame:
+    """
+    Samples the positions of the trains on their trips at a regular interval, with
+    some jitter in time and noise in position.
+    :param rng: The random generator.
+    :param trips: The trips, see generate_trips.
+    :param interval_s: The average number of seconds between samples.
+    :param noise_m: The standard deviation of the position noise in metres.
+    :return: A Polars DataFrame with one row per sample, sorted by trip and time.
+    """
+    counts = (trips["duration"].to_numpy() // interval_s).astype(np.int64)
+    trip_idx = np.repeat(np.arange(len(trips)), counts)
+    step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    seconds = (step + rng.uniform(0, 0.5, len(step))) * interval_s
+
+    return (
+        trips[trip_idx]
+        .with_columns(
+            frac=pl.Series(seconds) / pl.col("duration"),
+            seconds=pl.Series(seconds),
+        )
+        .select(
+            "trip",
+            "train_nr",
+            "mat_nr",
+            time=pl.col("start") + pl.duration(milliseconds=pl.col("seconds") * 1000),
+            lat=pl.col("lat_0")
+            + pl.col("frac") * (pl.col("lat_1") - pl.col("lat_0"))
+            + pl.Series(rng.normal(0, noise_m / LAT_TO_KM, len(step))),
+            lon=pl.col("lon_0")
+            + pl.col("frac") * (pl.col("lon_1") - pl.col("lon_0"))
+            + pl.Series(rng.normal(0, noise_m / LON_TO_KM, len(step))),
+        )
+    )
+
+
+def measurement(key: str, value: pl.Expr, valid: pl.Expr = None) -> pl.Expr:
+    """
+    Creates one entry of the nested RTM measurements list.
+    :param key: The measurement key, see clean_rtm.measurement_names.
+    :param value: The measured value.
+    :param valid: Whether the measurement is valid, defaults to always.
+    :return: A Polars Expression for the measurement struct.
+    """
+    return pl.struct(
+        key=pl.lit(key),
+        value=pl.struct(
+            valid=pl.lit(True) if valid is None else valid,
+            value=value.cast(pl.Float64),
+        ),
+    )
+
+
+def to_raw_rtm(rtm: pl.DataFrame, rng: np.random.Generator) -> pl.DataFrame:
+    """
+    Converts RTM samples to the raw nested measurement format read by clean_rtm.
+    :param rtm: The RTM samples, with voltages, see generate.
+    :param rng: The random generator.
+    :return: A Polars DataFrame in the raw RTM format.
+    """
+    keys = {name: key for key, name in measurement_names.items()}
+
+    def dms(prefix: str, col: str) -> list[pl.Expr]:
+        # Degrees, minutes, seconds and hundredths of seconds
+        return [
+            measurement(keys[f"{prefix}_grad"], pl.col(col).floor()),
+            measurement(keys[f"{prefix}_min"], (pl.col(col) * 60).floor() % 60),
+            measurement(keys[f"{prefix}_sec"], (pl.col(col) * 60 * 60).floor() % 60),
+            measurement(
+                keys[f"{prefix}_sub_sec"], (pl.col(col) * 60 * 60 * 100).floor() % 100
+            ),
+        ]
+
+    return rtm.with_columns(valid=pl.Series(rng.random(len(rtm)) > 0.01)).select(
+        datetime=pl.struct(
+            local=pl.col("time")
+            .dt.replace_time_zone("Europe/Amsterdam", ambiguous="earliest")
+            .dt.strftime("%+")
+        ),
+        measurements_filtered_normalized=pl.concat_list(
+            measurement(keys["volt_1"], pl.col("volt_1"), pl.col("valid")),
+            measurement(keys["volt_2"], pl.col("volt_2")),
+            measurement(keys["volt_7"], pl.col("volt_7")),
+            *dms("n", "lat"),
+            *dms("e", "lon"),
+            # Real messages contain many more keys, which clean_rtm ignores
+            measurement("snelheid abv6", pl.col("speed")),
+        ),
+    )
+
+
+def sensor_voltages(
+    rng: np.random.Generator, rtm: pl.DataFrame, sensors: int, day: dt.datetime
+) -> pl.DataFrame:
+    """
+    Creates the per-minute SAS maximum voltages for one day, which rise with the
+    number of trains within 5 km of the sensor.
+    :param rng: The random generator.
+    :param rtm: The RTM samples of the day.
+    :param sensors: The number of sensors.
+    :param day: The start of the day.
+    :return: A Polars DataFrame in the SAS format read by clean_sas.
+    """
+    minutes = pl.datetime_range(
+        day, day + dt.timedelta(days=1), "1m", closed="left", eager=True
+    )
+    grid = pl.DataFrame(
+        {
+            "sensor": np.repeat(np.arange(sensors), len(minutes)),
+            "minute": pl.concat([minutes] * sensors),
+        }
+    )
+    nearby = pl.concat(
+        rtm.filter(
+            ((pl.col("lat") - s_lat) * LAT_TO_KM).pow(2)
+            + ((pl.col("lon") - s_lon) * LON_TO_KM).pow(2)
+            < 5_000**2
+        ).select(
+            sensor=pl.lit(sensor, pl.Int64),
+            minute=pl.col("time").dt.truncate("1m"),
+            mat_nr="mat_nr",
+        )
+        for sensor, (s_lat, s_lon) in enumerate(SENSOR_POSITIONS[:sensors])
+    )
+    trains_nearby = nearby.group_by("sensor", "minute").agg(
+        trains=pl.col("mat_nr").n_unique()
+    )
+    positions = pl.DataFrame(
+        SENSOR_POSITIONS[:sensors], schema=["latitude", "longitude"], orient="row"
+    ).with_row_index("sensor")
+
+    return (
+        grid.join(trains_nearby, on=["sensor", "minute"], how="left")
+        .join(positions.cast({"sensor": pl.Int64}), on="sensor")
+        .select(
+            "latitude",
+            "longitude",
+            max=pl.lit(30.0)
+            + pl.col("trains").fill_null(0) * 25
+            + pl.Series(rng.normal(0, 5, len(grid))),
+            # SAS timestamps are local time, stored as if they were UTC
+            t_max=pl.col("minute").dt.epoch("s")
+            + pl.Series(rng.integers(0, 60, len(grid))),
+        )
+    )
+
+
+def generate(
+    trains: int = 10,
+    days: int = 2,
+    sensors: int = 12,
+    start: dt.datetime = dt.datetime(2024, 2, 1),
+    rtm_interval_s: float = 5.0,
+    gps_interval_s: float = 10.0,
+    seed: int = 42,
+) -> None:
+    """
+    Generates a synthetic version of all base data files in the data directory:
+    raw RTM parquet files in rtm/raw/, the GPS_filter and Sherlock CSV files in
+    mtps/, and the SAS averages in sas/. Data is generated one day at a time.
+    :param trains: The number of trains.
+    :param days: The number of days.
+    :param sensors: The number of sensors (from SENSOR_POSITIONS) trains drive past.
+    :param start: The first day.
+    :param rtm_interval_s: The average number of seconds between RTM measurements.
+    :param gps_interval_s: The average number of seconds between MTPS measurements.
+    :param seed: The seed of the random generator.
+    :return: None, but makes the base data files.
+    """
+    rng = np.random.default_rng(seed)
+    for directory in ["mtps", "sas", "samples", f"rtm/{RAW_RTM_DIR}"]:
+        os.makedirs(data_dir(directory), exist_ok=True)
+
+    sas = []
+    with (
+        open(data_dir(f"mtps/{GPS_FILE}"), "wb") as gps_file,
+        open(data_dir(f"mtps/{SHERLOCK_FILE}"), "wb") as sherlock_file,
+    ):
+        sherlock_file.write(b"Sherlock export\n")
+        for day_num in range(days):
+            day = start + dt.timedelta(days=day_num)
+            trips = generate_trips(rng, trains, sensors, day)
+            trips = trips.with_columns(
+                speed=(
+                    ((pl.col("lat_1") - pl.col("lat_0")) * LAT_TO_KM).pow(2)
+                    + ((pl.col("lon_1") - pl.col("lon_0")) * LON_TO_KM).pow(2)
+                ).sqrt()
+                / pl.col("duration")
+                * 3.6,
+                # Every trip has its own base line voltage
+                volt=pl.Series(rng.normal(1_750, 60, len(trips))),
+            )
+
+            rtm = sample_trips(rng, trips, rtm_interval_s, noise_m=3)
+            n = len(rtm)
+            rtm = rtm.with_columns(
+                volt_1=trips["volt"].gather(rtm["trip"])
+                + pl.Series(rng.normal(0, 20, n))
+                # A few outliers, which clean_rtm filters
+                + pl.Series(np.where(rng.random(n) < 0.002, 1_000.0, 0.0)),
+                speed=trips["speed"].gather(rtm["trip"]),
+            ).with_columns(
+                volt_2=pl.col("volt_1") + pl.Series(rng.normal(0, 5, n)),
+                volt_7=pl.col("volt_1") + pl.Series(rng.normal(0, 5, n)),
+            )
+            to_raw_rtm(rtm, rng).write_parquet(
+                data_dir(f"rtm/{RAW_RTM_DIR}/day_{day_num:0>3}.parquet")
+            )
+            sas.append(sensor_voltages(rng, rtm, sensors, day))
+            del rtm
+
+            gps = sample_trips(rng, trips, gps_interval_s, noise_m=5)
+            gps.select(
+                Treinnummer="train_nr",
+                **{"Mat-nummer": "mat_nr"},
+                Tijdstip=pl.col("time").dt.strftime("%F %T"),
+                Latitude=decimal_comma("lat"),
+                Longitude=decimal_comma("lon"),
+            ).write_csv(gps_file, separator=";", include_header=day_num == 0)
+
+            invalid = pl.Series(rng.random(len(gps)) < 0.02)
+            gps.select(
+                Treinnr="train_nr",
+                Matnr="mat_nr",
+                Tijdstip=pl.col("time").dt.strftime("%F %T%.3f"),
+                # Sherlock exports contain many invalid coordinates
+                GPS_latitude=pl.when(invalid)
+                .then(pl.lit("0"))
+                .otherwise(decimal_comma("lat")),
+                GPS_longitude=pl.when(invalid)
+                .then(pl.lit("0"))
+                .otherwise(decimal_comma("lon")),
+            ).write_csv(sherlock_file, separator=";", include_header=day_num == 0)
+
+    pl.concat(sas).write_parquet(data_dir(f"sas/{SAS_FILE}"))
+
+
+def decimal_comma(col: str) -> pl.Expr:
+    """
+    Formats coordinates like the MTPS exports, with a decimal comma.
+    :param col: The column with the coordinates.
+    :return: A Polars Expression for the formatted coordinates.
+    """
+    return pl.col(col).round(6).cast(pl.String).str.replace(".", ",", literal=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate synthetic base data")
+    parser.add_argument("--trains", type=int, default=10)
+    parser.add_argument("--days", type=int, default=2)
+    parser.add_argument("--sensors", type=int, default=len(SENSOR_POSITIONS))
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    generate(args.trains, args.days, args.sensors, seed=args.seed)
+    print(f"Generated synthetic data in {data_dir('')}")
@@ -3,7 +3,38 @@ from datetime import timedelta
 import polars as pl
 import tqdm
 
+from .artifacts import read_artifact, write_artifact
 from .constants import data_dir
+from .profiling import profiled
+
+
+def window_features(df: pl.LazyFrame, group_by: list[str] = None) -> pl.LazyFrame:
+    """
+    Finds the values 3 seconds before ('pre_') and after ('pos_') every second of
+    interpolated trips, or the first and last values within those 3 seconds at the
+    ends of a trip. Also used to make the features of live measurements, see serve.py.
+    :param df: The interpolated trip(s), sorted by time (within a group).
+    :param group_by: The columns identifying a trip, if there are several trips.
+    :return: The time, group columns and the window features of every row.
+    """
+    return df.rolling(
+        index_column="time",
+        period="8s",
+        offset="-4s",
+        closed="none",
+        group_by=group_by,
+    ).agg(
+        pl.col("time").first().alias("pre_time"),
+        pl.col("time").last().alias("pos_time"),
+        pl.col("volt_1").first().alias("pre_volt_1"),
+        pl.col("volt_1").last().alias("pos_volt_1"),
+        pl.col("volt_2").first().alias("pre_volt_2"),
+        pl.col("volt_2").last().alias("pos_volt_2"),
+        pl.col("volt_7").first().alias("pre_volt_7"),
+        pl.col("volt_7").last().alias("pos_volt_7"),
+        pl.col("distance_to_sensor").first().alias("pre_distance_to_sensor"),
+        pl.col("distance_to_sensor").last().alias("pos_distance_to_sensor"),
+    )
 
 
 def interpolate_per_trip(
@@ -28,8 +59,8 @@ def interpolate_per_trip(
             pl.DataFrame(
                 {
                     "time": pl.datetime_range(
-                        group.select(pl.min("time")),
-                        group.select(pl.max("time")),
+                        group["time"].min(),
+                        group["time"].max(),
                         timedelta(seconds=1),
                         eager=True,
                     )
@@ -48,29 +79,7 @@ def interpolate_per_trip(
                 pl.col("sensor_voltage").interpolate(),
             )
         )
-        second_df: pl.DataFrame = (
-            new_df.lazy()
-            .rolling(
-                index_column="time",
-                period="8s",
-                offset="-4s",
-                closed="none",
-            )
-            .agg(
-                pl.col("time").first().alias("pre_time"),
-                pl.col("time").last().alias("pos_time"),
-                pl.col("volt_1").first().alias("pre_volt_1"),
-                pl.col("volt_1").last().alias("pos_volt_1"),
-                pl.col("volt_2").first().alias("pre_volt_2"),
-                pl.col("volt_2").last().alias("pos_volt_2"),
-                pl.col("volt_7").first().alias("pre_volt_7"),
-                pl.col("volt_7").last().alias("pos_volt_7"),
-                pl.col("distance_to_sensor").first().alias("pre_distance_to_sensor"),
-                pl.col("distance_to_sensor").last().alias("pos_distance_to_sensor"),
-            )
-            .drop("time")
-            .collect()
-        )
+        second_df: pl.DataFrame = window_features(new_df.lazy()).drop("time").collect()
         new_df = new_df.hstack(second_df)
         new_df = new_df[3:-2]
         interpolated_dfs.append(new_df)
@@ -87,6 +96,27 @@ def interpolate_per_trip(
         )
 
 
+@profiled(inputs={"name": "samples"}, outputs={"out_file": "samples"})
+def time_window(
+    name: str, out_file: str = None, include_interpolated: bool = False
+) -> None:
+    """
+    Creates the time expanded dataset from a linked rtm and sas file.
+    :param name: The name of the linked file.
+    :param out_file: The name of the time expanded file to be made.
+    :param include_interpolated: A boolean indicating whether the interpolated
+    data should be included in the dataset.
+    :return: None, but makes a new file.
+    """
+    if out_file is None:
+        out_file = f"time_{name}" if include_interpolated else f"time_ni_{name}"
+    (
+        read_artifact(data_dir(f"samples/{name}"))
+        .pipe(interpolate_per_trip, include_interpolated)
+        .pipe(write_artifact, data_dir(f"samples/{out_file}"), compression_level=10)
+    )
+
+
 def ensure_time_window(name: str, include_interpolated: bool = False):
     """
     Makes sure the time expanded data file exists on the system. If it does not
@@ -102,8 +132,4 @@ def ensure_time_window(name: str, include_interpolated: bool = False):
     if os.path.isfile(data_dir(f"samples/{filename}")):
         return
 
-    (
-        pl.read_parquet(f"../data/samples/{name}")
-        .pipe(interpolate_per_trip, include_interpolated)
-        .write_parquet(data_dir(f"samples/{filename}"), compression_level=10)
-    )
+    time_window(name, out_file=filename, include_interpolated=include_interpolated)